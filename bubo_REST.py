@@ -1,10 +1,23 @@
-import json
 import logging
 import re
 from pyats import aetest
 from pyats.log.utils import banner
-from genie.utils.diff import Diff
 from tabulate import tabulate
+from bubo_diff import diff, format_changes
+from bubo_rules import NATIVE_RULES, report_rule
+from bubo_cache import snapshots
+from bubo_snapshot import write_snapshot
+from bubo_counters import evaluate_counters, counter_thresholds, fleet_counter_matrix, log_fleet_counters, report_counter
+from bubo_counters import counter_mode, counter_rate_thresholds, evaluate_counter_deltas, CounterStore, DEFAULT_COUNTER_STORE
+from bubo_counters import OPENCONFIG_COUNTER_RULES
+from bubo_parallel import connect_devices, prefetch, start_pipelines, stop_pipelines
+from bubo_parallel import DEFAULT_CONNECT_POOL_SIZE, DEFAULT_DEVICE_POOL_SIZE, DEFAULT_PREFETCH_DEPTH
+from bubo_replay import record
+from bubo_timing import export_timings, instrument, set_testcase, timings
+from bubo_profile import start_profile, stop_profile
+from bubo_interfaces import canonical_mapping, index_by_name, intended_description, interface_name_index, match_interfaces, native_interface_names
+from bubo_restconf import fetch_changed_native, fetch_native, fetch_interfaces, YangPatch
+from bubo_restconf import NATIVE_URL, NATIVE_ROOT, OPENCONFIG_INTERFACES_URL, OPENCONFIG_INTERFACES_ROOT
 
 # ----------------
 # Get logger for script
@@ -12,6 +25,26 @@ from tabulate import tabulate
 
 log = logging.getLogger(__name__)
 
+# Counters of every device, for fleet wide queries when numpy is installed
+fleet_counters = fleet_counter_matrix(OPENCONFIG_COUNTER_RULES)
+
+# ----------------
+# Send batched remediation from a test section
+# ----------------
+def send_patch(section, patch):
+    """Send a YangPatch to the section's device and pass or fail on the outcome of every change"""
+    table_data = []
+    for change, status, succeeded in patch.send(section.device,
+                                                chunk_size=section.device.testbed.custom.get('remediation_chunk_size')):
+        table_data.append([section.device.alias, change, status, 'Passed' if succeeded else 'Failed'])
+    log.info(tabulate(table_data,
+                        headers=['Device', 'Change', 'Status Code', 'Passed/Failed'],
+                        tablefmt='orgtbl'))
+    if any(row[3] == 'Failed' for row in table_data):
+        section.failed('Device Rejected Some Changes From Intent')
+    else:
+        section.passed('Device Accepted All Changes From Intent')
+
 # ----------------
 # AE Test Setup
 # ----------------
@@ -23,14 +56,62 @@ class common_setup(aetest.CommonSetup):
     @aetest.subsection
     def connect_to_devices(self, testbed):
         """Connect to all the devices"""
-        testbed.connect()
+        connected = connect_devices(testbed,
+                                    pool_size=testbed.custom.get('connect_pool_size', DEFAULT_CONNECT_POOL_SIZE),
+                                    timeout=testbed.custom.get('connect_timeout'),
+                                    via='rest')
+        self.parent.parameters['connected_devices'] = connected
+        for name in connected:
+            instrument(testbed.devices[name], rest=True)
+        if not connected:
+            self.failed('Could not connect to any device')
+        elif len(connected) < len(testbed.devices):
+            unreachable = [name for name in testbed.devices if name not in connected]
+            self.passx(f"Continuing without unreachable devices { unreachable }")
+# ----------------
+# Record device exchanges for offline replay
+# ----------------
+    @aetest.subsection
+    def record_cassettes(self, testbed, connected_devices):
+        """Record every RESTCONF exchange of the devices to replay the run later"""
+        directory = testbed.custom.get('record_cassettes')
+        if not directory:
+            self.skipped('record_cassettes is not set')
+        for name in connected_devices:
+            record(testbed.devices[name], directory, rest=True)
 # ----------------
 # Mark the loop for Input Discards
 # ----------------
     @aetest.subsection
-    def loop_mark(self, testbed):
-        aetest.loop.mark(Test_Cisco_IOS_XE_Native, device_name=testbed.devices)
-        aetest.loop.mark(Test_Interfaces, device_name=testbed.devices)
+    def loop_mark(self, testbed, connected_devices):
+        aetest.loop.mark(Test_Cisco_IOS_XE_Native, device_name=connected_devices)
+        aetest.loop.mark(Test_Interfaces, device_name=connected_devices)
+# ----------------
+# Collect device data in a worker pool
+# ----------------
+    @aetest.subsection
+    def prefetch_device_data(self, testbed, connected_devices):
+        """Fetch the RESTCONF data for every device in parallel"""
+        mode = testbed.custom.get('device_pool_mode', 'serial')
+        if mode == 'serial':
+            self.skipped('device_pool_mode is serial, each testcase fetches its own data')
+        devices = [testbed.devices[name] for name in connected_devices]
+        pool_size = testbed.custom.get('device_pool_size', DEFAULT_DEVICE_POOL_SIZE)
+        # bubo_async_rest.AsyncRest takes both GETs of a device at once
+        concurrent_keys = all(hasattr(device.rest, 'get_many') for device in devices)
+        if mode == 'pipeline':
+            # Fetch a few devices ahead of each testcase instead of everything up front
+            start_pipelines(devices,
+                            [{'native': fetch_changed_native}, {'openconfig-interfaces': fetch_interfaces}],
+                            depth=testbed.custom.get('prefetch_depth', DEFAULT_PREFETCH_DEPTH),
+                            pool_size=pool_size,
+                            concurrent_keys=concurrent_keys)
+            return
+        prefetch(devices,
+                 {'native': fetch_changed_native, 'openconfig-interfaces': fetch_interfaces},
+                 mode=mode,
+                 pool_size=pool_size,
+                 concurrent_keys=concurrent_keys)
 
 # ----------------
 # Test Case #1
@@ -43,265 +124,53 @@ class Test_Cisco_IOS_XE_Native(aetest.Testcase):
         """ Testcase Setup section """
         # connect to device
         self.device = testbed.devices[device_name]
+        set_testcase(type(self).__name__)
+        start_profile(self, self.device)
         # Loop over devices in tested for testing
+        self.failed_rules = {}
+        self.missing_interfaces = []
+        self.intended_interfaces = interface_name_index(self.device.interfaces)
     
     @aetest.test
     def get_yang_data(self):
-        # Use the RESTCONF OpenConfig YANG Model 
-        parsed_native = self.device.rest.get("/restconf/data/Cisco-IOS-XE-native:native")
-        # Get the JSON payload
-        self.parsed_json=parsed_native.json()
+        # Get the JSON payload, fetched once until bubo changes the device
+        self.parsed_json = snapshots.get(self.device, 'native', fetch_changed_native)
+        with timings.timed(self.device, 'evaluate', 'native rules'):
+            self.configured_interfaces = interface_name_index(native_interface_names(self.parsed_json))
+            # Every intent rule in one pass over the native snapshot
+            self.rule_results = NATIVE_RULES.evaluate(self.device.alias, self.device.custom, self.parsed_json)
 
     @aetest.test
     def create_files(self):
         # Create .JSON file
-        with open(f'JSON/{self.device.alias}_Cisco_IOS_XE_Native_PRE_TEST.json', 'w') as f:
-            f.write(json.dumps(self.parsed_json, indent=4, sort_keys=True))
+        write_snapshot(self.device, 'Cisco_IOS_XE_Native', 'PRE_TEST', self.parsed_json)
     
     @aetest.test
     def test_motd(self):
         # Test for motd banner against intent
-        self.failed_banner={}
-        table_data = []
-        table_row = []
-        if 'banner' in self.parsed_json['Cisco-IOS-XE-native:native']:
-            if 'motd' in self.parsed_json['Cisco-IOS-XE-native:native']['banner']:
-                if self.parsed_json['Cisco-IOS-XE-native:native']['banner']['motd']['banner'] == self.device.custom.motd:
-                    table_row.append(self.device.alias)
-                    table_row.append("Has Correct Banner")
-                    table_row.append('Passed')
-                else:
-                    table_row.append(self.device.alias)            
-                    table_row.append("Has Incorrect Banner")          
-                    table_row.append('Failed')
-                    self.failed_banner = "Incorrect Banner"
-            else:
-                table_row.append(self.device.alias)            
-                table_row.append("No MOTD Banner")          
-                table_row.append('Failed')
-                self.failed_banner = "No MOTD Banner"
-        else:
-            table_row.append(self.device.alias)            
-            table_row.append("No MOTD Banner")          
-            table_row.append('Failed')
-            self.failed_banner = "No Banners"
-        table_data.append(table_row)
-            # display the table
-        log.info(tabulate(table_data,
-                            headers=['Device', 'Has Banner', 'Passed/Failed'],
-                            tablefmt='orgtbl'))
-        # should we pass or fail?
-        if self.failed_banner:
-            self.failed('Device Does Not Have A MOTD Banner')
-        else:
-            self.passed('Device Has Correct MOTD Banner')
-
-    @aetest.test
-    def update_motd_banner(self):
-        if self.failed_banner:
-            self.pre_change_parsed_json = self.parsed_json
-            payload = json.dumps({
-                                    "Cisco-IOS-XE-native:banner": f"{ self.device.custom.motd }"
-                                })
-            update_motd_banner = self.device.rest.put("/restconf/data/Cisco-IOS-XE-native:native/banner/motd/banner", payload=payload)
-            log.info(f"The PUT to update the motd banner status code was { update_motd_banner }")
-            log.info("Re-testing motd")        
-        else:
-            self.skipped('No motd mismatches skipping test')
-
-    @aetest.test
-    def get_post_test_yang_data(self):
-        if self.failed_banner:
-            # Use the RESTCONF OpenConfig YANG Model 
-            post_parsed_native = self.device.rest.get("/restconf/data/Cisco-IOS-XE-native:native")
-            # Get the JSON payload
-            self.post_parsed_json=post_parsed_native.json()
-        else:
-            self.skipped('No motd mismatches skipping test')
-
-    @aetest.test
-    def create_post_test_files(self):
-        # Create .JSON file
-        if self.failed_banner:
-            with open(f'JSON/{self.device.alias}_Cisco_IOS_XE_Native_POST_TEST.json', 'w') as f:
-                f.write(json.dumps(self.post_parsed_json, indent=4, sort_keys=True))
-        else:
-            self.skipped('No motd mismatches skipping test')
-
-    @aetest.test
-    def pre_post_diff(self):
-        if self.failed_banner:
-            if 'banner' in self.parsed_json['Cisco-IOS-XE-native:native']:
-                if 'motd' in self.parsed_json['Cisco-IOS-XE-native:native']['banner']:            
-                    pre_change = self.pre_change_parsed_json['Cisco-IOS-XE-native:native']['banner']['motd']
-                else: 
-                    pre_change = {
-                        "Cisco-IOS-XE-native:motd": {
-                            "banner": ""
-                        }
-                    }
-            else:
-                pre_change = {
-                                "Cisco-IOS-XE-native:motd": {
-                                 "banner": ""
-                            }
-                        }
-            post_change = self.post_parsed_json['Cisco-IOS-XE-native:native']['banner']['motd']
-            diff = Diff(pre_change, post_change)
-            diff.findDiff()
-            log.info(diff)
-        else:
-            self.skipped('No MOTD mismatches skipping test')
-
-    @aetest.test
-    def retest(self):
-        if self.failed_banner:
-            self.get_yang_data()
-            self.test_motd()
-        else:
-            self.skipped('No MOTD mismatches skipping test')
+        report_rule(self, self.rule_results['motd'])
 
     @aetest.test
     def test_ip_domain_name(self):
-        # Test for input discards
-        self.failed_domain_name={}
-        table_data = []
-        table_row = []
-        if 'ip' in self.parsed_json['Cisco-IOS-XE-native:native']:
-            if 'domain' in self.parsed_json['Cisco-IOS-XE-native:native']['ip']:
-                if 'name' in self.parsed_json['Cisco-IOS-XE-native:native']['ip']['domain']:
-                    if self.parsed_json['Cisco-IOS-XE-native:native']['ip']['domain']['name'] == self.device.custom.domain_name:
-                        table_row.append(self.device.alias)
-                        table_row.append(self.device.custom.domain_name)
-                        table_row.append(self.parsed_json['Cisco-IOS-XE-native:native']['ip']['domain']['name'])
-                        table_row.append('Passed')
-                    else:
-                        table_row.append(self.device.alias)
-                        table_row.append(self.device.custom.domain_name)           
-                        table_row.append(self.parsed_json['Cisco-IOS-XE-native:native']['ip']['domain']['name'])          
-                        table_row.append('Failed')
-                        self.failed_domain_name = self.parsed_json['Cisco-IOS-XE-native:native']['ip']['domain']['name']
-                else:
-                    table_row.append(self.device.alias)
-                    table_row.append(self.device.custom.domain_name)
-                    table_row.append("No Domain Name Configured")
-                    table_row.append('Failed')
-                    self.failed_domain_name = "No Domain Name"
-            else:
-                table_row.append(self.device.alias)
-                table_row.append(self.device.custom.domain_name)
-                table_row.append("No Domain Name Configured")
-                table_row.append('Failed')
-                self.failed_domain_name = "No Domain Name"
-        else:
-            table_row.append(self.device.alias)
-            table_row.append(self.device.custom.domain_name)
-            table_row.append("No Domain Name Configured")
-            table_row.append('Failed')
-            self.failed_domain_name = "No Domain Name"
-
-        table_data.append(table_row)
-            # display the table
-        log.info(tabulate(table_data,
-                            headers=['Device', 'Intent Domain Name', 'Configured Domain Name', 'Passed/Failed'],
-                            tablefmt='orgtbl'))
-        # should we pass or fail?
-        if self.failed_domain_name:
-            self.failed('Device Does Not Have A Domain Name')
-        else:
-            self.passed('Device Has The Correct Domain Name')
-
-    @aetest.test
-    def update_domain_name(self):
-        if self.failed_domain_name:
-            self.pre_change_parsed_json = self.parsed_json
-            payload = json.dumps({
-                                    "Cisco-IOS-XE-native:name": f"{self.device.custom.domain_name}"
-                                })
-            update_domain_name = self.device.rest.put("/restconf/data/Cisco-IOS-XE-native:native/ip/domain/name", payload=payload)
-            log.info(f"The PUT to update the domain name status code was { update_domain_name }")
-            log.info("Re-testing domain name")        
-        else:
-            self.skipped('No domain name mismatches skipping test')
-
-    @aetest.test
-    def get_post_test_yang_data(self):
-        if self.failed_domain_name:
-            # Use the RESTCONF OpenConfig YANG Model 
-            post_parsed_native = self.device.rest.get("/restconf/data/Cisco-IOS-XE-native:native")
-            # Get the JSON payload
-            self.post_parsed_json=post_parsed_native.json()
-        else:
-            self.skipped('No domain name mismatches skipping test')
-
-    @aetest.test
-    def create_post_test_files(self):
-        # Create .JSON file
-        if self.failed_domain_name:
-            with open(f'JSON/{self.device.alias}_Cisco_IOS_XE_Native_POST_TEST.json', 'w') as f:
-                f.write(json.dumps(self.post_parsed_json, indent=4, sort_keys=True))
-        else:
-            self.skipped('No domain name mismatches skipping test')
-
-    @aetest.test
-    def pre_post_diff(self):
-        if self.failed_domain_name:
-            if 'ip' in self.parsed_json['Cisco-IOS-XE-native:native']:
-                if 'domain' in self.parsed_json['Cisco-IOS-XE-native:native']['ip']:
-                    if 'name' in self.parsed_json['Cisco-IOS-XE-native:native']['ip']['domain']:           
-                        pre_change = self.pre_change_parsed_json['Cisco-IOS-XE-native:native']['ip']['domain']
-                    else: 
-                        pre_change = {
-                                "Cisco-IOS-XE-native:domain": {
-                                "name": ""
-                                }
-                            }
-                else:
-                    pre_change = {
-                            "Cisco-IOS-XE-native:domain": {
-                            "name": ""
-                            }
-                        }
-            else:
-                pre_change = {
-                        "Cisco-IOS-XE-native:domain": {
-                        "name": ""
-                        }
-                    }
-            post_change = self.post_parsed_json['Cisco-IOS-XE-native:native']['ip']['domain']
-            diff = Diff(pre_change, post_change)
-            diff.findDiff()
-            log.info(diff)
-        else:
-            self.skipped('No domain name mismatches skipping test')
-
-    @aetest.test
-    def retest(self):
-        if self.failed_domain_name:
-            self.get_yang_data()
-            self.test_ip_domain_name()
-        else:
-            self.skipped('No domain name mismatches skipping test')
+        # Test for the domain name against intent
+        report_rule(self, self.rule_results['domain_name'])
 
     @aetest.test
     def test_configured_interfaces_in_intent(self):
-        # Test for input discards
+        # Test for configured interfaces missing from the intent
         self.failed_intent_interfaces={}
         table_data = []
-        for actual_interface,actual_value in self.parsed_json['Cisco-IOS-XE-native:native']['interface'].items():
-            for actual_key in actual_value:
-                table_row = []
-                configured_interface = f"{ actual_interface }{ actual_key['name'] }"
-                if configured_interface in self.device.interfaces:
-                    table_row.append(self.device.alias)
-                    table_row.append(configured_interface)
-                    table_row.append('Passed')
-                else:
-                    table_row.append(self.device.alias)            
-                    table_row.append(configured_interface)          
-                    table_row.append('Failed')
-                    self.failed_intent_interfaces = configured_interface
-                table_data.append(table_row)                
+        extra_interfaces = self.configured_interfaces.keys() - self.intended_interfaces.keys()
+        for canonical_name, configured_interface in self.configured_interfaces.items():
+            table_row = []
+            table_row.append(self.device.alias)
+            table_row.append(configured_interface)
+            if canonical_name in extra_interfaces:
+                table_row.append('Failed')
+                self.failed_intent_interfaces = configured_interface
+            else:
+                table_row.append('Passed')
+            table_data.append(table_row)
             # display the table
         
         log.info(tabulate(table_data,
@@ -315,27 +184,22 @@ class Test_Cisco_IOS_XE_Native(aetest.Testcase):
 
     @aetest.test
     def test_intended_interfaces_in_config(self):
-        # Test for input discards
+        # Test for intended interfaces missing from the configuration
         self.failed_intent_interfaces={}
         table_data = []
-        configured_interface_list = []
-        for actual_interface,actual_value in self.parsed_json['Cisco-IOS-XE-native:native']['interface'].items():
-            for actual_key in actual_value:
-                configured_interface_list.append(f"{ actual_interface }{ actual_key['name'] }")
+        missing_interfaces = self.intended_interfaces.keys() - self.configured_interfaces.keys()
         self.missing_interfaces = []
-        for intended_interface in self.device.interfaces:
+        for canonical_name, intended_interface in self.intended_interfaces.items():
             table_row = []
-            if intended_interface in configured_interface_list:
-                table_row.append(self.device.alias)
-                table_row.append(intended_interface)
-                table_row.append('Passed')
-            else:
-                table_row.append(self.device.alias)            
-                table_row.append(intended_interface)          
+            table_row.append(self.device.alias)
+            table_row.append(intended_interface)
+            if canonical_name in missing_interfaces:
                 table_row.append('Failed')
                 self.failed_intent_interfaces = intended_interface
-                self.missing_interfaces.append(intended_interface)
-            table_data.append(table_row)                
+                self.missing_interfaces.append(canonical_name)
+            else:
+                table_row.append('Passed')
+            table_data.append(table_row)
             # display the table
         
         log.info(tabulate(table_data,
@@ -348,66 +212,83 @@ class Test_Cisco_IOS_XE_Native(aetest.Testcase):
             self.passed('Device Has All Intended Interfaces in Intent YAML Model Configured')
 
     @aetest.test
-    def update_configured_interfaces_from_intent(self):
-        if self.failed_intent_interfaces:
+    def update_native_from_intent(self):
+        # Send every change the tests found as one merged PATCH
+        patch = YangPatch(NATIVE_URL, NATIVE_ROOT)
+        self.remediated = False
+        for name, result in self.failed_rules.items():
+            patch.add(result.rule.column, result.rule.remediation, result.expected)
+        for interface in self.missing_interfaces:
+            interface_type = re.search(r"[a-zA-Z\-]*", f"{ interface }").group()
+            patch.add(f"interface { interface }", ('interface', interface_type),
+                      {"name": f"{ interface[len(interface_type):] }"}, list_entry=True)
+        if patch:
+            self.remediated = True
             self.pre_change_parsed_json = self.parsed_json
-            for interface in self.missing_interfaces:
-                interface_type = re.search(r"[a-zA-Z]*", f"{ interface }").group()
-                interface_number = re.search('\d+|$', f'{ interface }').group()
-                payload = json.dumps({
-                                "Cisco-IOS-XE-native:interface": {
-                                f"{ interface_type }": [
-                                {
-                                    "name": f"{ interface_number }"
-                                }
-                                        ]
-                                }
-                            }
-                            )
-                create_interface = self.device.rest.patch("/restconf/data/Cisco-IOS-XE-native:native/interface", payload=payload)
-                log.info(f"The PATCH to create the missing intended interface status code was { create_interface }")
-                log.info("Re-testing motd")        
+            send_patch(self, patch)
         else:
-            self.skipped('Device Has All Intended Interfaces in Intent YAML Model Configured')
+            self.skipped('No native mismatches skipping test')
 
     @aetest.test
     def get_post_test_yang_data(self):
-        if self.failed_intent_interfaces:
-            # Use the RESTCONF OpenConfig YANG Model 
-            post_parsed_native = self.device.rest.get("/restconf/data/Cisco-IOS-XE-native:native")
-            # Get the JSON payload
-            self.post_parsed_json=post_parsed_native.json()
+        if self.remediated:
+            self.post_parsed_json = snapshots.get(self.device, 'native', fetch_native)
         else:
-            self.skipped('Device Has All Intended Interfaces in Intent YAML Model Configured')
+            self.skipped('No native mismatches skipping test')
 
     @aetest.test
     def create_post_test_files(self):
         # Create .JSON file
-        if self.failed_intent_interfaces:
-            with open(f'JSON/{self.device.alias}_Cisco_IOS_XE_Native_POST_TEST.json', 'w') as f:
-                f.write(json.dumps(self.post_parsed_json, indent=4, sort_keys=True))
+        if self.remediated:
+            write_snapshot(self.device, 'Cisco_IOS_XE_Native', 'POST_TEST', self.post_parsed_json)
         else:
-            self.skipped('Device Has All Intended Interfaces in Intent YAML Model Configured')
+            self.skipped('No native mismatches skipping test')
 
     @aetest.test
     def pre_post_diff(self):
-        if self.failed_intent_interfaces:           
-            pre_change = self.pre_change_parsed_json['Cisco-IOS-XE-native:native']['interface']
-            post_change = self.post_parsed_json['Cisco-IOS-XE-native:native']['interface']
-            diff = Diff(pre_change, post_change)
-            diff.findDiff()
-            log.info(diff)
+        if self.remediated:
+            pre_native = self.pre_change_parsed_json['Cisco-IOS-XE-native:native']
+            post_native = self.post_parsed_json['Cisco-IOS-XE-native:native']
+            subtrees = [result.rule.remediation[0] for result in self.failed_rules.values()]
+            if self.missing_interfaces:
+                subtrees.append('interface')
+            for subtree in dict.fromkeys(subtrees):
+                with timings.timed(self.device, 'diff', subtree):
+                    log.info(format_changes(diff(pre_native.get(subtree, {}), post_native.get(subtree, {}))))
         else:
-            self.skipped('Device Has All Intended Interfaces in Intent YAML Model Configured')
+            self.skipped('No native mismatches skipping test')
 
     @aetest.test
-    def retest(self):
-        if self.failed_intent_interfaces:
+    def retest_motd(self):
+        if 'motd' in self.failed_rules:
+            self.get_yang_data()
+            self.test_motd()
+        else:
+            self.skipped('No MOTD mismatches skipping test')
+
+    @aetest.test
+    def retest_ip_domain_name(self):
+        if 'domain_name' in self.failed_rules:
+            self.get_yang_data()
+            self.test_ip_domain_name()
+        else:
+            self.skipped('No domain name mismatches skipping test')
+
+    @aetest.test
+    def retest_intended_interfaces_in_config(self):
+        if self.missing_interfaces:
             self.get_yang_data()
             self.test_intended_interfaces_in_config()
         else:
             self.skipped('Device Has All Intended Interfaces in Intent YAML Model Configured')
 
+    @aetest.cleanup
+    def cleanup(self, testbed, device_name):
+        # Write the profile of this iteration when the job asked for one
+        stop_profile(self)
+        # Let go of the native snapshot of this device
+        snapshots.evict(testbed.devices[device_name], ['native'])
+
 # ----------------
 # Test Case #2
 # ----------------
@@ -419,248 +300,72 @@ class Test_Interfaces(aetest.Testcase):
         """ Testcase Setup section """
         # connect to device
         self.device = testbed.devices[device_name]
+        set_testcase(type(self).__name__)
+        start_profile(self, self.device)
         # Loop over devices in tested for testing
     
     @aetest.test
     def get_pre_test_yang_data(self):
-        # Use the RESTCONF OpenConfig YANG Model 
-        parsed_openconfig_interfaces = self.device.rest.get("/restconf/data/openconfig-interfaces:interfaces")
-        # Get the JSON payload
-        self.parsed_json=parsed_openconfig_interfaces.json()
+        # Get the JSON payload, fetched once until bubo changes the device
+        self.parsed_json = snapshots.get(self.device, 'openconfig-interfaces', fetch_interfaces)
+        self.interfaces = index_by_name(self.parsed_json['openconfig-interfaces:interfaces']['interface'])
 
     @aetest.test
     def create_pre_test_files(self):
         # Create .JSON file
-        with open(f'JSON/{self.device.alias}_OpenConfig_Interfaces_PRE_TEST.json', 'w') as f:
-            f.write(json.dumps(self.parsed_json, indent=4, sort_keys=True))
+        write_snapshot(self.device, 'OpenConfig_Interfaces', 'PRE_TEST', self.parsed_json)
     
+    @aetest.test
+    def evaluate_interface_counters(self):
+        # Evaluate every counter rule in one pass over the interface list
+        interfaces = ((intf['name'], intf['state']['counters']) for intf in self.parsed_json['openconfig-interfaces:interfaces']['interface'])
+        with timings.timed(self.device, 'evaluate', 'counters'):
+            if counter_mode(self.device) == 'delta':
+                # Rates since the counters stored by the previous run
+                store = CounterStore(self.device.testbed.custom.get('counter_store') or DEFAULT_COUNTER_STORE)
+                self.counter_results = evaluate_counter_deltas(
+                    self.device,
+                    interfaces,
+                    OPENCONFIG_COUNTER_RULES,
+                    counter_rate_thresholds(self.device, OPENCONFIG_COUNTER_RULES),
+                    store)
+            else:
+                self.counter_results = evaluate_counters(
+                    self.device,
+                    interfaces,
+                    OPENCONFIG_COUNTER_RULES,
+                    counter_thresholds(self.device, OPENCONFIG_COUNTER_RULES),
+                    matrix=fleet_counters)
+
     @aetest.test
     def test_interface_input_discards(self):
         # Test for input discards
-        in_discards_threshold = 0
-        self.failed_interfaces = {}
-        table_data = []
-        for intf in self.parsed_json['openconfig-interfaces:interfaces']['interface']:
-            counter = intf['state']['counters']['in-discards']
-            if counter:
-                table_row = []
-                table_row.append(self.device.alias)
-                table_row.append(intf['name'])
-                table_row.append(counter)
-                if int(counter) > in_discards_threshold:
-                    table_row.append('Failed')
-                    self.failed_interfaces[intf['name']] = int(counter)
-                    self.interface_name = intf['name']
-                    self.error_counter = self.failed_interfaces[intf['name']]
-                else:
-                    table_row.append('Passed')
-            else:
-                table_row.append(self.device.alias)
-                table_row.append(intf)
-                table_row.append('N/A')
-                table_row.append('N/A')
-            table_data.append(table_row)
-            # display the table
-        log.info(tabulate(table_data,
-                            headers=['Device', 'Interface',
-                                    'Input Discard Counter',
-                                    'Passed/Failed'],
-                            tablefmt='orgtbl'))
-        # should we pass or fail?
-        if self.failed_interfaces:
-            self.failed('Some interfaces have input discards')
-        else:
-            self.passed('No interfaces have input discards')
+        report_counter(self, self.counter_results['in-discards'])
 
     @aetest.test
     def test_interface_input_errors(self):
-        # Test for input discards
-        in_errors_threshold = 0
-        self.failed_interfaces = {}
-        table_data = []
-        for intf in self.parsed_json['openconfig-interfaces:interfaces']['interface']:
-            counter = intf['state']['counters']['in-errors']
-            if counter:
-                table_row = []
-                table_row.append(self.device.alias)
-                table_row.append(intf['name'])
-                table_row.append(counter)
-                if int(counter) > in_errors_threshold:
-                    table_row.append('Failed')
-                    self.failed_interfaces[intf['name']] = int(counter)
-                    self.interface_name = intf['name']
-                    self.error_counter = self.failed_interfaces[intf['name']]
-                else:
-                    table_row.append('Passed')
-            else:
-                table_row.append(self.device.alias)
-                table_row.append(intf)
-                table_row.append('N/A')
-                table_row.append('N/A')
-            table_data.append(table_row)
-            # display the table
-        log.info(tabulate(table_data,
-                            headers=['Device', 'Interface',
-                                    'Input Errors Counter',
-                                    'Passed/Failed'],
-                            tablefmt='orgtbl'))
-        # should we pass or fail?
-        if self.failed_interfaces:
-            self.failed('Some interfaces have input errors')
-        else:
-            self.passed('No interfaces have input errors')
+        # Test for input errors
+        report_counter(self, self.counter_results['in-errors'])
 
     @aetest.test
     def test_interface_input_fcs_errors(self):
-        # Test for input discards
-        in_fcs_errors_threshold = 0
-        self.failed_interfaces = {}
-        table_data = []
-        for intf in self.parsed_json['openconfig-interfaces:interfaces']['interface']:
-            counter = intf['state']['counters']['in-fcs-errors']
-            if counter:
-                table_row = []
-                table_row.append(self.device.alias)
-                table_row.append(intf['name'])
-                table_row.append(counter)
-                if int(counter) > in_fcs_errors_threshold:
-                    table_row.append('Failed')
-                    self.failed_interfaces[intf['name']] = int(counter)
-                    self.interface_name = intf['name']
-                    self.error_counter = self.failed_interfaces[intf['name']]
-                else:
-                    table_row.append('Passed')
-            else:
-                table_row.append(self.device.alias)
-                table_row.append(intf)
-                table_row.append('N/A')
-                table_row.append('N/A')
-            table_data.append(table_row)
-            # display the table
-        log.info(tabulate(table_data,
-                            headers=['Device', 'Interface',
-                                    'Input FCS Errors Counter',
-                                    'Passed/Failed'],
-                            tablefmt='orgtbl'))
-        # should we pass or fail?
-        if self.failed_interfaces:
-            self.failed('Some interfaces have input fcs errors')
-        else:
-            self.passed('No interfaces have input fcs errors')
+        # Test for input fcs errors
+        report_counter(self, self.counter_results['in-fcs-errors'])
 
     @aetest.test
     def test_interface_input_unknown_protocols(self):
-        # Test for input discards
-        in_unknown_protocols_threshold = 0
-        self.failed_interfaces = {}
-        table_data = []
-        for intf in self.parsed_json['openconfig-interfaces:interfaces']['interface']:
-            counter = intf['state']['counters']['in-unknown-protos']
-            if counter:
-                table_row = []
-                table_row.append(self.device.alias)
-                table_row.append(intf['name'])
-                table_row.append(counter)
-                if int(counter) > in_unknown_protocols_threshold:
-                    table_row.append('Failed')
-                    self.failed_interfaces[intf['name']] = int(counter)
-                    self.interface_name = intf['name']
-                    self.error_counter = self.failed_interfaces[intf['name']]
-                else:
-                    table_row.append('Passed')
-            else:
-                table_row.append(self.device.alias)
-                table_row.append(intf)
-                table_row.append('N/A')
-                table_row.append('N/A')
-            table_data.append(table_row)
-            # display the table
-        log.info(tabulate(table_data,
-                            headers=['Device', 'Interface',
-                                    'Input Unknown Protocols Counter',
-                                    'Passed/Failed'],
-                            tablefmt='orgtbl'))
-        # should we pass or fail?
-        if self.failed_interfaces:
-            self.failed('Some interfaces have input unknown protocols')
-        else:
-            self.passed('No interfaces have input unknwon protocols')
+        # Test for input unknown protocols
+        report_counter(self, self.counter_results['in-unknown-protos'])
 
     @aetest.test
     def test_interface_output_discards(self):
-        # Test for input discards
-        out_discards_threshold = 0
-        self.failed_interfaces = {}
-        table_data = []
-        for intf in self.parsed_json['openconfig-interfaces:interfaces']['interface']:
-            counter = intf['state']['counters']['out-discards']
-            if counter:
-                table_row = []
-                table_row.append(self.device.alias)
-                table_row.append(intf['name'])
-                table_row.append(counter)
-                if int(counter) > out_discards_threshold:
-                    table_row.append('Failed')
-                    self.failed_interfaces[intf['name']] = int(counter)
-                    self.interface_name = intf['name']
-                    self.error_counter = self.failed_interfaces[intf['name']]
-                else:
-                    table_row.append('Passed')
-            else:
-                table_row.append(self.device.alias)
-                table_row.append(intf)
-                table_row.append('N/A')
-                table_row.append('N/A')
-            table_data.append(table_row)
-            # display the table
-        log.info(tabulate(table_data,
-                            headers=['Device', 'Interface',
-                                    'Output Discards Counter',
-                                    'Passed/Failed'],
-                            tablefmt='orgtbl'))
-        # should we pass or fail?
-        if self.failed_interfaces:
-            self.failed('Some interfaces have output discards')
-        else:
-            self.passed('No interfaces have output discards')
+        # Test for output discards
+        report_counter(self, self.counter_results['out-discards'])
 
     @aetest.test
     def test_interface_output_errors(self):
-        # Test for input discards
-        out_errors_threshold = 0
-        self.failed_interfaces = {}
-        table_data = []
-        for intf in self.parsed_json['openconfig-interfaces:interfaces']['interface']:
-            counter = intf['state']['counters']['out-errors']
-            if counter:
-                table_row = []
-                table_row.append(self.device.alias)
-                table_row.append(intf['name'])
-                table_row.append(counter)
-                if int(counter) > out_errors_threshold:
-                    table_row.append('Failed')
-                    self.failed_interfaces[intf['name']] = int(counter)
-                    self.interface_name = intf['name']
-                    self.error_counter = self.failed_interfaces[intf['name']]
-                else:
-                    table_row.append('Passed')
-            else:
-                table_row.append(self.device.alias)
-                table_row.append(intf)
-                table_row.append('N/A')
-                table_row.append('N/A')
-            table_data.append(table_row)
-            # display the table
-        log.info(tabulate(table_data,
-                            headers=['Device', 'Interface',
-                                    'Output Errors Counter',
-                                    'Passed/Failed'],
-                            tablefmt='orgtbl'))
-        # should we pass or fail?
-        if self.failed_interfaces:
-            self.failed('Some interfaces have output errors')
-        else:
-            self.passed('No interfaces have output errors')
+        # Test for output errors
+        report_counter(self, self.counter_results['out-errors'])
 
     @aetest.test
     def test_interface_full_duplex(self):
@@ -740,43 +445,28 @@ class Test_Interfaces(aetest.Testcase):
     def test_interface_description_matches_intent(self):
         # Test for input discards
         self.failed_interfaces = {}
+        self.pending_descriptions = {}
         table_data = []
-        for self.intf in self.parsed_json['openconfig-interfaces:interfaces']['interface']:
-            if 'description' in self.intf['config']:
-                for interface,value in self.device.interfaces.items():
-                    if self.intf['name'] == interface:
-                        self.intended_desc = value['description']
-                        actual_desc = self.intf['config']['description']
-                        table_row = []
-                        table_row.append(self.device.alias)
-                        table_row.append(self.intf['name'])
-                        table_row.append(self.intended_desc)
-                        table_row.append(actual_desc)
-                        if actual_desc != self.intended_desc:
-                            table_row.append('Failed')
-                            self.failed_interfaces[self.intf['name']] = self.intended_desc
-                            self.interface_name = self.intf['name']
-                            self.error_counter = self.failed_interfaces[self.intf['name']]
-                        else:
-                            table_row.append('Passed')
-                        table_data.append(table_row)
+        for name, self.intf, intent_value in match_interfaces(self.interfaces, canonical_mapping(self.device.interfaces)):
+            self.intended_desc = intended_description(intent_value)
+            if self.intended_desc is None:
+                continue
+            actual_desc = self.intf['config'].get('description', "")
+            table_row = []
+            table_row.append(self.device.alias)
+            table_row.append(name)
+            table_row.append(self.intended_desc)
+            table_row.append(actual_desc)
+            if actual_desc != self.intended_desc:
+                table_row.append('Failed')
+                self.failed_interfaces[name] = self.intended_desc
+                self.interface_name = name
+                self.error_counter = self.failed_interfaces[name]
+                if 'description' not in self.intf['config']:
+                    self.pending_descriptions[name] = self.intended_desc
             else:
-                for interface,value in self.device.interfaces.items():
-                    if self.intf['name'] == interface:
-                        self.intended_desc = value['description']
-                        actual_desc = ""
-                        table_row = []
-                        table_row.append(self.device.alias)
-                        table_row.append(self.intf['name'])
-                        table_row.append(self.intended_desc)
-                        table_row.append(actual_desc)
-                        if actual_desc != self.intended_desc:
-                            table_row.append('Failed')
-                            self.failed_interfaces[self.intf['name']] = self.intended_desc
-                            self.interface_name = self.intf['name']
-                            self.error_counter = self.failed_interfaces[self.intf['name']]
-                            self.update_interface_description()
-                        table_data.append(table_row)                            
+                table_row.append('Passed')
+            table_data.append(table_row)
         # display the table
         log.info(tabulate(table_data,
                             headers=['Device', 'Interface',
@@ -791,25 +481,26 @@ class Test_Interfaces(aetest.Testcase):
         else:
             self.passed('All interfaces intent / actual descriptions match')
 
-    def update_interface_description(self):
-        if self.failed_interfaces:
-            self.pre_change_parsed_json = self.parsed_json
-            payload = json.dumps({
-                            "openconfig-interfaces:description": f"{ self.intended_desc }"
-                        })
-            update_interface_description = self.device.rest.put(f"/restconf/data/openconfig-interfaces:interfaces/interface={ self.intf['name'] }/config/description", payload=payload)
-            log.info(f"The PUT to update the interface {self.intf['name'] } description status code was { update_interface_description }")
-            log.info("Re-testing interface")        
+    @aetest.test
+    def update_interface_descriptions(self):
+        # Send every missing description as one merged PATCH
+        self.pre_change_parsed_json = self.parsed_json
+        self.pre_change_interfaces = self.interfaces
+        if self.pending_descriptions:
+            patch = YangPatch(OPENCONFIG_INTERFACES_URL, OPENCONFIG_INTERFACES_ROOT)
+            for name, description in self.pending_descriptions.items():
+                patch.add(f"interface { name } description", ('interface',),
+                          {"name": name, "config": {"name": name, "description": f"{ description }"}},
+                          list_entry=True)
+            send_patch(self, patch)
         else:
-            self.skipped('No description mismatches skipping test')
+            self.skipped('No missing descriptions skipping test')
 
     @aetest.test
     def get_post_test_yang_data(self):
         if self.failed_interfaces:
-            # Use the RESTCONF OpenConfig YANG Model 
-            post_parsed_openconfig_interfaces = self.device.rest.get("/restconf/data/openconfig-interfaces:interfaces")
-            # Get the JSON payload
-            self.post_parsed_json=post_parsed_openconfig_interfaces.json()
+            self.post_parsed_json = snapshots.get(self.device, 'openconfig-interfaces', fetch_interfaces)
+            self.post_interfaces = index_by_name(self.post_parsed_json['openconfig-interfaces:interfaces']['interface'])
         else:
             self.skipped('No description mismatches skipping test')
 
@@ -817,20 +508,19 @@ class Test_Interfaces(aetest.Testcase):
     def create_post_test_files(self):
         # Create .JSON file
         if self.failed_interfaces:
-            with open(f'JSON/{self.device.alias}_OpenConfig_Interfaces_POST_TEST.json', 'w') as f:
-                f.write(json.dumps(self.post_parsed_json, indent=4, sort_keys=True))
+            write_snapshot(self.device, 'OpenConfig_Interfaces', 'POST_TEST', self.post_parsed_json)
         else:
             self.skipped('No description mismatches skipping test')
 
     @aetest.test
     def pre_post_diff(self):
         if self.failed_interfaces:
-            for intf in self.pre_change_parsed_json['openconfig-interfaces:interfaces']['interface']:
-                    for interface in self.post_parsed_json['openconfig-interfaces:interfaces']['interface']:
-                        if intf['name'] == interface['name']:
-                            diff = Diff(intf['config'], interface['config'])
-                            diff.findDiff()
-                            log.info(diff)
+            # One diff of the config of every interface in both snapshots
+            pre_config, post_config = {}, {}
+            for name, pre_intf, post_intf in match_interfaces(self.pre_change_interfaces, self.post_interfaces):
+                pre_config[name], post_config[name] = pre_intf['config'], post_intf['config']
+            with timings.timed(self.device, 'diff', 'interface config'):
+                log.info(format_changes(diff(pre_config, post_config)))
         else:
             self.skipped('No description mismatches skipping test')
 
@@ -842,9 +532,22 @@ class Test_Interfaces(aetest.Testcase):
         else:
             self.skipped('No description mismatches skipping test')
 
+    @aetest.cleanup
+    def cleanup(self, testbed, device_name):
+        # Write the profile of this iteration when the job asked for one
+        stop_profile(self)
+        # Let go of the OpenConfig snapshot of this device
+        snapshots.evict(testbed.devices[device_name], ['openconfig-interfaces'])
+
 class CommonCleanup(aetest.CommonCleanup):
     @aetest.subsection
     def disconnect_from_devices(self, testbed):
+        stop_pipelines()
+        set_testcase('common_cleanup')
+        export_timings(testbed)
+        log.info(f"RESTCONF { snapshots.summary() }")
+        if fleet_counters is not None:
+            log_fleet_counters(fleet_counters)
         testbed.disconnect()
 
 # for running as its own executable
@@ -1,10 +1,21 @@
-import json
 import logging
 import re
 from pyats import aetest
 from pyats.log.utils import banner
-from genie.utils.diff import Diff
 from tabulate import tabulate
+from bubo_diff import diff, format_changes
+from bubo_rules import LEARNED_CONFIG_RULES, report_rule
+from bubo_counters import evaluate_counters, counter_thresholds, fleet_counter_matrix, log_fleet_counters, report_counter
+from bubo_counters import counter_mode, counter_rate_thresholds, evaluate_counter_deltas, CounterStore, DEFAULT_COUNTER_STORE
+from bubo_counters import LEARNED_COUNTER_RULES
+from bubo_interfaces import canonical_mapping, intended_description, interface_name_index, match_interfaces
+from bubo_cache import snapshots, DEFAULT_SHARED_DEVICES
+from bubo_parallel import connect_devices, prefetch, start_pipelines, stop_pipelines
+from bubo_parallel import DEFAULT_CONNECT_POOL_SIZE, DEFAULT_DEVICE_POOL_SIZE, DEFAULT_PREFETCH_DEPTH
+from bubo_replay import record
+from bubo_timing import export_timings, instrument, set_testcase, timings
+from bubo_profile import start_profile, stop_profile
+from bubo_snapshot import reuse_unchanged, write_snapshot
 
 # ----------------
 # Get logger for script
@@ -12,6 +23,71 @@ from tabulate import tabulate
 
 log = logging.getLogger(__name__)
 
+# Counters of every device, for fleet wide queries when numpy is installed
+fleet_counters = fleet_counter_matrix(LEARNED_COUNTER_RULES)
+
+# ----------------
+# pyATS learn data collection
+# ----------------
+def learn_config(device):
+    # Parsing time only, the show commands it runs are timed as io
+    with timings.timed(device, 'parse', 'learn config'):
+        return device.learn("config")
+
+# Intent items checked against the running config and an include filter
+# that finds their lines without transferring the whole config
+CONFIG_FILTERS = [
+    ('domain_name', '^ip domain[ -]name'),
+]
+
+def config_plan(device):
+    """The include filter for the intent of this device, or full to learn the whole config"""
+    if device.testbed.custom.get('config_collection', 'targeted') == 'full':
+        return 'full'
+    return '|'.join(pattern for intent, pattern in CONFIG_FILTERS if device.custom.get(intent) is not None)
+
+def collect_config(device):
+    """Collect the config lines the intent checks, keyed like learn("config") keys them"""
+    plan = config_plan(device)
+    if plan == 'full':
+        return learn_config(device)
+    if not plan:
+        return {}
+    output = device.execute(f"show running-config | include { plan }")
+    if '% Invalid' in output:
+        log.warning(f"{ device.alias } cannot filter the running config, learning the whole config")
+        return learn_config(device)
+    return {line.strip(): {} for line in output.splitlines() if line.strip() and not line.startswith(' ')}
+
+def config_fingerprint(device):
+    # The last configuration change line of the running config, None when
+    # the config has not changed since boot and there is nothing to compare
+    output = device.execute('show running-config | include Last configuration change')
+    match = re.search(r"Last configuration change at (.+)", output)
+    return f"{ config_plan(device) } { match.group(1).strip() }" if match else None
+
+# The intent config lines, or the stored copy when the device has not changed since
+collect_changed_config = reuse_unchanged('Cisco_IOS_XE_Learned_Config', collect_config, config_fingerprint)
+
+def learn_interface(device):
+    # Keep only the learned data so it can be handed back from a worker process
+    with timings.timed(device, 'parse', 'learn interface'):
+        return device.learn("interface").info
+
+def shared_interface_devices(testbed):
+    """Most devices whose learned interfaces wait for Test_Interfaces, None for no limit"""
+    # Prefetching the whole testbed up front holds every device anyway
+    if testbed.custom.get('device_pool_mode', 'serial') in ('thread', 'process'):
+        return None
+    return testbed.custom.get('shared_snapshot_devices', DEFAULT_SHARED_DEVICES)
+
+def configure(device, config_lines):
+    # Learned data of the device is stale once its config changes
+    try:
+        return device.configure(config_lines)
+    finally:
+        snapshots.invalidate(device)
+
 # ----------------
 # AE Test Setup
 # ----------------
@@ -23,14 +99,58 @@ class common_setup(aetest.CommonSetup):
     @aetest.subsection
     def connect_to_devices(self, testbed):
         """Connect to all the devices"""
-        testbed.connect()
+        connected = connect_devices(testbed,
+                                    pool_size=testbed.custom.get('connect_pool_size', DEFAULT_CONNECT_POOL_SIZE),
+                                    timeout=testbed.custom.get('connect_timeout'))
+        self.parent.parameters['connected_devices'] = connected
+        for name in connected:
+            instrument(testbed.devices[name], cli=True)
+        if not connected:
+            self.failed('Could not connect to any device')
+        elif len(connected) < len(testbed.devices):
+            unreachable = [name for name in testbed.devices if name not in connected]
+            self.passx(f"Continuing without unreachable devices { unreachable }")
+# ----------------
+# Record device exchanges for offline replay
+# ----------------
+    @aetest.subsection
+    def record_cassettes(self, testbed, connected_devices):
+        """Record every CLI exchange of the devices to replay the run later"""
+        directory = testbed.custom.get('record_cassettes')
+        if not directory:
+            self.skipped('record_cassettes is not set')
+        for name in connected_devices:
+            record(testbed.devices[name], directory, cli=True)
 # ----------------
 # Mark the loop for Input Discards
 # ----------------
     @aetest.subsection
-    def loop_mark(self, testbed):
-        aetest.loop.mark(Test_Cisco_IOS_XE_Intent, device_name=testbed.devices)
-        aetest.loop.mark(Test_Interfaces, device_name=testbed.devices)
+    def loop_mark(self, testbed, connected_devices):
+        aetest.loop.mark(Test_Cisco_IOS_XE_Intent, device_name=connected_devices)
+        aetest.loop.mark(Test_Interfaces, device_name=connected_devices)
+# ----------------
+# Collect device data in a worker pool
+# ----------------
+    @aetest.subsection
+    def prefetch_device_data(self, testbed, connected_devices):
+        """Learn the config and interfaces of every device in parallel"""
+        mode = testbed.custom.get('device_pool_mode', 'serial')
+        if mode == 'serial':
+            self.skipped('device_pool_mode is serial, each testcase learns its own data')
+        devices = [testbed.devices[name] for name in connected_devices]
+        pool_size = testbed.custom.get('device_pool_size', DEFAULT_DEVICE_POOL_SIZE)
+        if mode == 'pipeline':
+            # Learn a few devices ahead of each testcase instead of everything up front
+            # Test_Interfaces reuses the interfaces Test_Cisco_IOS_XE_Intent learned
+            start_pipelines(devices,
+                            [{'config': collect_changed_config, 'interface': learn_interface}],
+                            depth=testbed.custom.get('prefetch_depth', DEFAULT_PREFETCH_DEPTH),
+                            pool_size=pool_size)
+            return
+        prefetch(devices,
+                 {'config': collect_changed_config, 'interface': learn_interface},
+                 mode=mode,
+                 pool_size=pool_size)
 
 # ----------------
 # Test Case #1
@@ -43,114 +163,53 @@ class Test_Cisco_IOS_XE_Intent(aetest.Testcase):
         """ Testcase Setup section """
         # connect to device
         self.device = testbed.devices[device_name]
+        set_testcase(type(self).__name__)
+        start_profile(self, self.device)
         # Loop over devices in tested for testing
+        self.failed_rules = {}
+        self.missing_interfaces = []
+        self.intended_interfaces = interface_name_index(self.device.interfaces)
     
     @aetest.test
     def get_parsed_config(self):
-        parsed_config = self.device.learn("config")
-        # Get the JSON payload
-        self.parsed_json=parsed_config
+        # Get the config lines the intent checks, collected once until bubo changes the device
+        self.parsed_json = snapshots.get(self.device, 'config', collect_changed_config)
+        # Every intent rule in one pass over the config lines
+        with timings.timed(self.device, 'evaluate', 'config rules'):
+            self.rule_results = LEARNED_CONFIG_RULES.evaluate(self.device.alias, self.device.custom, self.parsed_json)
 
     @aetest.test
     def create_files(self):
         # Create .JSON file
-        with open(f'JSON/{self.device.alias}_Cisco_IOS_XE_Learned_Config_PRE_TEST.json', 'w') as f:
-            f.write(json.dumps(self.parsed_json, indent=4, sort_keys=True))
+        write_snapshot(self.device, 'Cisco_IOS_XE_Learned_Config', 'PRE_TEST', self.parsed_json)
     
     @aetest.test
     def test_ip_domain_name(self):
-        # Test for input discards
-        self.failed_domain_name={}
-        table_data = []
-        table_row = []
-        if f"ip domain name { self.device.custom.domain_name }" in self.parsed_json:
-            table_row.append(self.device.alias)
-            table_row.append(self.device.custom.domain_name)
-            table_row.append(self.device.custom.domain_name)
-            table_row.append('Passed')
-        else:
-            table_row.append(self.device.alias)
-            table_row.append(self.device.custom.domain_name)           
-            table_row.append("Different Domain Name Configured")          
-            table_row.append('Failed')
-            self.failed_domain_name = "Error"
-        table_data.append(table_row)
-            # display the table
-        log.info(tabulate(table_data,
-                            headers=['Device', 'Intent Domain Name', 'Configured Domain Name', 'Passed/Failed'],
-                            tablefmt='orgtbl'))
-        # should we pass or fail?
-        if self.failed_domain_name:
-            self.failed('Device Has An Incorrect Domain Name')
-        else:
-            self.passed('Device Has The Correct Domain Name')
-
-    @aetest.test
-    def update_domain_name(self):
-        if self.failed_domain_name:
-            self.pre_change_parsed_json = self.parsed_json
-            self.device.configure(f"ip domain name { self.device.custom.domain_name }")
-        else:
-            self.skipped('No domain name mismatches skipping test')
-
-    @aetest.test
-    def get_post_test_yang_data(self):
-        if self.failed_domain_name:
-            post_parsed_native = self.device.learn("config")
-            self.post_parsed_json=post_parsed_native
-        else:
-            self.skipped('No domain name mismatches skipping test')
-
-    @aetest.test
-    def create_post_test_files(self):
-        # Create .JSON file
-        if self.failed_domain_name:
-            with open(f'JSON/{self.device.alias}_Cisco_IOS_XE_Learned_Config_POST_TEST.json', 'w') as f:
-                f.write(json.dumps(self.post_parsed_json, indent=4, sort_keys=True))
-        else:
-            self.skipped('No domain name mismatches skipping test')
-
-    @aetest.test
-    def pre_post_diff(self):
-        if self.failed_domain_name:       
-            pre_change = self.pre_change_parsed_json
-            post_change = self.post_parsed_json
-            diff = Diff(pre_change, post_change)
-            diff.findDiff()
-            log.info(diff)
-        else:
-            self.skipped('No domain name mismatches skipping test')
-
-    @aetest.test
-    def retest(self):
-        if self.failed_domain_name:
-            self.get_parsed_config()
-            self.test_ip_domain_name()
-        else:
-            self.skipped('No domain name mismatches skipping test')
+        # Test for the domain name against intent
+        report_rule(self, self.rule_results['domain_name'])
 
     @aetest.test
     def get_parsed_interfaces(self):
-        self.parsed_interface = self.device.learn("interface")
+        # Learned once per device and shared with Test_Interfaces
+        self.parsed_interface = snapshots.get(self.device, 'interface', learn_interface)
+        self.configured_interfaces = interface_name_index(self.parsed_interface)
 
     @aetest.test
     def test_configured_interfaces_in_intent(self):
-        # Test for input discards
+        # Test for configured interfaces missing from the intent
         self.failed_intent_interfaces={}
         table_data = []
-        for actual_interface in self.parsed_interface.info:
+        extra_interfaces = self.configured_interfaces.keys() - self.intended_interfaces.keys()
+        for canonical_name, configured_interface in self.configured_interfaces.items():
             table_row = []
-            configured_interface = f"{ actual_interface }"
-            if configured_interface in self.device.interfaces:
-                table_row.append(self.device.alias)
-                table_row.append(configured_interface)
-                table_row.append('Passed')
-            else:
-                table_row.append(self.device.alias)            
-                table_row.append(configured_interface)          
+            table_row.append(self.device.alias)
+            table_row.append(configured_interface)
+            if canonical_name in extra_interfaces:
                 table_row.append('Failed')
                 self.failed_intent_interfaces = configured_interface
-            table_data.append(table_row)                
+            else:
+                table_row.append('Passed')
+            table_data.append(table_row)
             # display the table
         
         log.info(tabulate(table_data,
@@ -164,26 +223,22 @@ class Test_Cisco_IOS_XE_Intent(aetest.Testcase):
 
     @aetest.test
     def test_intended_interfaces_in_config(self):
-        # Test for input discards
+        # Test for intended interfaces missing from the configuration
         self.failed_intent_interfaces={}
         table_data = []
-        configured_interface_list = []
-        for actual_interface in self.parsed_interface.info:
-            configured_interface_list.append(f"{ actual_interface }")
+        missing_interfaces = self.intended_interfaces.keys() - self.configured_interfaces.keys()
         self.missing_interfaces = []
-        for intended_interface in self.device.interfaces:
+        for canonical_name, intended_interface in self.intended_interfaces.items():
             table_row = []
-            if intended_interface in configured_interface_list:
-                table_row.append(self.device.alias)
-                table_row.append(intended_interface)
-                table_row.append('Passed')
-            else:
-                table_row.append(self.device.alias)            
-                table_row.append(intended_interface)          
+            table_row.append(self.device.alias)
+            table_row.append(intended_interface)
+            if canonical_name in missing_interfaces:
                 table_row.append('Failed')
                 self.failed_intent_interfaces = intended_interface
-                self.missing_interfaces.append(intended_interface)
-            table_data.append(table_row)                
+                self.missing_interfaces.append(canonical_name)
+            else:
+                table_row.append('Passed')
+            table_data.append(table_row)
             # display the table
         
         log.info(tabulate(table_data,
@@ -196,49 +251,84 @@ class Test_Cisco_IOS_XE_Intent(aetest.Testcase):
             self.passed('Device Has All Intended Interfaces in Intent YAML Model Configured')
 
     @aetest.test
-    def update_configured_interfaces_from_intent(self):
-        if self.failed_intent_interfaces:
-            self.pre_change_parsed_json = self.parsed_interface.info
-            for interface in self.missing_interfaces:
-                self.device.configure(f"interface { interface }")
+    def update_config_from_intent(self):
+        # Push every change the tests found in one configure session
+        config_lines = []
+        for name, result in self.failed_rules.items():
+            config_lines.append(result.rule.remediation.format(intent=result.intended))
+        for interface in self.missing_interfaces:
+            config_lines.append(f"interface { interface }")
+        if config_lines:
+            self.pre_change_parsed_json = self.parsed_json
+            self.pre_change_parsed_interface = self.parsed_interface
+            configure(self.device, config_lines)
+            log.info(f"Configured { len(config_lines) } lines from intent in one session")
         else:
-            self.skipped('Device Has All Intended Interfaces in Intent YAML Model Configured')
+            self.skipped('No intent mismatches skipping test')
 
     @aetest.test
     def get_post_test_data(self):
-        if self.failed_intent_interfaces:
-            self.post_parsed_json = self.device.learn("interface")
+        if self.failed_rules or self.missing_interfaces:
+            # Learned again after the change and kept for the retests, never
+            # from the stored snapshot so the change is checked on the device
+            if self.failed_rules:
+                self.post_parsed_json = snapshots.get(self.device, 'config', collect_config)
+            if self.missing_interfaces:
+                self.post_parsed_interface = snapshots.get(self.device, 'interface', learn_interface)
         else:
-            self.skipped('Device Has All Intended Interfaces in Intent YAML Model Configured')
+            self.skipped('No intent mismatches skipping test')
 
     @aetest.test
     def create_post_test_files(self):
         # Create .JSON file
-        if self.failed_intent_interfaces:
-            with open(f'JSON/{self.device.alias}_Cisco_IOS_XE_Learned_Config_POST_TEST.json', 'w') as f:
-                f.write(json.dumps(self.post_parsed_json.info, indent=4, sort_keys=True))
+        if self.failed_rules or self.missing_interfaces:
+            if self.failed_rules:
+                write_snapshot(self.device, 'Cisco_IOS_XE_Learned_Config', 'POST_TEST', self.post_parsed_json)
+            if self.missing_interfaces:
+                write_snapshot(self.device, 'Cisco_IOS_XE_Learned_Interface', 'POST_TEST', self.post_parsed_interface)
         else:
-            self.skipped('Device Has All Intended Interfaces in Intent YAML Model Configured')
+            self.skipped('No intent mismatches skipping test')
 
     @aetest.test
     def pre_post_diff(self):
-        if self.failed_intent_interfaces:           
-            pre_change = self.pre_change_parsed_json
-            post_change = self.post_parsed_json.info
-            diff = Diff(pre_change, post_change)
-            diff.findDiff()
-            log.info(diff)
+        if self.failed_rules or self.missing_interfaces:
+            if self.failed_rules:
+                with timings.timed(self.device, 'diff', 'config'):
+                    log.info(format_changes(diff(self.pre_change_parsed_json, self.post_parsed_json)))
+            if self.missing_interfaces:
+                with timings.timed(self.device, 'diff', 'interface'):
+                    log.info(format_changes(diff(self.pre_change_parsed_interface, self.post_parsed_interface)))
         else:
-            self.skipped('Device Has All Intended Interfaces in Intent YAML Model Configured')
+            self.skipped('No intent mismatches skipping test')
 
     @aetest.test
-    def retest(self):
-        if self.failed_intent_interfaces:
+    def retest_ip_domain_name(self):
+        if 'domain_name' in self.failed_rules:
+            self.get_parsed_config()
+            self.test_ip_domain_name()
+        else:
+            self.skipped('No domain name mismatches skipping test')
+
+    @aetest.test
+    def retest_intended_interfaces_in_config(self):
+        if self.missing_interfaces:
             self.get_parsed_interfaces()
             self.test_intended_interfaces_in_config()
         else:
             self.skipped('Device Has All Intended Interfaces in Intent YAML Model Configured')
 
+    @aetest.cleanup
+    def cleanup(self, testbed, device_name):
+        # Write the profile of this iteration when the job asked for one
+        stop_profile(self)
+        # Let go of the learned config, and of the interfaces unless they are kept
+        # for Test_Interfaces, which learns them again for the devices over the limit
+        keys = ['config']
+        limit = shared_interface_devices(testbed)
+        if limit is not None and snapshots.held('interface') > limit:
+            keys.append('interface')
+        snapshots.evict(testbed.devices[device_name], keys)
+
 # ----------------
 # Test Case #2
 # ----------------
@@ -250,118 +340,56 @@ class Test_Interfaces(aetest.Testcase):
         """ Testcase Setup section """
         # connect to device
         self.device = testbed.devices[device_name]
+        set_testcase(type(self).__name__)
+        start_profile(self, self.device)
         # Loop over devices in tested for testing
     
     @aetest.test
     def get_pre_test_interface_data(self):
-        self.parsed_interfaces = self.device.learn("interface")
+        # The interfaces Test_Cisco_IOS_XE_Intent learned, unless the device changed since
+        self.parsed_interfaces = snapshots.get(self.device, 'interface', learn_interface)
 
     @aetest.test
     def create_pre_test_files(self):
         # Create .JSON file
-        with open(f'JSON/{self.device.alias}_pyATS_Learn_Interface_PRE_TEST.json', 'w') as f:
-            f.write(json.dumps(self.parsed_interfaces.info, indent=4, sort_keys=True))
+        write_snapshot(self.device, 'pyATS_Learn_Interface', 'PRE_TEST', self.parsed_interfaces)
     
     @aetest.test
-    def test_interface_input_errors(self):
-        # Test for input discards
-        in_errors_threshold = 0
-        self.failed_interfaces = {}
-        table_data = []
-        for intf,value in self.parsed_interfaces.info.items():
-            if 'counters' in value:
-                counter = value['counters']['in_errors']
-                table_row = []
-                table_row.append(self.device.alias)
-                table_row.append(intf)
-                table_row.append(counter)
-                if int(counter) > in_errors_threshold:
-                    table_row.append('Failed')
-                    self.failed_interfaces[intf] = int(counter)
-                    self.interface_name = intf
-                    self.error_counter = self.failed_interfaces[intf]
-                else:
-                    table_row.append('Passed')
-                table_data.append(table_row)
-        
-        # display the table
-        log.info(tabulate(table_data,
-            headers=['Device', 'Interface',
-                    'Input Errors Counter',
-                    'Passed/Failed'],
-                    tablefmt='orgtbl'))
+    def evaluate_interface_counters(self):
+        # Evaluate every counter rule in one pass over the learned interfaces
+        interfaces = ((intf, value['counters']) for intf, value in self.parsed_interfaces.items() if 'counters' in value)
+        with timings.timed(self.device, 'evaluate', 'counters'):
+            if counter_mode(self.device) == 'delta':
+                # Rates since the counters stored by the previous run
+                store = CounterStore(self.device.testbed.custom.get('counter_store') or DEFAULT_COUNTER_STORE)
+                self.counter_results = evaluate_counter_deltas(
+                    self.device,
+                    interfaces,
+                    LEARNED_COUNTER_RULES,
+                    counter_rate_thresholds(self.device, LEARNED_COUNTER_RULES),
+                    store)
+            else:
+                self.counter_results = evaluate_counters(
+                    self.device,
+                    interfaces,
+                    LEARNED_COUNTER_RULES,
+                    counter_thresholds(self.device, LEARNED_COUNTER_RULES),
+                    matrix=fleet_counters)
 
-        # should we pass or fail?
-        if self.failed_interfaces:
-            self.failed('Some interfaces have input errors')
-        else:
-            self.passed('No interfaces have input errors')
+    @aetest.test
+    def test_interface_input_errors(self):
+        # Test for input errors
+        report_counter(self, self.counter_results['in_errors'])
 
     @aetest.test
     def test_interface_input_crc_errors(self):
-        # Test for input crc discards
-        in_errors_threshold = 0
-        self.failed_interfaces = {}
-        table_data = []
-        for intf,value in self.parsed_interfaces.info.items():
-            if 'counters' in value:
-                counter = value['counters']['in_crc_errors']
-                table_row = []
-                table_row.append(self.device.alias)
-                table_row.append(intf)
-                table_row.append(counter)
-                if int(counter) > in_errors_threshold:
-                    table_row.append('Failed')
-                    self.failed_interfaces[intf] = int(counter)
-                    self.interface_name = intf
-                    self.error_counter = self.failed_interfaces[intf]
-                else:
-                    table_row.append('Passed')
-                table_data.append(table_row)
-            # display the table
-        log.info(tabulate(table_data,
-                            headers=['Device', 'Interface',
-                                    'Input CRC Errors Counter',
-                                    'Passed/Failed'],
-                            tablefmt='orgtbl'))
-        # should we pass or fail?
-        if self.failed_interfaces:
-            self.failed('Some interfaces have input CRC errors')
-        else:
-            self.passed('No interfaces have input CRC errors')
+        # Test for input crc errors
+        report_counter(self, self.counter_results['in_crc_errors'])
 
     @aetest.test
     def test_interface_output_errors(self):
-        # Test for input crc discards
-        in_errors_threshold = 0
-        self.failed_interfaces = {}
-        table_data = []
-        for intf,value in self.parsed_interfaces.info.items():
-            if 'counters' in value:
-                counter = value['counters']['out_errors']
-                table_row = []
-                table_row.append(self.device.alias)
-                table_row.append(intf)
-                table_row.append(counter)
-                if int(counter) > in_errors_threshold:
-                    table_row.append('Failed')
-                    self.failed_interfaces[intf] = int(counter)
-                    self.interface_name = intf
-                    self.error_counter = self.failed_interfaces[intf]
-                else:
-                    table_row.append('Passed')
-                table_data.append(table_row)
-            # display the table
-        log.info(tabulate(table_data,
-                            headers=['Device', 'Interface',
-                                    'Output Errors Counter',
-                                    'Passed/Failed'],
-                            tablefmt='orgtbl'))
-        # should we pass or fail?
-        if self.failed_interfaces:
-            self.failed('Some interfaces have input CRC errors')
-        else:
-            self.passed('No interfaces have input CRC errors')
+        # Test for output errors
+        report_counter(self, self.counter_results['out_errors'])
 
     @aetest.test
     def test_interface_full_duplex(self):
@@ -369,7 +397,7 @@ class Test_Interfaces(aetest.Testcase):
         duplex_threshold = "FULL"
         self.failed_interfaces = {}
         table_data = []
-        for intf,value in self.parsed_interfaces.info.items():
+        for intf,value in self.parsed_interfaces.items():
             if 'duplex_mode' in value:
                 counter = value['duplex_mode']
                 table_row = []
@@ -402,7 +430,7 @@ class Test_Interfaces(aetest.Testcase):
         duplex_threshold = "up"
         self.failed_interfaces = {}
         table_data = []
-        for intf,value in self.parsed_interfaces.info.items():
+        for intf,value in self.parsed_interfaces.items():
             if 'oper_status' in value:
                 counter = value['oper_status']
                 table_row = []
@@ -433,43 +461,28 @@ class Test_Interfaces(aetest.Testcase):
     def test_interface_description_matches_intent(self):
         # Test for input discards
         self.failed_interfaces = {}
+        self.pending_descriptions = {}
         table_data = []
-        for self.intf,value in self.parsed_interfaces.info.items():
-            if 'description' in value:
-                for interface,intent_value in self.device.custom.interfaces.items():
-                    if self.intf == interface:
-                        self.intended_desc = intent_value['description']
-                        actual_desc = value['description']
-                        table_row = []
-                        table_row.append(intent_value['description'])
-                        table_row.append(self.intf)
-                        table_row.append(self.intended_desc)
-                        table_row.append(actual_desc)
-                        if actual_desc != self.intended_desc:
-                            table_row.append('Failed')
-                            self.failed_interfaces[self.intf] = self.intended_desc
-                            self.interface_name = self.intf
-                            self.error_counter = self.failed_interfaces[self.intf]
-                        else:
-                            table_row.append('Passed')
-                        table_data.append(table_row)
+        for self.intf, value, intent_value in match_interfaces(self.parsed_interfaces, canonical_mapping(self.device.custom.interfaces)):
+            self.intended_desc = intended_description(intent_value)
+            if self.intended_desc is None:
+                continue
+            actual_desc = value.get('description', "")
+            table_row = []
+            table_row.append(self.device.alias)
+            table_row.append(self.intf)
+            table_row.append(self.intended_desc)
+            table_row.append(actual_desc)
+            if actual_desc != self.intended_desc:
+                table_row.append('Failed')
+                self.failed_interfaces[self.intf] = self.intended_desc
+                self.interface_name = self.intf
+                self.error_counter = self.failed_interfaces[self.intf]
+                if 'description' not in value:
+                    self.pending_descriptions[self.intf] = self.intended_desc
             else:
-                for interface,intent_value in self.device.custom.interfaces.items():
-                    if self.intf == interface:
-                        self.intended_desc = intent_value['description']
-                        actual_desc = ""
-                        table_row = []
-                        table_row.append(intent_value['description'])
-                        table_row.append(self.intf)
-                        table_row.append(self.intended_desc)
-                        table_row.append(actual_desc)
-                        if actual_desc != self.intended_desc:
-                            table_row.append('Failed')
-                            self.failed_interfaces[self.intf] = self.intended_desc
-                            self.interface_name = self.intf
-                            self.error_counter = self.failed_interfaces[self.intf]
-                            self.update_interface_description()
-                        table_data.append(table_row)                            
+                table_row.append('Passed')
+            table_data.append(table_row)
         # display the table
         log.info(tabulate(table_data,
                             headers=['Device', 'Interface',
@@ -484,19 +497,24 @@ class Test_Interfaces(aetest.Testcase):
         else:
             self.passed('All interfaces intent / actual descriptions match')
 
-    def update_interface_description(self):
-        if self.failed_interfaces:
-            self.device.configure(f'''interface { self.intf }
-                                      description { self.intended_desc } 
-                                    ''')
+    @aetest.test
+    def update_interface_descriptions(self):
+        # Push every missing description in one configure session
+        if self.pending_descriptions:
+            config_lines = []
+            for interface, description in self.pending_descriptions.items():
+                config_lines.append(f"interface { interface }")
+                config_lines.append(f" description { description }")
+            configure(self.device, config_lines)
+            log.info(f"Configured { len(self.pending_descriptions) } interface descriptions in one session")
         else:
-            self.skipped('No description mismatches skipping test')
+            self.skipped('No missing descriptions skipping test')
 
     @aetest.test
     def get_post_test_interface_data(self):
         if self.failed_interfaces:
             self.pre_change_parsed_json = self.parsed_interfaces
-            self.post_parsed_interfaces = self.device.learn("interface")
+            self.post_parsed_interfaces = snapshots.get(self.device, 'interface', learn_interface)
         else:
             self.pre_change_parsed_json = self.parsed_interfaces
             self.skipped('No description mismatches skipping test')
@@ -505,20 +523,18 @@ class Test_Interfaces(aetest.Testcase):
     def create_post_test_files(self):
         # Create .JSON file
         if self.failed_interfaces:
-            with open(f'JSON/{self.device.alias}_Learn_Interfaces_POST_TEST.json', 'w') as f:
-                f.write(json.dumps(self.post_parsed_interfaces.info, indent=4, sort_keys=True))
+            write_snapshot(self.device, 'Learn_Interfaces', 'POST_TEST', self.post_parsed_interfaces)
         else:
             self.skipped('No description mismatches skipping test')
 
     @aetest.test
     def pre_post_diff(self):
         if self.failed_interfaces:
-            for intf,pre_value in self.pre_change_parsed_json.info.items():
-                    for interface,post_value in self.post_parsed_interfaces.info.items():
-                        if intf == interface:
-                            diff = Diff(pre_value, post_value)
-                            diff.findDiff()
-                            log.info(diff)
+            # One diff of every interface in both snapshots
+            pre_interfaces, post_interfaces = {}, {}
+            for intf, pre_value, post_value in match_interfaces(self.pre_change_parsed_json, self.post_parsed_interfaces):
+                pre_interfaces[intf], post_interfaces[intf] = pre_value, post_value
+            log.info(format_changes(diff(pre_interfaces, post_interfaces)))
         else:
             self.skipped('No description mismatches skipping test')
 
@@ -530,9 +546,22 @@ class Test_Interfaces(aetest.Testcase):
         else:
             self.skipped('No description mismatches skipping test')
 
+    @aetest.cleanup
+    def cleanup(self, testbed, device_name):
+        # Write the profile of this iteration when the job asked for one
+        stop_profile(self)
+        # Let go of the learned interfaces of this device
+        snapshots.evict(testbed.devices[device_name], ['interface'])
+
 class CommonCleanup(aetest.CommonCleanup):
     @aetest.subsection
     def disconnect_from_devices(self, testbed):
+        stop_pipelines()
+        set_testcase('common_cleanup')
+        export_timings(testbed)
+        log.info(f"pyATS learn { snapshots.summary() }")
+        if fleet_counters is not None:
+            log_fleet_counters(fleet_counters)
         testbed.disconnect()
 
 # for running as its own executable
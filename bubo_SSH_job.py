@@ -1,7 +1,16 @@
+import argparse
 import os
 from genie.testbed import load
 
+# ----------------
+# Job arguments
+# ----------------
+parser = argparse.ArgumentParser()
+parser.add_argument('--profile', nargs='*', metavar='TESTCASE',
+                    help='profile every testcase iteration, or only the named testcases, with cProfile and tracemalloc')
+
 def main(runtime):
+    args, unknown = parser.parse_known_args()
 
     # ----------------
     # Load the testbed
@@ -19,4 +28,4 @@ def main(runtime):
     testscript = os.path.join(os.path.dirname(__file__), 'bubo_SSH.py')
 
     # run script
-    runtime.tasks.run(testscript=testscript, testbed=testbed)
\ No newline at end of file
+    runtime.tasks.run(testscript=testscript, testbed=testbed, profile=args.profile)
\ No newline at end of file
@@ -0,0 +1,226 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from requests.exceptions import ConnectionError as RequestConnectionError, HTTPError, Timeout
+from pyats.connections import BaseConnection
+from pyats.utils.secret_strings import to_plaintext
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# ----------------
+# Get logger for script
+# ----------------
+
+log = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_CONCURRENCY = 64
+DEFAULT_TIMEOUT = 30
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# ----------------
+# One event loop for every device
+# ----------------
+_loop = None
+_loop_pid = None
+_semaphore = None
+_loop_lock = threading.Lock()
+
+def _event_loop(concurrency=DEFAULT_CONCURRENCY):
+    """Start the background event loop of this process, again after a fork"""
+    global _loop, _loop_pid, _semaphore
+    with _loop_lock:
+        if _loop is None or _loop_pid != os.getpid():
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='bubo-async-rest', daemon=True).start()
+            _loop_pid = os.getpid()
+            _semaphore = asyncio.Semaphore(concurrency)
+        return _loop
+
+class RestResponse(object):
+    """The parts of a requests.Response the testcases use"""
+
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def ok(self):
+        return 200 <= self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode(errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+# ----------------
+# RESTCONF connection
+# ----------------
+class AsyncRest(BaseConnection):
+    """RESTCONF over aiohttp with the get/put/patch calls of rest.connector.Rest.
+
+    Select it with class: bubo_async_rest.AsyncRest on the rest connection
+    of a device in the testbed YAML.  Every device keeps a pool of
+    keep-alive HTTPS sessions (pool_size on the connection), requests of
+    all devices share one event loop and at most rest_concurrency of them
+    are in flight (testbed custom:), and each request times out after
+    timeout seconds.  get_many() sends several GETs at once and stream()
+    hands a body over chunk by chunk as it arrives.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._session = None
+        self._session_pid = None
+        self.base_url = None
+
+    @property
+    def connected(self):
+        return self._session is not None
+
+    def connect(self, timeout=None, pool_size=None):
+        if aiohttp is None:
+            raise ImportError('bubo_async_rest.AsyncRest needs aiohttp, pip install aiohttp')
+        host = self.connection_info.get('host') or self.connection_info['ip']
+        host = getattr(host, 'exploded', f"{ host }")
+        if ':' in host:
+            host = f"[{ host }]"
+        protocol = self.connection_info.get('protocol', 'https')
+        self.base_url = f"{ protocol }://{ host }:{ self.connection_info.get('port', 443) }"
+        credentials = self.connection_info.get('credentials', {}).get('rest', {})
+        self.auth = (credentials.get('username', ''), to_plaintext(credentials.get('password', '')))
+        self.timeout = timeout or self.connection_info.get('timeout', DEFAULT_TIMEOUT)
+        self.pool_size = pool_size or self.connection_info.get('pool_size', DEFAULT_POOL_SIZE)
+        self._open()
+        response = self.get('/restconf/data/ietf-restconf-monitoring:restconf-state/capabilities',
+                            expected_status_code=None)
+        if response.status_code in (401, 403):
+            self.disconnect()
+            raise ConnectionError(f"{ self.device.name } rejected the RESTCONF credentials")
+        log.info(f"Connected to { self.device.name } RESTCONF at { self.base_url }")
+
+    def _open(self):
+        loop = _event_loop(self.device.testbed.custom.get('rest_concurrency') or DEFAULT_CONCURRENCY)
+
+        async def _session():
+            return aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, ssl=False, keepalive_timeout=60),
+                auth=aiohttp.BasicAuth(*self.auth),
+                headers={'Accept': 'application/yang-data+json',
+                         'Content-Type': 'application/yang-data+json'})
+
+        self._session = asyncio.run_coroutine_threadsafe(_session(), loop).result()
+        self._session_pid = os.getpid()
+
+    def disconnect(self):
+        if self._session is not None and self._session_pid == os.getpid():
+            asyncio.run_coroutine_threadsafe(self._session.close(), _event_loop()).result()
+        self._session = None
+
+    def _run(self, coroutine):
+        # A forked worker inherits the session but not the loop thread
+        if self._session_pid != os.getpid():
+            self._open()
+        return asyncio.run_coroutine_threadsafe(coroutine, _event_loop()).result()
+
+    async def _request(self, method, api_url, payload=None, expected_status_code=None, timeout=None):
+        timeout = timeout or self.timeout
+        try:
+            async with _semaphore:
+                async with self._session.request(method, f"{ self.base_url }{ api_url }", data=payload,
+                                                 timeout=aiohttp.ClientTimeout(total=timeout)) as r:
+                    response = RestResponse(api_url, r.status, r.headers, await r.read())
+        except asyncio.TimeoutError:
+            raise Timeout(f"{ method } { api_url } timed out after { timeout } seconds")
+        except aiohttp.ClientError as e:
+            raise RequestConnectionError(f"{ method } { api_url } failed: { e }")
+        log.debug(f"{ method } { api_url } { response.status_code }")
+        if expected_status_code and response.status_code != expected_status_code:
+            # The same exception rest.connector raises for an unexpected status
+            raise HTTPError(f"{ method } { api_url } returned { response.status_code }, "
+                            f"expected { expected_status_code }", response=response)
+        return response
+
+    def get(self, api_url, expected_status_code=200, timeout=None, **kwargs):
+        return self._run(self._request('GET', api_url, None, expected_status_code, timeout))
+
+    def put(self, api_url, payload=None, expected_status_code=None, timeout=None, **kwargs):
+        return self._run(self._request('PUT', api_url, payload, expected_status_code, timeout))
+
+    def patch(self, api_url, payload=None, expected_status_code=None, timeout=None, **kwargs):
+        return self._run(self._request('PATCH', api_url, payload, expected_status_code, timeout))
+
+    def get_many(self, api_urls, expected_status_code=200, timeout=None):
+        """GET every url at once, returning a response or the exception raised per url"""
+        async def _gather():
+            return await asyncio.gather(*[self._request('GET', api_url, None, expected_status_code, timeout)
+                                          for api_url in api_urls], return_exceptions=True)
+        return self._run(_gather())
+
+    @contextmanager
+    def stream(self, api_url, chunk_size=STREAM_CHUNK_SIZE, timeout=None):
+        """GET api_url and yield an iterator over its body in chunks as they arrive"""
+        timeout = timeout or self.timeout
+
+        async def _get():
+            await _semaphore.acquire()
+            try:
+                # No total timeout, a large body may take longer to arrive than one read
+                return await self._session.get(f"{ self.base_url }{ api_url }",
+                                               timeout=aiohttp.ClientTimeout(total=None, sock_connect=timeout,
+                                                                             sock_read=timeout))
+            except BaseException:
+                _semaphore.release()
+                raise
+
+        async def _read(response):
+            # Fill a whole chunk per trip to the event loop, reads return what has arrived so far
+            chunk = bytearray()
+            while len(chunk) < chunk_size:
+                data = await response.content.read(chunk_size - len(chunk))
+                if not data:
+                    break
+                chunk += data
+            return bytes(chunk)
+
+        async def _release(response):
+            response.release()
+            _semaphore.release()
+
+        def _chunks(response):
+            while True:
+                try:
+                    chunk = self._run(_read(response))
+                except asyncio.TimeoutError:
+                    raise Timeout(f"GET { api_url } stalled for { timeout } seconds")
+                except aiohttp.ClientError as e:
+                    raise RequestConnectionError(f"GET { api_url } failed: { e }")
+                if not chunk:
+                    return
+                yield chunk
+
+        try:
+            response = self._run(_get())
+        except asyncio.TimeoutError:
+            raise Timeout(f"GET { api_url } timed out after { timeout } seconds")
+        except aiohttp.ClientError as e:
+            raise RequestConnectionError(f"GET { api_url } failed: { e }")
+        try:
+            log.debug(f"GET { api_url } { response.status } streamed")
+            if response.status != 200:
+                raise HTTPError(f"GET { api_url } returned { response.status }, expected 200",
+                                response=RestResponse(api_url, response.status, response.headers,
+                                                      self._run(response.read())))
+            yield _chunks(response)
+        finally:
+            self._run(_release(response))
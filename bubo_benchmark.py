@@ -0,0 +1,306 @@
+import argparse
+import copy
+import json
+import multiprocessing
+import os
+import re
+import resource
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from tabulate import tabulate
+from bubo_diff import diff
+from bubo_counters import evaluate_counters, counter_thresholds, OPENCONFIG_COUNTER_RULES
+from bubo_interfaces import canonical_mapping, index_by_name, intended_description, interface_name_index, match_interfaces, native_interface_names
+from bubo_restconf import fetch_native, fetch_interfaces, YangPatch
+from bubo_restconf import NATIVE_URL, NATIVE_ROOT, OPENCONFIG_INTERFACES_URL, OPENCONFIG_INTERFACES_ROOT
+from bubo_rules import NATIVE_RULES
+from bubo_simulator import Simulator, add_fleet_arguments, simulated_devices, write_testbed, STATS_PATH
+from bubo_snapshot import write_snapshot
+
+# ----------------
+# Synthetic interface data
+# ----------------
+def make_interfaces(count):
+    """An OpenConfig interface list and a matching intent with every tenth description drifted"""
+    actual = []
+    intended = {}
+    for number in range(count):
+        name = f"GigabitEthernet0/0/0.{ number }"
+        actual.append({'name': name, 'config': {'name': name, 'description': f"Subinterface { number }"}})
+        description = f"Subinterface { number }" if number % 10 else "Drifted"
+        intended[name] = {'type': 'ethernet', 'description': description}
+    return actual, intended
+
+def nested_description_check(actual, intended):
+    # The intent/actual scan the description checks used before the index
+    mismatches = 0
+    for intf in actual:
+        for interface, value in intended.items():
+            if intf['name'] == interface and intf['config']['description'] != value['description']:
+                mismatches += 1
+    return mismatches
+
+def indexed_description_check(actual, intended):
+    mismatches = 0
+    for name, intf, value in match_interfaces(index_by_name(actual), intended):
+        if intf['config']['description'] != value['description']:
+            mismatches += 1
+    return mismatches
+
+def make_native(count):
+    """A Cisco-IOS-XE-native document with count addressed GigabitEthernet interfaces"""
+    interfaces = []
+    for number in range(count):
+        interfaces.append({'name': f"0/0/0.{ number }", 'description': f"Subinterface { number }",
+                           'ip': {'address': {'primary': {'address': f"10.{ number // 65536 }.{ number // 256 % 256 }.{ number % 256 }",
+                                                          'mask': '255.255.255.0'}}}})
+    return {'Cisco-IOS-XE-native:native': {'interface': {'GigabitEthernet': interfaces},
+                                           'ip': {'domain': {'name': 'lab.devnetsandbox.local'}}}}
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+# ----------------
+# Benchmarks
+# ----------------
+def benchmark_interfaces(args):
+    """Time the description check against the number of interfaces"""
+    table_data = []
+    for count in args.sizes:
+        actual, intended = make_interfaces(count)
+        indexed, indexed_time = timed(indexed_description_check, actual, intended)
+        if count <= args.nested_limit:
+            nested, nested_time = timed(nested_description_check, actual, intended)
+            assert nested == indexed
+            nested_column = f"{ nested_time * 1000:.1f}"
+        else:
+            nested_column = 'skipped'
+        table_data.append([count, f"{ indexed_time * 1000:.2f}",
+                           f"{ indexed_time / count * 1e6:.2f}", nested_column])
+    print(tabulate(table_data,
+                    headers=['Interfaces', 'Indexed (ms)', 'Indexed per Interface (us)', 'Nested (ms)'],
+                    tablefmt='orgtbl'))
+
+def benchmark_diff(args):
+    """Time the pre/post diff of a native document with one changed description"""
+    table_data = []
+    for count in args.sizes:
+        pre = make_native(count)
+        post = copy.deepcopy(pre)
+        post['Cisco-IOS-XE-native:native']['interface']['GigabitEthernet'][count // 2]['description'] = 'Drifted'
+        changes, diff_time = timed(diff, pre, post)
+        assert len(changes) == 1
+        table_data.append([count, f"{ len(json.dumps(pre)) / 1e6:.1f}", f"{ diff_time * 1000:.1f}"])
+    print(tabulate(table_data,
+                    headers=['Interfaces', 'Document (MB)', 'Diff (ms)'],
+                    tablefmt='orgtbl'))
+
+# ----------------
+# Fleet stages against the simulator
+# ----------------
+# The work each testcase does for one device, without the aetest reporting
+def connect(device, state):
+    device.connect(alias='rest', via='rest')
+
+def native_fetch(device, state):
+    state['native'] = fetch_native(device)
+
+def native_evaluate(device, state):
+    native = state['native']
+    state['rule_results'] = NATIVE_RULES.evaluate(device.alias, device.custom, native)
+    configured = interface_name_index(native_interface_names(native))
+    intended = interface_name_index(device.interfaces)
+    state['missing_interfaces'] = sorted(intended.keys() - configured.keys())
+
+def native_snapshot(device, state):
+    write_snapshot(device, 'Cisco_IOS_XE_Native', 'PRE_TEST', state['native'])
+
+def native_remediate(device, state):
+    patch = YangPatch(NATIVE_URL, NATIVE_ROOT)
+    for result in state['rule_results'].values():
+        if result is not None and not result.passed:
+            patch.add(result.rule.column, result.rule.remediation, result.expected)
+    for interface in state['missing_interfaces']:
+        interface_type = re.search(r"[a-zA-Z\-]*", f"{ interface }").group()
+        patch.add(f"interface { interface }", ('interface', interface_type),
+                  {"name": f"{ interface[len(interface_type):] }"}, list_entry=True)
+    patch.send(device, chunk_size=device.testbed.custom.get('remediation_chunk_size'))
+
+def native_verify(device, state):
+    post = fetch_native(device)
+    diff(state.pop('native'), post)
+
+def interfaces_fetch(device, state):
+    state['openconfig'] = fetch_interfaces(device)
+
+def interfaces_evaluate(device, state):
+    entries = state['openconfig'][OPENCONFIG_INTERFACES_ROOT]['interface']
+    evaluate_counters(device,
+                      ((intf['name'], intf['state']['counters']) for intf in entries),
+                      OPENCONFIG_COUNTER_RULES,
+                      counter_thresholds(device, OPENCONFIG_COUNTER_RULES))
+    state['interfaces'] = index_by_name(entries)
+    state['pending_descriptions'] = {}
+    for name, intf, intent_value in match_interfaces(state['interfaces'], canonical_mapping(device.interfaces)):
+        description = intended_description(intent_value)
+        if description is not None and 'description' not in intf['config']:
+            state['pending_descriptions'][name] = description
+
+def interfaces_snapshot(device, state):
+    write_snapshot(device, 'OpenConfig_Interfaces', 'PRE_TEST', state['openconfig'])
+
+def interfaces_remediate(device, state):
+    patch = YangPatch(OPENCONFIG_INTERFACES_URL, OPENCONFIG_INTERFACES_ROOT)
+    for name, description in state['pending_descriptions'].items():
+        patch.add(f"interface { name } description", ('interface',),
+                  {"name": name, "config": {"name": name, "description": f"{ description }"}},
+                  list_entry=True)
+    patch.send(device, chunk_size=device.testbed.custom.get('remediation_chunk_size'))
+
+def interfaces_verify(device, state):
+    post = index_by_name(fetch_interfaces(device)[OPENCONFIG_INTERFACES_ROOT]['interface'])
+    pre_config, post_config = {}, {}
+    for name, pre_intf, post_intf in match_interfaces(state.pop('interfaces'), post):
+        pre_config[name], post_config[name] = pre_intf['config'], post_intf['config']
+    diff(pre_config, post_config)
+    state.pop('openconfig')
+
+FLEET_STAGES = [
+    ('common_setup', 'connect', connect),
+    ('Test_Cisco_IOS_XE_Native', 'fetch', native_fetch),
+    ('Test_Cisco_IOS_XE_Native', 'evaluate', native_evaluate),
+    ('Test_Cisco_IOS_XE_Native', 'snapshot', native_snapshot),
+    ('Test_Cisco_IOS_XE_Native', 'remediate', native_remediate),
+    ('Test_Cisco_IOS_XE_Native', 'verify', native_verify),
+    ('Test_Interfaces', 'fetch', interfaces_fetch),
+    ('Test_Interfaces', 'evaluate', interfaces_evaluate),
+    ('Test_Interfaces', 'snapshot', interfaces_snapshot),
+    ('Test_Interfaces', 'remediate', interfaces_remediate),
+    ('Test_Interfaces', 'verify', interfaces_verify),
+]
+
+def percentile(values, share):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(len(ordered) * share + 0.5) - 1))]
+
+def reset_peak_rss():
+    """Start a new peak RSS from the current RSS, False where the kernel does not allow it"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    """Peak RSS since the last reset_peak_rss(), or of the whole process without /proc"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run_simulator(count, interfaces, drift, seed, base_port):
+    Simulator(simulated_devices(count, interfaces, drift, seed), base_port=base_port).serve_forever()
+
+def simulator_requests(base_port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{ base_port }{ STATS_PATH }", timeout=30) as response:
+        return json.load(response)['requests']
+
+def run_stage(devices, stage, states, pool_size):
+    """Run a stage for every device on the pool, returning the wall time and the time of each device"""
+    def _run(device):
+        start = time.perf_counter()
+        stage(device, states[device.name])
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='bubo-benchmark') as pool:
+        latencies = list(pool.map(_run, devices))
+    return time.perf_counter() - start, latencies
+
+def benchmark_fleet(args):
+    """Time every testcase stage against a simulated fleet of each size"""
+    from genie.testbed import load
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bubo-fleet-')
+    table_data = []
+    # Only a peak that can be reset says anything about the stage it was taken in
+    stage_peaks = True
+    for count in args.sizes:
+        for interfaces in args.interface_sizes:
+            directory = os.path.join(workdir, f"{ count }x{ interfaces }")
+            devices = simulated_devices(count, interfaces, args.drift, args.seed)
+            intent = write_testbed(devices, directory, base_port=args.base_port,
+                                   connection_class=args.connection_class,
+                                   settings={'snapshot_store': os.path.join(directory, 'store'),
+                                             'snapshot_files': False,
+                                             'openconfig_streaming': args.openconfig_streaming})
+            del devices
+            server = multiprocessing.Process(target=run_simulator, daemon=True,
+                                             args=(count, interfaces, args.drift, args.seed, args.base_port))
+            server.start()
+            try:
+                for attempt in range(600):
+                    try:
+                        simulator_requests(args.base_port)
+                        break
+                    except OSError:
+                        time.sleep(0.1)
+                testbed = load(intent)
+                testbed_devices = list(testbed.devices.values())
+                states = {device.name: {} for device in testbed_devices}
+                for testcase, name, stage in FLEET_STAGES:
+                    requests = simulator_requests(args.base_port)
+                    stage_peaks = reset_peak_rss() and stage_peaks
+                    wall, latencies = run_stage(testbed_devices, stage, states, args.pool_size)
+                    # Less the stats request itself
+                    requests = simulator_requests(args.base_port) - requests - 1
+                    table_data.append([count, interfaces, testcase, name, f"{ wall:.2f}",
+                                       f"{ percentile(latencies, 0.5) * 1000:.1f}",
+                                       f"{ percentile(latencies, 0.99) * 1000:.1f}",
+                                       f"{ requests / wall:.0f}", f"{ peak_rss_mb():.0f}"])
+                testbed.disconnect()
+            finally:
+                server.terminate()
+                server.join()
+    print(tabulate(table_data,
+                    headers=['Devices', 'Interfaces', 'Testcase', 'Stage', 'Wall (s)', 'p50 (ms)', 'p99 (ms)',
+                             'Requests/s', 'Stage Peak RSS (MB)' if stage_peaks else 'Process Peak RSS So Far (MB)'],
+                    tablefmt='orgtbl'))
+
+def main():
+    parser = argparse.ArgumentParser(description='bubo benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    interfaces = subparsers.add_parser('interfaces', help='interface description check scaling')
+    interfaces.add_argument('--sizes', type=int, nargs='+', default=[500, 1000, 2000, 4000, 8000, 16000])
+    interfaces.add_argument('--nested-limit', type=int, default=4000,
+                            help='largest size to also run the old nested scan for')
+    interfaces.set_defaults(func=benchmark_interfaces)
+    diffs = subparsers.add_parser('diff', help='pre/post native diff scaling')
+    diffs.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 40000])
+    diffs.set_defaults(func=benchmark_diff)
+    fleet = subparsers.add_parser('fleet', help='testcase stages against a simulated RESTCONF fleet')
+    add_fleet_arguments(fleet)
+    fleet.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 100],
+                       help='numbers of devices to simulate')
+    fleet.add_argument('--interface-sizes', type=int, nargs='+', default=[10, 1000],
+                       help='numbers of interfaces per device to simulate')
+    fleet.add_argument('--pool-size', type=int, default=8, help='devices worked on at the same time')
+    fleet.add_argument('--connection-class', default='rest.connector.Rest')
+    fleet.add_argument('--openconfig-streaming', action='store_true',
+                       help='stream and trim the OpenConfig interfaces like the openconfig_streaming setting')
+    fleet.add_argument('--workdir', help='where to write the generated testbeds and snapshots')
+    fleet.set_defaults(func=benchmark_fleet)
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
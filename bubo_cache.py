@@ -0,0 +1,133 @@
+import collections
+import logging
+import threading
+
+# ----------------
+# Get logger for script
+# ----------------
+
+log = logging.getLogger(__name__)
+
+_MISSING = object()
+
+# Devices whose snapshots a testcase keeps for a later testcase at most
+DEFAULT_SHARED_DEVICES = 64
+
+class Pending(object):
+    """A snapshot still being fetched in the background.
+
+    future returns the snapshot itself, or a dict of snapshots by key
+    when several keys of a device are fetched in one go.
+    """
+
+    def __init__(self, future, key=None):
+        self.future = future
+        self.key = key
+
+    def result(self):
+        result = self.future.result()
+        return result if self.key is None else result[self.key]
+
+# ----------------
+# Per device snapshot cache
+# ----------------
+class SnapshotCache(object):
+    """Device data keyed by device name and snapshot key.
+
+    A snapshot is fetched once and then shared by every section and
+    retest that asks for it, until bubo changes the device and calls
+    invalidate().  Snapshots prefetched in the background are held as
+    Pending and waited for when asked for; watchers are told whenever a
+    testcase asks for a snapshot so they can fetch further ahead.
+    held() counts the devices with a snapshot of a key, so a testcase can
+    bound how many devices it keeps a snapshot for.
+    """
+
+    def __init__(self):
+        self._snapshots = {}
+        self._held = collections.Counter()
+        self._lock = threading.Lock()
+        self._watchers = []
+        self.fetched = 0
+        self.reused = 0
+
+    def watch(self, watcher):
+        """Call watcher.consumed(device_name, key) whenever a snapshot is asked for"""
+        self._watchers.append(watcher)
+
+    def _consumed(self, device, key):
+        for watcher in self._watchers:
+            watcher.consumed(device.name, key)
+
+    def _resolve(self, device, key, cached, fetch):
+        """Wait for a snapshot still being prefetched, fetching it again if the prefetch failed"""
+        if not isinstance(cached, Pending):
+            return cached
+        try:
+            return cached.result()
+        except Exception as e:
+            log.error(f"Prefetching { key } from { device.name } failed, fetching it again: { e }")
+            with self._lock:
+                self.fetched += 1
+            return fetch(device)
+
+    def get(self, device, key, fetch):
+        """Return the snapshot for device and key, calling fetch(device) on a miss"""
+        with self._lock:
+            cached = self._snapshots.get((device.name, key), _MISSING)
+            if cached is not _MISSING:
+                self.reused += 1
+        self._consumed(device, key)
+        if cached is _MISSING:
+            data = fetch(device)
+            self.put(device.name, key, data)
+            return data
+        data = self._resolve(device, key, cached, fetch)
+        if data is not cached:
+            with self._lock:
+                # Unless the device was invalidated while waiting
+                if self._snapshots.get((device.name, key)) is cached:
+                    self._snapshots[(device.name, key)] = data
+        return data
+
+    def _store(self, device_name, key, data):
+        if (device_name, key) not in self._snapshots:
+            self._held[key] += 1
+        self._snapshots[(device_name, key)] = data
+
+    def _drop(self, device_name, key):
+        if self._snapshots.pop((device_name, key), _MISSING) is not _MISSING:
+            self._held[key] -= 1
+
+    def put_pending(self, device_name, key, future, result_key=None):
+        """Hold a prefetch in flight as the snapshot for device and key"""
+        with self._lock:
+            self.fetched += 1
+            self._store(device_name, key, Pending(future, result_key))
+
+    def put(self, device_name, key, data):
+        with self._lock:
+            self.fetched += 1
+            self._store(device_name, key, data)
+
+    def held(self, key):
+        """Number of devices with a snapshot or a prefetch in flight for key"""
+        with self._lock:
+            return self._held[key]
+
+    def evict(self, device, keys):
+        """Forget the given snapshots of a device once its testcase is done with them"""
+        with self._lock:
+            for key in keys:
+                self._drop(device.name, key)
+
+    def invalidate(self, device):
+        """Forget every snapshot of a device after bubo has changed it"""
+        with self._lock:
+            for device_name, key in [cached for cached in self._snapshots if cached[0] == device.name]:
+                self._drop(device_name, key)
+
+    def summary(self):
+        return f"{ self.fetched } snapshots fetched from devices, { self.reused } reused from cache"
+
+snapshots = SnapshotCache()
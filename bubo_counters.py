@@ -0,0 +1,333 @@
+import logging
+import os
+import sqlite3
+import time
+from contextlib import closing
+from tabulate import tabulate
+from bubo_timing import timings
+try:
+    import numpy
+except ImportError:
+    # The counter rules still work without numpy, one interface at a time
+    numpy = None
+
+# ----------------
+# Get logger for script
+# ----------------
+
+log = logging.getLogger(__name__)
+
+DEFAULT_COUNTER_STORE = 'JSON/bubo_counters.db'
+
+# ----------------
+# Interface counter rules
+# ----------------
+class CounterRule(object):
+    """A threshold check on one interface counter.
+
+    counter is the counter key in the device data and also the key used to
+    override the threshold under counter_thresholds in the intent YAML.
+
+    packets are the packet counters in the same direction, used to turn
+    a counter delta into a rate per million packets.
+    """
+
+    def __init__(self, counter, column, description, threshold=0, packets=()):
+        self.counter = counter
+        self.column = column
+        self.description = description
+        self.threshold = threshold
+        self.packets = packets
+
+class CounterResult(object):
+    """The table rows and failed interfaces of one counter rule"""
+
+    def __init__(self, rule, headers=None):
+        self.rule = rule
+        self.headers = headers or ['Device', 'Interface', rule.column, 'Passed/Failed']
+        self.table_data = []
+        self.failed_interfaces = {}
+
+OPENCONFIG_IN_PACKETS = ('in-unicast-pkts', 'in-broadcast-pkts', 'in-multicast-pkts')
+OPENCONFIG_OUT_PACKETS = ('out-unicast-pkts', 'out-broadcast-pkts', 'out-multicast-pkts')
+
+OPENCONFIG_COUNTER_RULES = [
+    CounterRule('in-discards', 'Input Discard Counter', 'input discards', packets=OPENCONFIG_IN_PACKETS),
+    CounterRule('in-errors', 'Input Errors Counter', 'input errors', packets=OPENCONFIG_IN_PACKETS),
+    CounterRule('in-fcs-errors', 'Input FCS Errors Counter', 'input fcs errors', packets=OPENCONFIG_IN_PACKETS),
+    CounterRule('in-unknown-protos', 'Input Unknown Protocols Counter', 'input unknown protocols', packets=OPENCONFIG_IN_PACKETS),
+    CounterRule('out-discards', 'Output Discards Counter', 'output discards', packets=OPENCONFIG_OUT_PACKETS),
+    CounterRule('out-errors', 'Output Errors Counter', 'output errors', packets=OPENCONFIG_OUT_PACKETS),
+]
+
+LEARNED_COUNTER_RULES = [
+    CounterRule('in_errors', 'Input Errors Counter', 'input errors', packets=('in_pkts',)),
+    CounterRule('in_crc_errors', 'Input CRC Errors Counter', 'input CRC errors', packets=('in_pkts',)),
+    CounterRule('out_errors', 'Output Errors Counter', 'output errors', packets=('out_pkts',)),
+]
+
+def counter_thresholds(device, rules):
+    """Thresholds per counter from the rule defaults, the testbed custom and the device custom settings"""
+    thresholds = {rule.counter: rule.threshold for rule in rules}
+    thresholds.update(device.testbed.custom.get('counter_thresholds') or {})
+    thresholds.update(device.custom.get('counter_thresholds') or {})
+    return thresholds
+
+def counter_mode(device):
+    """absolute compares lifetime counters, delta compares the change since the last run"""
+    return device.custom.get('counter_mode') or device.testbed.custom.get('counter_mode') or 'absolute'
+
+def counter_rate_thresholds(device, rules):
+    """Highest accepted errors per_second and per_million packets per counter in delta mode"""
+    thresholds = {rule.counter: {'per_second': None, 'per_million': 0} for rule in rules}
+    for settings in (device.testbed.custom.get('counter_rate_thresholds') or {},
+                     device.custom.get('counter_rate_thresholds') or {}):
+        for counter, limits in settings.items():
+            thresholds.setdefault(counter, {}).update(limits)
+    return thresholds
+
+def _has_value(counter):
+    return counter is not None and counter != ''
+
+# ----------------
+# Columnar counter matrix
+# ----------------
+class CounterMatrix(object):
+    """Interface counters of many devices as columnar numpy arrays.
+
+    Every device adds a block of interfaces x counters; the fleet view
+    stacks the blocks into one interfaces x counters array with a device
+    index per row, so threshold and top-N queries run vectorised across
+    every interface of every device.  Interface counts differ a lot
+    between devices, so the blocks are stacked rather than padded into
+    a device x interface x counter cube.
+    """
+
+    def __init__(self, counters):
+        self.counters = list(counters)
+        self._blocks = {}
+        self._fleet = None
+
+    def add_device(self, device_name, interfaces):
+        """Load the (name, counters) pairs of a device, replacing any earlier block"""
+        interfaces = list(interfaces)
+        names = [name for name, counters in interfaces]
+        values = numpy.zeros((len(names), len(self.counters)), dtype=numpy.uint64)
+        present = numpy.zeros((len(names), len(self.counters)), dtype=bool)
+        # One column at a time, so numpy converts whole columns instead of single cells
+        for column, counter in enumerate(self.counters):
+            cells = [counters.get(counter) for name, counters in interfaces]
+            present[:, column] = [cell is not None and cell != '' for cell in cells]
+            values[:, column] = [int(cell) if cell is not None and cell != '' else 0 for cell in cells]
+        block = (names, values, present)
+        self._blocks[device_name] = block
+        self._fleet = None
+        return block
+
+    def threshold_vector(self, thresholds):
+        # OpenConfig counters are uint64, a negative threshold accepts nothing above zero
+        return numpy.array([max(int(thresholds[counter]), 0) for counter in self.counters], dtype=numpy.uint64)
+
+    def fleet(self):
+        """Return device names, device index, interface names, values and present mask of the whole fleet"""
+        if self._fleet is None:
+            devices = list(self._blocks)
+            blocks = [self._blocks[device] for device in devices]
+            device_index = numpy.concatenate([numpy.full(len(block[0]), index, dtype=numpy.int32)
+                                              for index, block in enumerate(blocks)] or [numpy.empty(0, dtype=numpy.int32)])
+            names = [name for block in blocks for name in block[0]]
+            values = numpy.concatenate([block[1] for block in blocks] or [numpy.empty((0, len(self.counters)), dtype=numpy.uint64)])
+            present = numpy.concatenate([block[2] for block in blocks] or [numpy.empty((0, len(self.counters)), dtype=bool)])
+            self._fleet = (devices, device_index, names, values, present)
+        return self._fleet
+
+    def exceeds(self, thresholds):
+        """Boolean interfaces x counters mask of the fleet counters above their threshold"""
+        devices, device_index, names, values, present = self.fleet()
+        return present & (values > self.threshold_vector(thresholds))
+
+    def top(self, counter, count=10):
+        """The count highest values of one counter across the fleet as (device, interface, value)"""
+        devices, device_index, names, values, present = self.fleet()
+        column = numpy.where(present[:, self.counters.index(counter)],
+                             values[:, self.counters.index(counter)], numpy.uint64(0))
+        count = min(count, len(column))
+        if not count:
+            return []
+        highest = numpy.argpartition(column, -count)[-count:]
+        highest = highest[numpy.argsort(column[highest])[::-1]]
+        return [(devices[device_index[row]], names[row], int(column[row])) for row in highest if column[row] > 0]
+
+def log_fleet_counters(matrix, count=10):
+    """Log the interfaces with the highest value of every counter across the fleet"""
+    table_data = []
+    for counter in matrix.counters:
+        for device_name, interface, value in matrix.top(counter, count):
+            table_data.append([counter, device_name, interface, value])
+    log.info(tabulate(table_data,
+                        headers=['Counter', 'Device', 'Interface', 'Value'],
+                        tablefmt='orgtbl'))
+
+def fleet_counter_matrix(rules):
+    """A CounterMatrix for the counters of the rules, or None when numpy is not installed"""
+    if numpy is None:
+        return None
+    return CounterMatrix(rule.counter for rule in rules)
+
+# ----------------
+# Evaluate counter rules
+# ----------------
+def evaluate_counters(device, interfaces, rules, thresholds, matrix=None):
+    """Evaluate every counter rule in a single pass over the interfaces.
+
+    interfaces yields (name, counters) pairs; returns a CounterResult per
+    counter with the same rows the per counter tests used to build.  With
+    numpy the interfaces are loaded into matrix, or a matrix of their own,
+    and compared against every threshold at once.
+    """
+    results = {rule.counter: CounterResult(rule) for rule in rules}
+    if numpy is None:
+        for name, counters in interfaces:
+            for rule in rules:
+                result = results[rule.counter]
+                counter = counters.get(rule.counter)
+                if not _has_value(counter):
+                    result.table_data.append([device.alias, name, 'N/A', 'N/A'])
+                elif int(counter) > thresholds[rule.counter]:
+                    result.table_data.append([device.alias, name, counter, 'Failed'])
+                    result.failed_interfaces[name] = int(counter)
+                else:
+                    result.table_data.append([device.alias, name, counter, 'Passed'])
+        return results
+
+    if matrix is None:
+        matrix = CounterMatrix(rule.counter for rule in rules)
+    names, values, present = matrix.add_device(device.name, interfaces)
+    failed = present & (values > matrix.threshold_vector(thresholds))
+    for rule in rules:
+        column = matrix.counters.index(rule.counter)
+        result = results[rule.counter]
+        counters = values[:, column].tolist()
+        states = numpy.where(failed[:, column], 'Failed', numpy.where(present[:, column], 'Passed', 'N/A')).tolist()
+        result.table_data = [[device.alias, name, counter if state != 'N/A' else 'N/A', state]
+                             for name, counter, state in zip(names, counters, states)]
+        result.failed_interfaces = {names[row]: counters[row] for row in numpy.nonzero(failed[:, column])[0].tolist()}
+    return results
+
+# ----------------
+# Counter deltas between runs
+# ----------------
+COUNTER_WIDTHS = (2 ** 32, 2 ** 64)
+
+def counter_delta(previous, current):
+    """The increase of a counter between two readings, allowing for wraps and clears.
+
+    A counter that went down wrapped if the previous reading was in the top
+    quarter of a 32 or 64 bit counter, otherwise it was cleared and the
+    current reading is everything counted since.
+    """
+    if current >= previous:
+        return current - previous
+    for width in COUNTER_WIDTHS:
+        if width * 3 // 4 <= previous < width:
+            return width - previous + current
+    return current
+
+class CounterStore(object):
+    """The last counters seen per device and interface, kept between runs in sqlite"""
+
+    def __init__(self, path=DEFAULT_COUNTER_STORE):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with closing(self._connect()) as db, db:
+            db.execute('CREATE TABLE IF NOT EXISTS runs (device TEXT PRIMARY KEY, timestamp REAL)')
+            db.execute('CREATE TABLE IF NOT EXISTS counters (device TEXT, interface TEXT, counter TEXT, value INTEGER, '
+                       'PRIMARY KEY (device, interface, counter)) WITHOUT ROWID')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def load(self, device_name):
+        """Return the timestamp and {interface: {counter: value}} of the last run, or None and {}"""
+        with closing(self._connect()) as db, db:
+            run = db.execute('SELECT timestamp FROM runs WHERE device = ?', (device_name,)).fetchone()
+            if run is None:
+                return None, {}
+            interfaces = {}
+            for interface, counter, value in db.execute(
+                    'SELECT interface, counter, value FROM counters WHERE device = ?', (device_name,)):
+                interfaces.setdefault(interface, {})[counter] = value
+        return run[0], interfaces
+
+    def save(self, device_name, timestamp, interfaces):
+        with closing(self._connect()) as db, db:
+            db.execute('DELETE FROM counters WHERE device = ?', (device_name,))
+            db.executemany('INSERT INTO counters VALUES (?, ?, ?, ?)',
+                           ((device_name, interface, counter, value)
+                            for interface, counters in interfaces.items()
+                            for counter, value in counters.items()))
+            db.execute('INSERT OR REPLACE INTO runs VALUES (?, ?)', (device_name, timestamp))
+
+def _exceeds(value, limit):
+    return value is not None and limit is not None and value > limit
+
+def evaluate_counter_deltas(device, interfaces, rules, rate_thresholds, store, now=None):
+    """Evaluate every counter rule on the change since the last run stored for the device.
+
+    A counter fails when its errors per second or errors per million
+    packets are above the rate thresholds; interfaces without an earlier
+    reading are recorded as the baseline for the next run.
+    """
+    interfaces = list(interfaces)
+    now = now or time.time()
+    timestamp, previous = store.load(device.name)
+    elapsed = now - timestamp if timestamp else None
+    results = {rule.counter: CounterResult(rule, headers=['Device', 'Interface', rule.column, 'Delta',
+                                                          'Per Second', 'Per Million Packets', 'Passed/Failed'])
+               for rule in rules}
+    tracked = {rule.counter for rule in rules} | {packets for rule in rules for packets in rule.packets}
+    current = {}
+    for name, counters in interfaces:
+        current[name] = {counter: int(counters[counter]) for counter in tracked if _has_value(counters.get(counter))}
+        before = previous.get(name, {})
+        for rule in rules:
+            result = results[rule.counter]
+            if rule.counter not in current[name]:
+                result.table_data.append([device.alias, name, 'N/A', 'N/A', 'N/A', 'N/A', 'N/A'])
+                continue
+            counter = current[name][rule.counter]
+            if rule.counter not in before or not elapsed or elapsed <= 0:
+                result.table_data.append([device.alias, name, counter, 'N/A', 'N/A', 'N/A', 'Baseline'])
+                continue
+            errors = counter_delta(before[rule.counter], counter)
+            packets = sum(counter_delta(before[key], current[name][key])
+                          for key in rule.packets if key in before and key in current[name])
+            per_second = errors / elapsed
+            per_million = errors * 1e6 / packets if packets else (float('inf') if errors else 0.0)
+            limits = rate_thresholds[rule.counter]
+            table_row = [device.alias, name, counter, errors, f"{ per_second:.4f}", f"{ per_million:.2f}"]
+            if _exceeds(per_second, limits.get('per_second')) or _exceeds(per_million, limits.get('per_million')):
+                table_row.append('Failed')
+                result.failed_interfaces[name] = errors
+            else:
+                table_row.append('Passed')
+            result.table_data.append(table_row)
+    store.save(device.name, now, current)
+    return results
+
+# ----------------
+# Report a counter rule from a test section
+# ----------------
+def report_counter(section, result):
+    """Log the table of a counter rule and pass or fail the section on it"""
+    section.failed_interfaces = result.failed_interfaces
+    with timings.timed(section.device, 'report', result.rule.counter):
+        log.info(tabulate(result.table_data,
+                            headers=result.headers,
+                            tablefmt='orgtbl'))
+    # should we pass or fail?
+    if result.failed_interfaces:
+        section.failed(f'Some interfaces have { result.rule.description }')
+    else:
+        section.passed(f'No interfaces have { result.rule.description }')
@@ -0,0 +1,114 @@
+import json
+import marshal
+from collections import namedtuple
+from tabulate import tabulate
+
+# ----------------
+# Structural diff of parsed JSON
+# ----------------
+class _Absent(object):
+    """The old value of an added node or the new value of a removed one"""
+
+    def __repr__(self):
+        return '<absent>'
+
+ABSENT = _Absent()
+
+# path is a tuple of dict keys, list indexes and (key, value) pairs for
+# list entries matched by key, e.g. ('interface', 'GigabitEthernet', ('name', '1'), 'description')
+Change = namedtuple('Change', ['path', 'old', 'new'])
+
+def _keyed(entries, key):
+    """Index a list of dicts by key, or None when the entries are not uniquely keyed"""
+    index = {}
+    for entry in entries:
+        if not isinstance(entry, dict) or key not in entry:
+            return None
+        try:
+            index[(key, entry[key])] = entry
+        except TypeError:
+            return None
+    return index if len(index) == len(entries) else None
+
+def _diff_items(old, new, path, changes, key):
+    for name, value in old.items():
+        if name in new:
+            _diff(value, new[name], path + (name,), changes, key)
+        else:
+            changes.append(Change(path + (name,), value, ABSENT))
+    for name, value in new.items():
+        if name not in old:
+            changes.append(Change(path + (name,), ABSENT, value))
+
+def _same(old, new):
+    # Deep equality runs in C and stops at the first difference, so it
+    # prunes unchanged branches far faster than hashing them in Python.
+    # It takes True, 1 and 1.0 for the same value anywhere below a
+    # container though.  marshal tells them apart and also runs in C;
+    # version 2 writes no back references, so shared objects do not matter
+    if old.__class__ is not new.__class__ or old != new:
+        return False
+    if not isinstance(old, (dict, list)):
+        return True
+    try:
+        return marshal.dumps(old, 2) == marshal.dumps(new, 2)
+    except ValueError:
+        return repr(old) == repr(new)
+
+def _diff(old, new, path, changes, key):
+    if _same(old, new):
+        return
+    if isinstance(old, dict) and isinstance(new, dict):
+        _diff_items(old, new, path, changes, key)
+    elif isinstance(old, list) and isinstance(new, list):
+        old_index, new_index = _keyed(old, key), _keyed(new, key)
+        if old_index is not None and new_index is not None:
+            _diff_items(old_index, new_index, path, changes, key)
+            return
+        for position, (old_item, new_item) in enumerate(zip(old, new)):
+            _diff(old_item, new_item, path + (position,), changes, key)
+        for position in range(len(new), len(old)):
+            changes.append(Change(path + (position,), old[position], ABSENT))
+        for position in range(len(old), len(new)):
+            changes.append(Change(path + (position,), ABSENT, new[position]))
+    else:
+        changes.append(Change(path, old, new))
+
+def diff(old, new, key='name'):
+    """Return a Change for every leaf or subtree that differs between two documents.
+
+    Only branches that compare unequal are descended into, and lists of
+    dicts are matched by their key leaf rather than position.
+    """
+    changes = []
+    _diff(old, new, (), changes, key)
+    return changes
+
+# ----------------
+# Report changes
+# ----------------
+def format_path(path):
+    text = ''
+    for node in path:
+        if isinstance(node, tuple):
+            text += f"[{ node[0] }={ node[1] }]"
+        elif isinstance(node, int):
+            text += f"[{ node }]"
+        else:
+            text += f"/{ node }" if text else f"{ node }"
+    return text or '/'
+
+def _format_value(value, width=120):
+    if value is ABSENT:
+        return ''
+    text = json.dumps(value, sort_keys=True) if isinstance(value, (dict, list)) else f"{ value }"
+    return text if len(text) <= width else f"{ text[:width - 3] }..."
+
+def format_changes(changes):
+    """A table of changes for the job log"""
+    if not changes:
+        return 'No differences'
+    return tabulate([[format_path(change.path), _format_value(change.old), _format_value(change.new)]
+                     for change in changes],
+                    headers=['Path', 'Pre Test', 'Post Test'],
+                    tablefmt='orgtbl')
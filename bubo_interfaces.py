@@ -0,0 +1,91 @@
+import re
+from functools import lru_cache
+
+# ----------------
+# Interface name canonicalisation
+# ----------------
+INTERFACE_TYPES = [
+    'AppGigabitEthernet', 'BDI', 'Dialer', 'Ethernet', 'FastEthernet',
+    'FiveGigabitEthernet', 'FortyGigabitEthernet', 'GigabitEthernet',
+    'HundredGigE', 'Loopback', 'Management', 'Port-channel', 'Serial',
+    'TenGigabitEthernet', 'Tunnel', 'TwentyFiveGigE', 'TwoGigabitEthernet',
+    'Virtual-Template', 'VirtualPortGroup', 'Vlan',
+]
+
+# Short forms IOS XE shows that are not a unique prefix of a type
+INTERFACE_ABBREVIATIONS = {
+    'ap': 'AppGigabitEthernet',
+    'eth': 'Ethernet',
+    'fi': 'FiveGigabitEthernet',
+    'fo': 'FortyGigabitEthernet',
+    'gi': 'GigabitEthernet',
+    'hu': 'HundredGigE',
+    'po': 'Port-channel',
+    'te': 'TenGigabitEthernet',
+    'tu': 'Tunnel',
+    'tw': 'TwoGigabitEthernet',
+    'twe': 'TwentyFiveGigE',
+    'vl': 'Vlan',
+}
+
+_INTERFACE_TYPES = {interface_type.lower(): interface_type for interface_type in INTERFACE_TYPES}
+
+@lru_cache(maxsize=None)
+def canonical_interface_name(name):
+    """Expand an interface name like Gi1 or gig 1/0/1 to GigabitEthernet1 or GigabitEthernet1/0/1"""
+    match = re.match(r"([A-Za-z\-]+)\s*(.*)", f"{ name }")
+    if not match:
+        return f"{ name }"
+    prefix, number = match.group(1).lower(), match.group(2)
+    interface_type = _INTERFACE_TYPES.get(prefix) or INTERFACE_ABBREVIATIONS.get(prefix)
+    if interface_type is None:
+        candidates = [full for lower, full in _INTERFACE_TYPES.items() if lower.startswith(prefix)]
+        interface_type = candidates[0] if len(candidates) == 1 else match.group(1)
+    return f"{ interface_type }{ number }"
+
+def interface_name_index(names):
+    """Map the canonical name of every interface to the name it was given as"""
+    index = {}
+    for name in names:
+        index.setdefault(canonical_interface_name(name), name)
+    return index
+
+def canonical_mapping(mapping):
+    """Key a name keyed mapping, like the intent interfaces, by canonical name"""
+    return {canonical_interface_name(name): value for name, value in mapping.items()}
+
+def intended_description(intent_value):
+    """The description an intent interface asks for, or None when it asks for none.
+
+    The SSH intent holds plain dicts under custom: interfaces, the testbed
+    topology holds Interface objects with a description attribute.
+    """
+    if isinstance(intent_value, dict):
+        return intent_value.get('description')
+    return getattr(intent_value, 'description', None)
+
+def native_interface_names(parsed_json):
+    """Flatten the Cisco-IOS-XE-native interface lists into names like GigabitEthernet1"""
+    names = []
+    for interface_type, entries in parsed_json['Cisco-IOS-XE-native:native'].get('interface', {}).items():
+        for entry in entries:
+            names.append(f"{ interface_type }{ entry['name'] }")
+    return names
+
+# ----------------
+# Interface indexes
+# ----------------
+def index_by_name(entries, key='name'):
+    """Index a list of interface entries, like the OpenConfig interface list, by name"""
+    return {entry[key]: entry for entry in entries}
+
+def match_interfaces(actual, intended):
+    """Yield (name, actual, intended) for every actual interface that is in the intent.
+
+    actual is a name keyed mapping of the device interfaces and intended a
+    name keyed mapping of the intent, so each interface costs one lookup.
+    """
+    for name, actual_value in actual.items():
+        intended_value = intended.get(name)
+        if intended_value is not None:
+            yield name, actual_value, intended_value
@@ -0,0 +1,267 @@
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from tabulate import tabulate
+from bubo_cache import snapshots
+from bubo_timing import timings
+
+# ----------------
+# Get logger for script
+# ----------------
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CONNECT_POOL_SIZE = 16
+DEFAULT_DEVICE_POOL_SIZE = 8
+DEFAULT_PREFETCH_DEPTH = 4
+
+# ----------------
+# Connect to devices with a bounded pool
+# ----------------
+class _DaemonPool(object):
+    """Run work(item) for every item on daemon threads, with a Future per item in futures.
+
+    Unlike a ThreadPoolExecutor the threads are not joined at exit, so a
+    call that never returns does not keep the interpreter alive.
+    """
+
+    def __init__(self, work, items, name):
+        self.work = work
+        self.name = name
+        self.futures = [(Future(), item) for item in items]
+        self._queue = collections.deque(self.futures)
+        self._workers = 0
+
+    def add_workers(self, count):
+        for _ in range(min(count, len(self._queue))):
+            threading.Thread(target=self._worker, name=f"{ self.name }_{ self._workers }", daemon=True).start()
+            self._workers += 1
+
+    def _worker(self):
+        while True:
+            try:
+                future, item = self._queue.popleft()
+            except IndexError:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self.work(item))
+            except BaseException as e:
+                future.set_exception(e)
+
+def connect_devices(testbed, pool_size=DEFAULT_CONNECT_POOL_SIZE, timeout=None, via=None):
+    """Connect to every device with at most pool_size sessions opening at once.
+
+    With via the named connection is opened under that alias, so
+    device.<via> reaches it whatever its connection class.  A device
+    that has not connected within timeout seconds of its own connect
+    starting is reported as timed out and left behind on its daemon
+    thread.  Returns the names of the connected devices in testbed order.
+    """
+    started = {}
+    finished = {}
+
+    def _connect(device):
+        started[device.name] = time.monotonic()
+        if via:
+            device.connect(alias=via, via=via)
+        else:
+            device.connect()
+        return time.monotonic() - started[device.name]
+
+    pool = _DaemonPool(_connect, testbed.devices.values(), 'bubo-connect')
+    pool.add_workers(pool_size)
+    futures = {future: device.name for future, device in pool.futures}
+    pending = set(futures)
+    hanging = []
+    while pending:
+        done, pending = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+        for future in done:
+            name = futures[future]
+            try:
+                finished[name] = ('Connected', future.result())
+                timings.record(name, 'io', 'connect', finished[name][1])
+            except Exception as e:
+                log.error(f"Failed to connect to { name }: { e }")
+                finished[name] = ('Failed', time.monotonic() - started[name])
+        if timeout:
+            now = time.monotonic()
+            for future in list(pending):
+                name = futures[future]
+                if name in started and now - started[name] > timeout:
+                    log.error(f"Timed out connecting to { name } after { timeout } seconds")
+                    finished[name] = ('Timeout', now - started[name])
+                    pending.discard(future)
+                    hanging.append(name)
+                    # The devices queued behind a hung connect still get a thread
+                    pool.add_workers(1)
+    if hanging:
+        # Their threads are daemons, so they end with the job rather than hold it open
+        log.warning(f"Left { len(hanging) } connects hanging: { ', '.join(hanging) }")
+
+    table_data = []
+    for name in testbed.devices:
+        status, elapsed = finished[name]
+        table_data.append([name, status, f"{ elapsed:.2f}"])
+    log.info(tabulate(table_data,
+                        headers=['Device', 'Connection', 'Connect Time (s)'],
+                        tablefmt='orgtbl'))
+    connected = [name for name in testbed.devices if finished[name][0] == 'Connected']
+    if connected:
+        slowest = max(connected, key=lambda name: finished[name][1])
+        log.info(f"Connected { len(connected) } of { len(testbed.devices) } devices, "
+                 f"slowest was { slowest } at { finished[slowest][1]:.2f}s")
+    return connected
+
+# ----------------
+# Collect device data in a worker pool
+# ----------------
+def _fetch_device(device, fetchers):
+    """Run every fetcher for one device, one after the other"""
+    return {key: fetch(device) for key, fetch in fetchers.items()}
+
+def prefetch(devices, fetchers, mode='thread', pool_size=DEFAULT_DEVICE_POOL_SIZE, concurrent_keys=False):
+    """Run fetchers for every device in a pool of threads or processes.
+
+    fetchers maps a key to a callable taking the device; each device runs
+    its fetchers in order on one worker so a session is never shared.
+    Results are kept in the snapshot cache for the testcases.  In
+    process mode the results are pickled back to the parent, so fetchers
+    must return plain data.  With concurrent_keys, for connections that
+    take several requests at once, thread mode runs the fetchers of a
+    device side by side.
+    """
+    devices = list(devices)
+    results = {}
+    errors = {}
+    if mode == 'process':
+        from pyats.async_ import pcall
+        for start in range(0, len(devices), pool_size):
+            chunk = devices[start:start + pool_size]
+            try:
+                chunk_results = pcall(_fetch_device, device=chunk, ckwargs={'fetchers': fetchers})
+            except Exception as e:
+                for device in chunk:
+                    errors[device.name] = e
+                continue
+            for device, result in zip(chunk, chunk_results):
+                results[device.name] = result
+    elif mode == 'thread':
+        with ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='bubo-device') as pool:
+            futures = {}
+            for device in devices:
+                if concurrent_keys:
+                    futures[device.name] = {key: pool.submit(fetch, device) for key, fetch in fetchers.items()}
+                else:
+                    futures[device.name] = pool.submit(_fetch_device, device, fetchers)
+            for name, future in futures.items():
+                try:
+                    if concurrent_keys:
+                        results[name] = {key: key_future.result() for key, key_future in future.items()}
+                    else:
+                        results[name] = future.result()
+                except Exception as e:
+                    errors[name] = e
+    else:
+        raise ValueError(f"Unknown device pool mode { mode }, expected thread or process")
+
+    for name, data in results.items():
+        for key, value in data.items():
+            snapshots.put(name, key, value)
+    for name, error in errors.items():
+        log.error(f"Failed to collect data from { name }, the testcase will retry: { error }")
+    return list(results)
+
+# ----------------
+# Fetch ahead of the testcases
+# ----------------
+class Pipeline(object):
+    """Fetch data for the devices a testcase loops over, a bounded number of devices ahead.
+
+    When the testcase asks for the data of a device the pipeline starts
+    fetching up to depth devices after it on the shared pool, so device
+    I/O overlaps with the evaluation of the device being tested while at
+    most depth devices of prefetched data wait ahead of it.  Data a later
+    testcase reuses stays cached until that testcase evicts it.  The
+    pipeline of the next testcase starts once this one reaches its last
+    device, so a device session is never used by two testcases at once.
+    """
+
+    def __init__(self, devices, fetchers, pool, depth=DEFAULT_PREFETCH_DEPTH, concurrent_keys=False):
+        self.devices = list(devices)
+        self.fetchers = fetchers
+        self.pool = pool
+        self.depth = depth
+        self.concurrent_keys = concurrent_keys
+        self._position = {device.name: index for index, device in enumerate(self.devices)}
+        self._scheduled = 0
+        self._futures = []
+        self._lock = threading.Lock()
+        self.started = False
+        self.next = None
+
+    def start(self, busy=None):
+        """Fetch the first depth devices, except busy which is still being tested and fetches its own"""
+        self.started = True
+        self._schedule_through(self.depth - 1, busy)
+
+    def _submit(self, device):
+        if self.concurrent_keys:
+            for key, fetch in self.fetchers.items():
+                future = self.pool.submit(fetch, device)
+                snapshots.put_pending(device.name, key, future)
+                self._futures.append(future)
+        else:
+            future = self.pool.submit(_fetch_device, device, self.fetchers)
+            for key in self.fetchers:
+                snapshots.put_pending(device.name, key, future, result_key=key)
+            self._futures.append(future)
+
+    def _schedule_through(self, last, busy=None):
+        with self._lock:
+            while self._scheduled <= min(last, len(self.devices) - 1):
+                device = self.devices[self._scheduled]
+                if device.name != busy:
+                    self._submit(device)
+                self._scheduled += 1
+
+    def consumed(self, device_name, key):
+        if key not in self.fetchers or device_name not in self._position:
+            return
+        if not self.started:
+            # The previous testcase never reached its last device
+            self.start(busy=device_name)
+        self._schedule_through(self._position[device_name] + self.depth)
+        if self._position[device_name] == len(self.devices) - 1 and self.next and not self.next.started:
+            self.next.start(busy=device_name)
+
+    def cancel(self):
+        for future in self._futures:
+            future.cancel()
+
+_pipelines = []
+_pipeline_pool = None
+
+def start_pipelines(devices, stages, depth=DEFAULT_PREFETCH_DEPTH, pool_size=DEFAULT_DEVICE_POOL_SIZE,
+                    concurrent_keys=False):
+    """Start a Pipeline per testcase, stages being the fetchers of each testcase in run order"""
+    global _pipeline_pool
+    _pipeline_pool = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='bubo-pipeline')
+    for fetchers in stages:
+        pipeline = Pipeline(devices, fetchers, _pipeline_pool, depth=depth, concurrent_keys=concurrent_keys)
+        snapshots.watch(pipeline)
+        if _pipelines:
+            _pipelines[-1].next = pipeline
+        _pipelines.append(pipeline)
+    if _pipelines:
+        _pipelines[0].start()
+
+def stop_pipelines():
+    """Cancel prefetches nobody asked for, e.g. of devices whose testcases were skipped"""
+    for pipeline in _pipelines:
+        pipeline.cancel()
+    if _pipeline_pool is not None:
+        _pipeline_pool.shutdown(wait=False, cancel_futures=True)
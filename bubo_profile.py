@@ -0,0 +1,129 @@
+import cProfile
+import logging
+import os
+import pstats
+import tracemalloc
+
+# ----------------
+# Get logger for script
+# ----------------
+
+log = logging.getLogger(__name__)
+
+TRACEMALLOC_FRAMES = 25
+TOP_ALLOCATIONS = 25
+# Paths through the call graph that took less than this many seconds are left out
+MIN_STACK_SECONDS = 1e-6
+MAX_STACK_DEPTH = 128
+
+# ----------------
+# Collapsed stacks from cProfile
+# ----------------
+def _frame_name(func):
+    filename, line, name = func
+    if filename == '~':
+        # A builtin, like <method 'join' of 'str' objects>
+        return name
+    return f"{ os.path.basename(filename) }:{ name }:{ line }"
+
+def collapsed_stacks(stats):
+    """Fold a pstats.Stats into flamegraph stacks, returning {stack: microseconds of own time}.
+
+    cProfile keeps caller to callee times rather than whole stacks, so the
+    time of a function called from several places is shared between its
+    callers in proportion to the time each edge took.
+    """
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, {})[func] = edge[3]
+    roots = [func for func, (cc, nc, tt, ct, callers) in stats.stats.items()
+             if not any(caller in stats.stats for caller in callers)]
+    stacks = {}
+
+    def walk(func, path, share):
+        tt = stats.stats[func][2]
+        stack = ';'.join(_frame_name(frame) for frame in path)
+        stacks[stack] = stacks.get(stack, 0) + tt * share
+        if len(path) >= MAX_STACK_DEPTH:
+            return
+        for callee, edge_time in callees.get(func, {}).items():
+            callee_time = stats.stats[callee][3]
+            if callee in path or not callee_time or edge_time * share < MIN_STACK_SECONDS:
+                continue
+            walk(callee, path + (callee,), share * edge_time / callee_time)
+
+    for root in roots:
+        walk(root, (root,), 1.0)
+    return {stack: int(seconds * 1e6) for stack, seconds in stacks.items() if int(seconds * 1e6)}
+
+# ----------------
+# Profile a testcase iteration
+# ----------------
+class TestcaseProfiler(object):
+    """cProfile and tracemalloc around one testcase iteration of one device.
+
+    Writes JSON/<alias>_<testcase>_PROFILE.pstats for snakeviz or pstats,
+    _PROFILE.collapsed stacks for flamegraph.pl or speedscope, and
+    _ALLOCATIONS.txt with the lines that allocated the most memory still
+    held at the end of the iteration and the peak traced memory.
+    """
+
+    def __init__(self, device, testcase, directory='JSON'):
+        self.prefix = os.path.join(directory, f"{ device.alias }_{ testcase }")
+        self.profile = cProfile.Profile()
+        self.started_tracemalloc = False
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.started_tracemalloc = True
+        tracemalloc.reset_peak()
+        self.baseline = tracemalloc.take_snapshot()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+        stats = pstats.Stats(self.profile)
+        stats.dump_stats(f"{ self.prefix }_PROFILE.pstats")
+        with open(f"{ self.prefix }_PROFILE.collapsed", 'w') as f:
+            for stack, microseconds in sorted(collapsed_stacks(stats).items()):
+                f.write(f"{ stack } { microseconds }\n")
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, '<frozen importlib._bootstrap*>')]
+        growth = snapshot.filter_traces(ignore).compare_to(self.baseline.filter_traces(ignore), 'lineno')
+        held = snapshot.filter_traces(ignore).statistics('traceback')
+        with open(f"{ self.prefix }_ALLOCATIONS.txt", 'w') as f:
+            f.write(f"Peak traced memory { peak / 1e6:.1f} MB, { current / 1e6:.1f} MB at the end of the testcase\n\n")
+            f.write(f"Top { TOP_ALLOCATIONS } lines by memory allocated during the testcase and still held\n")
+            for stat in growth[:TOP_ALLOCATIONS]:
+                f.write(f"{ stat }\n")
+            f.write(f"\nTop { min(5, len(held)) } allocation tracebacks\n")
+            for stat in held[:5]:
+                f.write(f"\n{ stat.size / 1e6:.1f} MB in { stat.count } blocks\n")
+                f.write('\n'.join(stat.traceback.format(limit=TRACEMALLOC_FRAMES)) + '\n')
+        log.info(f"Wrote the profile and allocations of this testcase to { self.prefix }_*")
+
+def start_profile(section, device):
+    """Profile the rest of a testcase iteration when the job asked for it.
+
+    The job passes profile, a list of testcase names or an empty list
+    for every testcase, or None when profiling is off.
+    """
+    selected = section.parameters.get('profile')
+    testcase = type(section).__name__
+    if selected is None or (selected and testcase not in selected):
+        section.profiler = None
+        return
+    section.profiler = TestcaseProfiler(device, testcase)
+    section.profiler.start()
+
+def stop_profile(section):
+    """Write the profile of a testcase iteration started by start_profile"""
+    profiler = getattr(section, 'profiler', None)
+    if profiler is not None:
+        section.profiler = None
+        profiler.stop()
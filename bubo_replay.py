@@ -0,0 +1,226 @@
+import collections
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from requests.exceptions import HTTPError, RequestException
+from pyats.connections import BaseConnection
+from bubo_async_rest import RestResponse
+
+# ----------------
+# Get logger for script
+# ----------------
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CASSETTES = 'cassettes'
+
+def cassette_path(directory, device_name):
+    return os.path.join(directory, f"{ device_name }.jsonl")
+
+# ----------------
+# Record device exchanges
+# ----------------
+class Cassette(object):
+    """Every request and response of one device, appended as JSON lines"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    def append(self, entry):
+        line = json.dumps(entry, sort_keys=True)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(f"{ line }\n")
+
+def _request_key(method, request, payload=None):
+    return f"{ method } { request }" if payload is None else f"{ method } { request } { payload }"
+
+def _record_rest(cassette, connection, method):
+    send = getattr(connection, method)
+
+    def recorded(api_url, *args, **kwargs):
+        payload = kwargs.get('payload', args[0] if args and method != 'get' else None)
+        start = time.perf_counter()
+        entry = {'kind': 'rest', 'method': method.upper(), 'request': api_url, 'payload': payload}
+        try:
+            response = send(api_url, *args, **kwargs)
+        except RequestException as e:
+            response = e.response
+            entry['error'] = f"{ e }"
+            if response is None:
+                raise
+        entry.update(elapsed=time.perf_counter() - start,
+                     status_code=response.status_code,
+                     headers=dict(getattr(response, 'headers', None) or {}),
+                     content=(response.content or b'').decode(errors='replace'))
+        cassette.append(entry)
+        if 'error' in entry:
+            raise HTTPError(entry['error'], response=response)
+        return response
+
+    setattr(connection, method, recorded)
+
+def _record_get_many(cassette, connection):
+    send = connection.get_many
+
+    def recorded(api_urls, *args, **kwargs):
+        start = time.perf_counter()
+        responses = send(api_urls, *args, **kwargs)
+        elapsed = time.perf_counter() - start
+        for api_url, response in zip(api_urls, responses):
+            entry = {'kind': 'rest', 'method': 'GET', 'request': api_url, 'payload': None, 'elapsed': elapsed}
+            if isinstance(response, Exception):
+                if getattr(response, 'response', None) is None:
+                    continue
+                entry['error'] = f"{ response }"
+                response = response.response
+            entry.update(status_code=response.status_code,
+                         headers=dict(getattr(response, 'headers', None) or {}),
+                         content=(response.content or b'').decode(errors='replace'))
+            cassette.append(entry)
+        return responses
+
+    connection.get_many = recorded
+
+def _record_stream(cassette, connection):
+    send = connection.stream
+
+    @contextmanager
+    def recorded(api_url, *args, **kwargs):
+        start = time.perf_counter()
+        body = []
+
+        def _tee(chunks):
+            for chunk in chunks:
+                body.append(chunk)
+                yield chunk
+
+        with send(api_url, *args, **kwargs) as chunks:
+            yield _tee(chunks)
+        # Replayed as a plain GET, connections without stream() decode it in one go
+        cassette.append({'kind': 'rest', 'method': 'GET', 'request': api_url, 'payload': None,
+                         'elapsed': time.perf_counter() - start, 'status_code': 200, 'headers': {},
+                         'content': b''.join(body).decode(errors='replace')})
+
+    connection.stream = recorded
+
+def _record_cli(cassette, device, method):
+    send = getattr(device, method)
+
+    def recorded(command, *args, **kwargs):
+        request = command if isinstance(command, str) else '\n'.join(command)
+        start = time.perf_counter()
+        output = send(command, *args, **kwargs)
+        cassette.append({'kind': 'cli', 'method': method, 'request': request, 'payload': None,
+                         'elapsed': time.perf_counter() - start, 'output': output})
+        return output
+
+    setattr(device, method, recorded)
+
+def record(device, directory=DEFAULT_CASSETTES, rest=False, cli=False):
+    """Wrap the connection calls of a connected device to append every exchange to its cassette.
+
+    rest records device.rest get/put/patch/get_many/stream, cli records
+    device.execute and device.configure, which learn() and the parsers
+    go through.
+    """
+    cassette = Cassette(cassette_path(directory, device.name))
+    if rest:
+        for method in ('get', 'put', 'patch'):
+            _record_rest(cassette, device.rest, method)
+        if hasattr(device.rest, 'get_many'):
+            _record_get_many(cassette, device.rest)
+        if hasattr(device.rest, 'stream'):
+            _record_stream(cassette, device.rest)
+    if cli:
+        for method in ('execute', 'configure'):
+            _record_cli(cassette, device, method)
+    log.info(f"Recording { device.name } to { cassette.path }")
+
+# ----------------
+# Replay connections
+# ----------------
+class _Replay(BaseConnection):
+    """Serve a device cassette back instead of talking to the device.
+
+    Exchanges are matched by method, request and payload and served in
+    recorded order; the last response for a request repeats once the
+    recording runs out.  latency on the connection sleeps the recorded
+    time of each exchange ('recorded') or a fixed number of seconds.
+    """
+
+    kind = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._exchanges = None
+        self._lock = threading.Lock()
+
+    @property
+    def connected(self):
+        return self._exchanges is not None
+
+    def connect(self):
+        path = self.connection_info.get('cassette') or cassette_path(
+            self.connection_info.get('cassettes', DEFAULT_CASSETTES), self.device.name)
+        self._exchanges = collections.defaultdict(collections.deque)
+        with open(path) as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry['kind'] == self.kind:
+                    self._exchanges[_request_key(entry['method'], entry['request'], entry['payload'])].append(entry)
+        self.latency = self.connection_info.get('latency', 0)
+        log.info(f"Replaying { self.device.name } from { path }")
+
+    def disconnect(self):
+        self._exchanges = None
+
+    def _replay(self, method, request, payload=None):
+        key = _request_key(method, request, payload)
+        with self._lock:
+            recorded = self._exchanges.get(key)
+            if not recorded:
+                raise LookupError(f"{ self.device.name } has no recorded { key }")
+            entry = recorded.popleft() if len(recorded) > 1 else recorded[0]
+        delay = entry['elapsed'] if self.latency == 'recorded' else float(self.latency or 0)
+        if delay:
+            time.sleep(delay)
+        return entry
+
+class ReplayRest(_Replay):
+    """Replays device.rest get/put/patch, select with class: bubo_replay.ReplayRest"""
+
+    kind = 'rest'
+
+    def _response(self, method, api_url, payload):
+        entry = self._replay(method, api_url, payload)
+        response = RestResponse(api_url, entry['status_code'], entry['headers'], entry['content'].encode())
+        if 'error' in entry:
+            raise HTTPError(entry['error'], response=response)
+        return response
+
+    def get(self, api_url, *args, **kwargs):
+        return self._response('GET', api_url, None)
+
+    def put(self, api_url, payload=None, *args, **kwargs):
+        return self._response('PUT', api_url, payload)
+
+    def patch(self, api_url, payload=None, *args, **kwargs):
+        return self._response('PATCH', api_url, payload)
+
+class ReplayCli(_Replay):
+    """Replays device.execute/configure and so learn(), select with class: bubo_replay.ReplayCli"""
+
+    kind = 'cli'
+
+    def execute(self, command, *args, **kwargs):
+        return self._replay('execute', command)['output']
+
+    def configure(self, config, *args, **kwargs):
+        request = config if isinstance(config, str) else '\n'.join(config)
+        return self._replay('configure', request)['output']
@@ -0,0 +1,293 @@
+import hashlib
+import json
+import logging
+import re
+import sys
+from requests.exceptions import RequestException
+from bubo_cache import snapshots
+from bubo_snapshot import reuse_unchanged
+from bubo_timing import resource_name, timings
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# ----------------
+# Get logger for script
+# ----------------
+
+log = logging.getLogger(__name__)
+
+NATIVE_URL = "/restconf/data/Cisco-IOS-XE-native:native"
+NATIVE_ROOT = "Cisco-IOS-XE-native:native"
+OPENCONFIG_INTERFACES_URL = "/restconf/data/openconfig-interfaces:interfaces"
+OPENCONFIG_INTERFACES_ROOT = "openconfig-interfaces:interfaces"
+
+# ----------------
+# Native subtrees checked by the testcases
+# ----------------
+# intent item, subtree under native and RESTCONF query parameters.
+# depth=3 on interface keeps the interface lists and their leafs
+# (name, description) but leaves out nested containers like addressing.
+NATIVE_SUBTREES = [
+    ('motd', 'banner/motd', None),
+    ('domain_name', 'ip/domain/name', None),
+    ('interfaces', 'interface', 'depth=3'),
+]
+
+# rest.connector raises a RequestException without a response for unexpected
+# codes, "... has returned the following code '404', instead of ...", and
+# raise_for_status() starts its message with "404 Client Error"
+ERROR_STATUS_PATTERNS = [
+    re.compile(r"has returned the following code '(\d{3})'"),
+    re.compile(r"^(\d{3}) (?:Client|Server) Error"),
+]
+
+def _status_code(error):
+    """The HTTP status of a failed request, from its response or else its message"""
+    status_code = getattr(error.response, 'status_code', None)
+    if status_code is not None:
+        return status_code
+    for pattern in ERROR_STATUS_PATTERNS:
+        match = pattern.search(f"{ error }")
+        if match:
+            return int(match.group(1))
+    return None
+
+def _decode(response):
+    """Decode a GET response, or re-raise its exception, returning {} when the resource does not exist"""
+    if isinstance(response, RequestException):
+        # rest.connector raises on non 2xx codes, a missing leaf is a 404
+        if _status_code(response) == 404:
+            return {}
+        raise response
+    if isinstance(response, Exception):
+        raise response
+    if response.status_code in (204, 404) or not response.content:
+        return {}
+    return response.json()
+
+def get_json(device, url):
+    """GET a RESTCONF resource and decode it, returning {} when it does not exist"""
+    try:
+        response = device.rest.get(url)
+    except RequestException as e:
+        response = e
+    with timings.timed(device, 'parse', resource_name(url)):
+        return _decode(response)
+
+def get_many_json(device, urls):
+    """GET several RESTCONF resources, at once when the connection supports it"""
+    if hasattr(device.rest, 'get_many'):
+        responses = device.rest.get_many(urls)
+        with timings.timed(device, 'parse', ' '.join(resource_name(url) for url in urls)):
+            return [_decode(response) for response in responses]
+    return [get_json(device, url) for url in urls]
+
+def plan_native_queries(device):
+    """Return the native subtree URLs the intent of this device needs"""
+    plan = []
+    for intent, subtree, query in NATIVE_SUBTREES:
+        # The interface checks compare both ways, so the configured
+        # interfaces are needed even without interfaces in the intent
+        if intent != 'interfaces' and device.custom.get(intent) is None:
+            continue
+        url = f"{ NATIVE_URL }/{ subtree }"
+        if query:
+            url = f"{ url }?{ query }"
+        plan.append((subtree, url))
+    return plan
+
+def fetch_native(device):
+    """Fetch the native model, either in full or only the subtrees the intent checks.
+
+    Subtrees are grafted back into a Cisco-IOS-XE-native:native document
+    so the testcases read both the same way.
+    """
+    if device.testbed.custom.get('native_fetch', 'subtree') == 'full':
+        response = device.rest.get(NATIVE_URL)
+        with timings.timed(device, 'parse', NATIVE_ROOT):
+            return response.json()
+    native = {}
+    plan = plan_native_queries(device)
+    for (subtree, url), body in zip(plan, get_many_json(device, [url for subtree, url in plan])):
+        if not body:
+            continue
+        # A subtree comes back as its last node, e.g. Cisco-IOS-XE-native:motd
+        value = next(iter(body.values()))
+        *parents, leaf = subtree.split('/')
+        node = native
+        for parent in parents:
+            node = node.setdefault(parent, {})
+        node[leaf] = value
+    return {NATIVE_ROOT: native}
+
+def native_fingerprint(device):
+    """A token that changes with the native config and the fetch plan, or None when unknown.
+
+    Uses the ETag or Last-Modified of the native datastore, or a hash of
+    the fingerprint_url resource, like a config change counter, if set.
+    """
+    url = device.testbed.custom.get('fingerprint_url')
+    try:
+        response = device.rest.get(url or f"{ NATIVE_URL }?depth=1")
+    except RequestException as e:
+        log.info(f"{ device.alias } could not be fingerprinted: { e }")
+        return None
+    headers = getattr(response, 'headers', None) or {}
+    token = headers.get('ETag') or headers.get('Last-Modified')
+    if token is None and url:
+        token = hashlib.sha256(response.content).hexdigest()
+    if token is None:
+        return None
+    if device.testbed.custom.get('native_fetch', 'subtree') == 'full':
+        plan = NATIVE_URL
+    else:
+        plan = ' '.join(url for subtree, url in plan_native_queries(device))
+    return hashlib.sha256(f"{ plan } { token }".encode()).hexdigest()
+
+# The native model, or the stored copy when the device has not changed since
+fetch_changed_native = reuse_unchanged('Cisco_IOS_XE_Native', fetch_native, native_fingerprint)
+
+def fetch_openconfig_interfaces(device):
+    # Use the RESTCONF OpenConfig YANG Model
+    response = device.rest.get(OPENCONFIG_INTERFACES_URL)
+    with timings.timed(device, 'parse', OPENCONFIG_INTERFACES_ROOT):
+        return response.json()
+
+# ----------------
+# Streamed OpenConfig interfaces
+# ----------------
+# The leafs of an OpenConfig interface the Test_Interfaces checks read,
+# None keeps the whole node
+INTERFACE_FIELDS = {
+    'name': None,
+    'config': {'name': None, 'description': None},
+    'state': {'admin-status': None, 'oper-status': None, 'counters': None},
+    'openconfig-if-ethernet:ethernet': {'state': {'negotiated-duplex-mode': None}},
+}
+
+def _keep(value):
+    # ijson makes new key strings for every entry where json.loads shares them
+    if isinstance(value, dict):
+        return {sys.intern(key): _keep(child) for key, child in value.items()}
+    if isinstance(value, list):
+        return [_keep(child) for child in value]
+    return value
+
+def _trim(node, fields):
+    trimmed = {}
+    for key, children in fields.items():
+        if key in node:
+            value = node[key]
+            trimmed[key] = _trim(value, children) if children is not None and isinstance(value, dict) else _keep(value)
+    return trimmed
+
+class _ChunkReader(object):
+    """A file-like read() over an iterator of byte chunks, for ijson"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+def iter_openconfig_interfaces(device):
+    """Yield the OpenConfig interface entries of a device one at a time.
+
+    With ijson installed and a connection that streams, like
+    bubo_async_rest.AsyncRest, each entry is decoded as its part of the
+    body arrives, so neither the whole body nor the whole document is
+    ever in memory.  Otherwise the response is decoded in one go.
+    """
+    if can_stream(device):
+        with device.rest.stream(OPENCONFIG_INTERFACES_URL) as chunks:
+            yield from ijson.items(_ChunkReader(chunks), f"{ OPENCONFIG_INTERFACES_ROOT }.interface.item", use_float=True)
+        return
+    yield from fetch_openconfig_interfaces(device)[OPENCONFIG_INTERFACES_ROOT]['interface']
+
+def stream_openconfig_interfaces(device):
+    """The OpenConfig interfaces with only the leafs the testcases check, built one entry at a time"""
+    with timings.timed(device, 'parse', f"{ OPENCONFIG_INTERFACES_ROOT } streamed"):
+        interfaces = [_trim(entry, INTERFACE_FIELDS) for entry in iter_openconfig_interfaces(device)]
+    return {OPENCONFIG_INTERFACES_ROOT: {'interface': interfaces}}
+
+def can_stream(device):
+    return ijson is not None and hasattr(device.rest, 'stream')
+
+def fetch_interfaces(device):
+    """The OpenConfig interfaces, streamed and trimmed when openconfig_streaming is set and possible.
+
+    A streamed document only holds INTERFACE_FIELDS, and so do the
+    OpenConfig_Interfaces snapshots written from it.
+    """
+    # Trimming a document decoded in one go would only add to its peak memory
+    if device.testbed.custom.get('openconfig_streaming', False) and can_stream(device):
+        return stream_openconfig_interfaces(device)
+    return fetch_openconfig_interfaces(device)
+
+# ----------------
+# Batched remediation
+# ----------------
+class YangPatch(object):
+    """Leaf changes for one device merged into as few PATCH requests as possible.
+
+    Each change is a path of nodes below the root and a value; list
+    entries are appended to the list at their path.  send() merges the
+    changes into one document, or one per chunk_size changes, and
+    reports the outcome of every change.
+    """
+
+    def __init__(self, url, root):
+        self.url = url
+        self.root = root
+        self.changes = []
+
+    def __len__(self):
+        return len(self.changes)
+
+    def add(self, label, path, value, list_entry=False):
+        self.changes.append((label, path, value, list_entry))
+
+    def documents(self, chunk_size=None):
+        """Yield the change labels and merged PATCH document of every chunk"""
+        chunk_size = chunk_size or max(len(self.changes), 1)
+        for start in range(0, len(self.changes), chunk_size):
+            chunk = self.changes[start:start + chunk_size]
+            document = {self.root: {}}
+            for label, path, value, list_entry in chunk:
+                node = document[self.root]
+                *parents, leaf = path
+                for parent in parents:
+                    node = node.setdefault(parent, {})
+                if list_entry:
+                    node.setdefault(leaf, []).append(value)
+                else:
+                    node[leaf] = value
+            yield [change[0] for change in chunk], document
+
+    def send(self, device, chunk_size=None):
+        """PATCH every chunk and return (label, status code, succeeded) per change"""
+        outcomes = []
+        for labels, document in self.documents(chunk_size):
+            try:
+                response = device.rest.patch(self.url, payload=json.dumps(document))
+                status, succeeded = response.status_code, response.ok
+            except RequestException as e:
+                status, succeeded = getattr(e.response, 'status_code', None) or str(e), False
+            log.info(f"The PATCH of { len(labels) } changes to { self.url } status code was { status }")
+            outcomes.extend((label, status, succeeded) for label in labels)
+        if self.changes:
+            snapshots.invalidate(device)
+        return outcomes
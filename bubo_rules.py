@@ -0,0 +1,197 @@
+import argparse
+import logging
+from tabulate import tabulate
+from bubo_timing import timings
+
+# ----------------
+# Get logger for script
+# ----------------
+
+log = logging.getLogger(__name__)
+
+_MISSING = object()
+_RULES = object()
+
+# ----------------
+# Declarative intent rules
+# ----------------
+COMPARATORS = {
+    # The configured value is the intended value
+    'equals': lambda actual, expected: actual == expected,
+    # The node is keyed by config lines, like learn("config"), and has the intended line
+    'has_line': lambda actual, expected: isinstance(actual, dict) and expected in actual,
+}
+
+class IntentRule(object):
+    """A check of one node of a snapshot against one item of the device intent.
+
+    path is the node as keys separated by /, intent the item under the
+    device custom:, expect a template of the expected value made from
+    the intent and compare a name in COMPARATORS.  remediation is what
+    the testcase sends to fix a failure: a YangPatch path tuple for
+    RESTCONF or a config line template for SSH.  display 'value' logs
+    the intended and configured values, 'match' only whether they match.
+    """
+
+    def __init__(self, name, column, path, intent, compare='equals', expect='{intent}',
+                 remediation=None, display='value'):
+        self.name = name
+        self.column = column
+        self.keys = tuple(key for key in path.split('/') if key)
+        self.intent = intent
+        self.compare = COMPARATORS[compare]
+        self.expect = expect
+        self.remediation = remediation
+        self.display = display
+
+class RuleResult(object):
+    def __init__(self, rule, device_alias, intended, expected, actual, passed):
+        self.rule = rule
+        self.device_alias = device_alias
+        self.intended = intended
+        self.expected = expected
+        self.actual = actual
+        self.passed = passed
+
+    def table_row(self):
+        if self.rule.display == 'match':
+            if self.passed:
+                return [self.device_alias, 'Matches Intent', 'Passed']
+            state = 'Not Configured' if self.actual is _MISSING else 'Differs From Intent'
+            return [self.device_alias, state, 'Failed']
+        if self.rule.compare is COMPARATORS['has_line']:
+            configured = self.intended if self.passed else 'Not Configured'
+        else:
+            configured = 'Not Configured' if self.actual is _MISSING else self.actual
+        return [self.device_alias, self.intended, configured, 'Passed' if self.passed else 'Failed']
+
+    def headers(self):
+        if self.rule.display == 'match':
+            return ['Device', self.rule.column, 'Passed/Failed']
+        return ['Device', f"Intent { self.rule.column }", f"Configured { self.rule.column }", 'Passed/Failed']
+
+class RuleSet(object):
+    """Rules compiled into one tree of snapshot keys.
+
+    Rules that share a path prefix share the walk down it, so a snapshot
+    is traversed once however many rules read it.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self._tree = {}
+        for rule in self.rules:
+            node = self._tree
+            for key in rule.keys:
+                node = node.setdefault(key, {})
+            node.setdefault(_RULES, []).append(rule)
+
+    def _collect(self, node, value, found):
+        for key, child in node.items():
+            if key is _RULES:
+                for rule in child:
+                    found[rule.name] = value
+            else:
+                self._collect(child, value.get(key, _MISSING) if isinstance(value, dict) else _MISSING, found)
+
+    def evaluate(self, device_alias, intent, snapshot):
+        """Return a RuleResult per rule name, or None for rules the intent has no item for"""
+        found = {}
+        self._collect(self._tree, snapshot, found)
+        results = {}
+        for rule in self.rules:
+            intended = intent.get(rule.intent)
+            if intended is None:
+                results[rule.name] = None
+                continue
+            expected = rule.expect.format(intent=intended)
+            actual = found[rule.name]
+            results[rule.name] = RuleResult(rule, device_alias, intended, expected, actual,
+                                            actual is not _MISSING and rule.compare(actual, expected))
+        return results
+
+    def evaluate_fleet(self, snapshots):
+        """Evaluate (device alias, intent, snapshot) of many devices, returning results per rule name"""
+        fleet = {rule.name: [] for rule in self.rules}
+        for device_alias, intent, snapshot in snapshots:
+            for name, result in self.evaluate(device_alias, intent, snapshot).items():
+                if result is not None:
+                    fleet[name].append(result)
+        return fleet
+
+NATIVE_RULES = RuleSet([
+    IntentRule('motd', 'MOTD Banner', 'Cisco-IOS-XE-native:native/banner/motd/banner', 'motd',
+               remediation=('banner', 'motd', 'banner'), display='match'),
+    IntentRule('domain_name', 'Domain Name', 'Cisco-IOS-XE-native:native/ip/domain/name', 'domain_name',
+               remediation=('ip', 'domain', 'name')),
+])
+
+LEARNED_CONFIG_RULES = RuleSet([
+    IntentRule('domain_name', 'Domain Name', '', 'domain_name', compare='has_line',
+               expect='ip domain name {intent}', remediation='ip domain name {intent}'),
+])
+
+# Snapshot model the rules of each script read, for offline evaluation
+RULESETS = {
+    'native': ('Cisco_IOS_XE_Native', NATIVE_RULES),
+    'learned_config': ('Cisco_IOS_XE_Learned_Config', LEARNED_CONFIG_RULES),
+}
+
+# ----------------
+# Report a rule from a test section
+# ----------------
+def report_rule(section, result):
+    """Log the result of a rule for one device, record a failure and pass or fail the section"""
+    if result is None:
+        section.skipped('No intent for this check')
+    with timings.timed(section.device, 'report', result.rule.name):
+        log.info(tabulate([result.table_row()],
+                            headers=result.headers(),
+                            tablefmt='orgtbl'))
+    if result.passed:
+        section.passed(f"Device { result.rule.column } matches the intent")
+    else:
+        section.failed_rules[result.rule.name] = result
+        section.failed(f"Device { result.rule.column } does not match the intent")
+
+# ----------------
+# Evaluate stored snapshots without devices
+# ----------------
+def evaluate_stored(args):
+    import yaml
+    from bubo_snapshot import SnapshotStore
+    with open(args.intent) as f:
+        intent = yaml.safe_load(f)
+    model, rules = RULESETS[args.ruleset]
+    store = SnapshotStore(args.store)
+    snapshots = []
+    for name, device in (intent.get('devices') or {}).items():
+        snapshot = store.latest(name, model)
+        if snapshot is None:
+            log.warning(f"No stored { model } snapshot for { name }")
+            continue
+        snapshots.append((name, (device or {}).get('custom') or {}, snapshot))
+    failures = 0
+    for name, results in rules.evaluate_fleet(snapshots).items():
+        if not results:
+            continue
+        print(tabulate([result.table_row() for result in results],
+                        headers=results[0].headers(),
+                        tablefmt='orgtbl'))
+        failures += sum(not result.passed for result in results)
+    print(f"{ len(snapshots) } devices evaluated, { failures } failed checks")
+    return 1 if failures else 0
+
+def main():
+    parser = argparse.ArgumentParser(description='bubo intent rules')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    evaluate = subparsers.add_parser('evaluate', help='evaluate the intent against the latest stored snapshots')
+    evaluate.add_argument('--intent', default='intent_REST.yaml')
+    evaluate.add_argument('--ruleset', choices=sorted(RULESETS), default='native')
+    evaluate.add_argument('--store', default='JSON/store')
+    evaluate.set_defaults(func=evaluate_stored)
+    args = parser.parse_args()
+    raise SystemExit(args.func(args))
+
+if __name__ == '__main__':
+    main()
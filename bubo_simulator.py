@@ -0,0 +1,335 @@
+import argparse
+import copy
+import json
+import logging
+import os
+import random
+import resource
+import selectors
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs, unquote
+
+# ----------------
+# Get logger for script
+# ----------------
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BASE_PORT = 18000
+DATA_PREFIX = '/restconf/data/'
+STATS_PATH = '/bubo-simulator/stats'
+MOTD = "\nWelcome to a simulated IOS XE device\n"
+DOMAIN_NAME = 'sim.bubo.local'
+
+# ----------------
+# Simulated device data
+# ----------------
+class SimulatedDevice(object):
+    """The intent and the RESTCONF datastore of one simulated device.
+
+    A drift share of the interfaces is missing from the native config,
+    has no OpenConfig description and counts input errors, and the MOTD
+    and domain name drift with the same odds.  The same name, counts and
+    seed always give the same device, so the testbed generator and the
+    server agree without sharing any state.
+    """
+
+    def __init__(self, name, interfaces, drift=0.1, seed=0):
+        self.name = name
+        rng = random.Random(f"{ seed } { name }")
+        self.intent = {'motd': MOTD, 'domain_name': DOMAIN_NAME}
+        self.interfaces = {}
+        native_interfaces = []
+        openconfig_interfaces = []
+        for number in range(1, interfaces + 1):
+            interface = f"GigabitEthernet{ number }"
+            description = f"Simulated interface { number }"
+            self.interfaces[interface] = {'type': 'ethernet', 'description': description}
+            drifted = rng.random() < drift
+            if not drifted:
+                native_interfaces.append({'name': f"{ number }", 'description': description,
+                                          'ip': {'address': {'primary': {'address': f"10.{ number // 65536 }.{ number // 256 % 256 }.{ number % 256 }",
+                                                                         'mask': '255.255.255.0'}}}})
+            config = {'name': interface, 'type': 'iana-if-type:ethernetCsmacd', 'enabled': True}
+            if not drifted:
+                config['description'] = description
+            openconfig_interfaces.append({
+                'name': interface,
+                'config': config,
+                'state': {'name': interface, 'admin-status': 'UP', 'oper-status': 'UP',
+                          'counters': {'in-octets': '987654321', 'in-unicast-pkts': '1234567',
+                                       'in-broadcast-pkts': '1234', 'in-multicast-pkts': '5678',
+                                       'in-discards': '0', 'in-errors': f"{ rng.randint(1, 50) if drifted else 0 }",
+                                       'in-fcs-errors': '0', 'in-unknown-protos': '0',
+                                       'out-octets': '123456789', 'out-unicast-pkts': '7654321',
+                                       'out-broadcast-pkts': '12', 'out-multicast-pkts': '34',
+                                       'out-discards': '0', 'out-errors': '0'}},
+                'openconfig-if-ethernet:ethernet': {'state': {'negotiated-duplex-mode': 'FULL'}},
+            })
+        self.datastore = {
+            'Cisco-IOS-XE-native:native': {
+                'version': '17.9',
+                'banner': {'motd': {'banner': MOTD if rng.random() >= drift else 'Unauthorised access prohibited'}},
+                'ip': {'domain': {'name': DOMAIN_NAME if rng.random() >= drift else 'drifted.bubo.local'}},
+                'interface': {'GigabitEthernet': native_interfaces},
+            },
+            'openconfig-interfaces:interfaces': {'interface': openconfig_interfaces},
+        }
+        self.version = 1
+        self.lock = threading.Lock()
+        self._encoded = {}
+
+def simulated_devices(count, interfaces, drift=0.1, seed=0):
+    return [SimulatedDevice(f"sim-{ number:05d}", interfaces, drift, seed) for number in range(1, count + 1)]
+
+# ----------------
+# RESTCONF resources
+# ----------------
+def _prune(value, depth):
+    """Keep depth levels of a node like the RESTCONF depth query, list entries count as their list"""
+    if isinstance(value, list):
+        return [_prune(entry, depth) for entry in value]
+    if not isinstance(value, dict):
+        return value
+    if depth <= 1:
+        return {}
+    return {key: _prune(child, depth - 1) for key, child in value.items()}
+
+def _resolve(datastore, path):
+    """Return (parent, key, value) of a resource path like Cisco-IOS-XE-native:native/banner/motd"""
+    segments = [unquote(segment) for segment in path.split('/') if segment]
+    if not segments or segments[0] not in datastore:
+        raise KeyError(path)
+    parent, key = datastore, segments[0]
+    for segment in segments[1:]:
+        node = parent[key]
+        name, _, entry_key = segment.partition('=')
+        if isinstance(node, dict) and name in node:
+            parent, key = node, name
+            if entry_key:
+                entries = node[name]
+                position = next(position for position, entry in enumerate(entries)
+                                if f"{ entry.get('name') }" == entry_key)
+                parent, key = entries, position
+        else:
+            raise KeyError(path)
+    return parent, key, parent[key]
+
+def _merge(node, change):
+    """Merge a PATCH document into a node, matching list entries by name"""
+    for key, value in change.items():
+        current = node.get(key)
+        if isinstance(current, dict) and isinstance(value, dict):
+            _merge(current, value)
+        elif isinstance(current, list) and isinstance(value, list):
+            entries = {entry.get('name'): entry for entry in current if isinstance(entry, dict)}
+            for entry in value:
+                if isinstance(entry, dict) and entry.get('name') in entries:
+                    _merge(entries[entry['name']], entry)
+                else:
+                    current.append(entry)
+        else:
+            node[key] = copy.deepcopy(value)
+
+class RestconfHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        log.debug(f"{ self.server.device.name } { format % args }")
+
+    def _send(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/yang-data+json')
+        self.send_header('Content-Length', f"{ len(body) }")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _target(self):
+        url = urlsplit(self.path)
+        if not url.path.startswith(DATA_PREFIX):
+            return None, None
+        return url.path[len(DATA_PREFIX):], parse_qs(url.query)
+
+    def do_GET(self):
+        device = self.server.device
+        self.server.simulator.count()
+        if self.path == STATS_PATH:
+            self._send(200, json.dumps({'requests': self.server.simulator.requests}).encode())
+            return
+        path, query = self._target()
+        if path is None:
+            self._send(404)
+            return
+        cache_key = (path, f"{ query }")
+        with device.lock:
+            etag = f'"{ device.version }"'
+            body = device._encoded.get(cache_key)
+            if body is None:
+                try:
+                    parent, key, value = _resolve(device.datastore, path)
+                except (KeyError, StopIteration):
+                    self._send(404)
+                    return
+                if 'depth' in query:
+                    value = _prune(value, int(query['depth'][0]))
+                # A resource comes back as its last node with the module prefix of the path
+                module = path.split(':', 1)[0]
+                name = path.rstrip('/').rsplit('/', 1)[-1].partition('=')[0]
+                name = name if ':' in name else f"{ module }:{ name }"
+                body = json.dumps({name: [value] if isinstance(key, int) else value}).encode()
+                device._encoded[cache_key] = body
+        self._send(200, body, {'ETag': etag})
+
+    def _change(self, replace):
+        device = self.server.device
+        self.server.simulator.count()
+        path, query = self._target()
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            document = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self._send(400)
+            return
+        if path is None:
+            self._send(404)
+            return
+        with device.lock:
+            try:
+                parent, key, value = _resolve(device.datastore, path)
+            except (KeyError, StopIteration):
+                self._send(404)
+                return
+            change = next(iter(document.values()), {})
+            if replace or not isinstance(value, dict):
+                parent[key] = change
+            else:
+                _merge(value, change)
+            device.version += 1
+            device._encoded.clear()
+        self._send(204)
+
+    def do_PATCH(self):
+        self._change(replace=False)
+
+    def do_PUT(self):
+        self._change(replace=True)
+
+class DeviceServer(ThreadingMixIn, HTTPServer):
+    """One listening port of one simulated device"""
+
+    daemon_threads = True
+    block_on_close = False
+    request_queue_size = 128
+    timeout = 0
+
+    def __init__(self, address, device, simulator):
+        self.device = device
+        self.simulator = simulator
+        super().__init__(address, RestconfHandler)
+
+class Simulator(object):
+    """Serve simulated devices on consecutive loopback ports from one selector loop"""
+
+    def __init__(self, devices, host='127.0.0.1', base_port=DEFAULT_BASE_PORT):
+        self.devices = devices
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        # Every port and keep-alive session is a file descriptor
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        self.servers = [DeviceServer((host, base_port + number), device, self)
+                        for number, device in enumerate(devices)]
+
+    def count(self):
+        with self._lock:
+            self.requests += 1
+
+    def serve_forever(self):
+        with selectors.DefaultSelector() as selector:
+            for server in self.servers:
+                selector.register(server, selectors.EVENT_READ)
+            while not self._stopped.is_set():
+                for key, events in selector.select(timeout=0.5):
+                    key.fileobj.handle_request()
+        for server in self.servers:
+            server.server_close()
+
+    def stop(self):
+        self._stopped.set()
+
+# ----------------
+# Testbed and intent files
+# ----------------
+def write_testbed(devices, directory, host='127.0.0.1', base_port=DEFAULT_BASE_PORT,
+                  connection_class='rest.connector.Rest', settings=None):
+    """Write testbed_SIM.yaml and intent_SIM.yaml for the simulated devices, returning the intent path"""
+    import yaml
+    os.makedirs(directory, exist_ok=True)
+    testbed = {'devices': {}, 'topology': {}}
+    intent = {'extends': 'testbed_SIM.yaml',
+              'testbed': {'custom': dict(settings or {})},
+              'devices': {}}
+    for number, device in enumerate(devices):
+        testbed['devices'][device.name] = {
+            'alias': device.name,
+            'type': 'router',
+            'os': 'iosxe',
+            'platform': 'csr1000v',
+            'connections': {'rest': {'class': connection_class, 'ip': host, 'port': base_port + number,
+                                     'protocol': 'http',
+                                     'credentials': {'rest': {'username': 'bubo', 'password': 'bubo'}}}},
+        }
+        testbed['topology'][device.name] = {'interfaces': device.interfaces}
+        intent['devices'][device.name] = {'custom': device.intent}
+    with open(os.path.join(directory, 'testbed_SIM.yaml'), 'w') as f:
+        yaml.safe_dump(testbed, f, default_flow_style=False, sort_keys=False)
+    path = os.path.join(directory, 'intent_SIM.yaml')
+    with open(path, 'w') as f:
+        yaml.safe_dump(intent, f, default_flow_style=False, sort_keys=False)
+    return path
+
+def add_fleet_arguments(parser):
+    parser.add_argument('--drift', type=float, default=0.1, help='share of interfaces and settings that differ from the intent')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--base-port', type=int, default=DEFAULT_BASE_PORT)
+
+def generate(args):
+    devices = simulated_devices(args.devices, args.interfaces, args.drift, args.seed)
+    path = write_testbed(devices, args.output_dir, base_port=args.base_port, connection_class=args.connection_class)
+    print(f"Wrote { path } for { len(devices) } devices on ports { args.base_port }-{ args.base_port + len(devices) - 1 }")
+
+def serve(args):
+    devices = simulated_devices(args.devices, args.interfaces, args.drift, args.seed)
+    simulator = Simulator(devices, base_port=args.base_port)
+    print(f"Serving { len(devices) } devices on 127.0.0.1 ports { args.base_port }-{ args.base_port + len(devices) - 1 }")
+    try:
+        simulator.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description='bubo RESTCONF fleet simulator')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    testbed = subparsers.add_parser('testbed', help='write the testbed and intent YAML of a simulated fleet')
+    testbed.add_argument('--devices', type=int, default=10)
+    testbed.add_argument('--interfaces', type=int, default=100)
+    add_fleet_arguments(testbed)
+    testbed.add_argument('--output-dir', default='simulator')
+    testbed.add_argument('--connection-class', default='rest.connector.Rest')
+    testbed.set_defaults(func=generate)
+    serving = subparsers.add_parser('serve', help='serve the simulated fleet until interrupted')
+    serving.add_argument('--devices', type=int, default=10)
+    serving.add_argument('--interfaces', type=int, default=100)
+    add_fleet_arguments(serving)
+    serving.set_defaults(func=serve)
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
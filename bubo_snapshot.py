@@ -0,0 +1,265 @@
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import closing
+from datetime import datetime
+from bubo_timing import timings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# ----------------
+# Get logger for script
+# ----------------
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SNAPSHOT_STORE = 'JSON/store'
+
+# ----------------
+# JSON snapshot files
+# ----------------
+WRITE_BUFFER = 1024 * 1024
+
+def write_json(path, obj, compact=False, backend='json'):
+    """Write obj to path as JSON without building the whole document in memory first.
+
+    The json backend streams the encoder chunks straight into a buffered
+    file.  orjson, when installed, encodes in one fast call to bytes,
+    which is still far smaller than the indented str json.dumps builds.
+    """
+    if backend == 'orjson' and orjson is not None:
+        option = orjson.OPT_SORT_KEYS | (0 if compact else orjson.OPT_INDENT_2)
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(obj, option=option))
+        return
+    with open(path, 'w', buffering=WRITE_BUFFER) as f:
+        if compact:
+            json.dump(obj, f, separators=(',', ':'), sort_keys=True)
+        else:
+            json.dump(obj, f, indent=4, sort_keys=True)
+
+# ----------------
+# Content addressed snapshot store
+# ----------------
+class SnapshotStore(object):
+    """Compressed snapshots keyed by device, model, stage and time.
+
+    Every document is stored once under the sha256 of its canonical JSON
+    (sorted keys, no whitespace) in objects/, compressed with zstd when
+    zstandard is installed and gzip otherwise.  A sqlite index maps each
+    snapshot to its object, so history is listed without reading objects
+    and a device that did not change between runs costs one index row.
+    """
+
+    def __init__(self, root=DEFAULT_SNAPSHOT_STORE):
+        self.root = root
+        self.objects = os.path.join(root, 'objects')
+        os.makedirs(self.objects, exist_ok=True)
+        self.index = os.path.join(root, 'index.db')
+        with closing(self._connect()) as db, db:
+            db.execute('CREATE TABLE IF NOT EXISTS snapshots (id INTEGER PRIMARY KEY, device TEXT, model TEXT, '
+                       'stage TEXT, timestamp REAL, digest TEXT, size INTEGER, fingerprint TEXT)')
+            db.execute('CREATE INDEX IF NOT EXISTS snapshots_key ON snapshots (device, model, stage, timestamp)')
+
+    def _connect(self):
+        # The connection context manager only commits, closing() closes it
+        return sqlite3.connect(self.index, timeout=30)
+
+    def _object_path(self, digest, compression):
+        return os.path.join(self.objects, digest[:2], f"{ digest[2:] }.json.{ compression }")
+
+    def _find_object(self, digest):
+        for compression in ('zst', 'gz'):
+            path = self._object_path(digest, compression)
+            if os.path.exists(path):
+                return path, compression
+        return None, None
+
+    def _open_writer(self, f):
+        if zstandard is not None:
+            return zstandard.ZstdCompressor(level=10).stream_writer(f), 'zst'
+        return gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6, mtime=0), 'gz'
+
+    def put(self, device_name, model, stage, obj, timestamp=None, fingerprint=None):
+        """Store obj and index it, returning (digest, stored) where stored is False for a duplicate"""
+        digest = hashlib.sha256()
+        size = 0
+        # Hash and compress the canonical encoding chunk by chunk into a
+        # temporary file that only becomes an object if it is new
+        with tempfile.NamedTemporaryFile(dir=self.objects, delete=False) as f:
+            writer, compression = self._open_writer(f)
+            for chunk in json.JSONEncoder(separators=(',', ':'), sort_keys=True).iterencode(obj):
+                data = chunk.encode()
+                digest.update(data)
+                writer.write(data)
+                size += len(data)
+            writer.close()
+        digest = digest.hexdigest()
+        stored = self._find_object(digest)[0] is None
+        if stored:
+            path = self._object_path(digest, compression)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(f.name, path)
+        else:
+            os.remove(f.name)
+        with closing(self._connect()) as db, db:
+            db.execute('INSERT INTO snapshots (device, model, stage, timestamp, digest, size, fingerprint) '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       (device_name, model, stage, timestamp or time.time(), digest, size, fingerprint))
+        return digest, stored
+
+    def list(self, device=None, model=None, stage=None, limit=None):
+        """Return index rows (id, device, model, stage, timestamp, digest, size), newest first"""
+        query = 'SELECT id, device, model, stage, timestamp, digest, size FROM snapshots'
+        filters = [(column, value) for column, value in (('device', device), ('model', model), ('stage', stage))
+                   if value is not None]
+        if filters:
+            query += ' WHERE ' + ' AND '.join(f"{ column } = ?" for column, value in filters)
+        query += ' ORDER BY timestamp DESC, id DESC'
+        if limit:
+            query += f" LIMIT { int(limit) }"
+        with closing(self._connect()) as db, db:
+            return db.execute(query, [value for column, value in filters]).fetchall()
+
+    def load_object(self, digest):
+        path, compression = self._find_object(digest)
+        if path is None:
+            raise KeyError(f"No snapshot object { digest }")
+        if compression == 'zst':
+            with open(path, 'rb') as f:
+                return json.load(zstandard.ZstdDecompressor().stream_reader(f))
+        with gzip.open(path, 'rt') as f:
+            return json.load(f)
+
+    def load(self, snapshot_id):
+        """Load a snapshot by its index id"""
+        with closing(self._connect()) as db, db:
+            row = db.execute('SELECT digest FROM snapshots WHERE id = ?', (snapshot_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"No snapshot { snapshot_id }")
+        return self.load_object(row[0])
+
+    def latest(self, device, model, stage=None):
+        """Load the newest snapshot of a device model, or None"""
+        rows = self.list(device, model, stage, limit=1)
+        return self.load_object(rows[0][5]) if rows else None
+
+    def find(self, device, model, fingerprint):
+        """Return (timestamp, digest) of the newest snapshot fetched at a fingerprint, or None"""
+        with closing(self._connect()) as db, db:
+            return db.execute('SELECT timestamp, digest FROM snapshots WHERE device = ? AND model = ? AND fingerprint = ? '
+                              'ORDER BY timestamp DESC, id DESC LIMIT 1', (device, model, fingerprint)).fetchone()
+
+    def disk_usage(self):
+        total = 0
+        for directory, subdirectories, files in os.walk(self.objects):
+            total += sum(os.path.getsize(os.path.join(directory, name)) for name in files)
+        return total
+
+_stores = {}
+
+def snapshot_store(root=DEFAULT_SNAPSHOT_STORE):
+    """The SnapshotStore for a directory, opened once per process"""
+    if root not in _stores:
+        _stores[root] = SnapshotStore(root)
+    return _stores[root]
+
+def write_snapshot(device, model, stage, obj):
+    """Record a device snapshot in JSON/<alias>_<model>_<stage>.json and, when snapshot_store is set, the store"""
+    settings = device.testbed.custom
+    store = settings.get('snapshot_store')
+    with timings.timed(device, 'serialize', f"{ model } { stage }"):
+        if store:
+            snapshot_store(store).put(device.name, model, stage, obj)
+        if settings.get('snapshot_files', True):
+            write_json(f"JSON/{ device.alias }_{ model }_{ stage }.json", obj,
+                       compact=bool(settings.get('snapshot_compact', False)),
+                       backend=settings.get('snapshot_json_backend') or 'json')
+
+# ----------------
+# Skip unchanged devices
+# ----------------
+def reuse_unchanged(model, fetch, fingerprint):
+    """Wrap fetch(device) to reuse the stored snapshot when the device fingerprint has not changed.
+
+    fingerprint(device) returns a cheap token that changes whenever the
+    data fetch returns would, or None when it cannot tell, which always
+    fetches.  Only active with fingerprint_skip set and a snapshot store.
+    """
+    def fetch_or_reuse(device):
+        settings = device.testbed.custom
+        root = settings.get('snapshot_store')
+        if not settings.get('fingerprint_skip', False) or not root:
+            return fetch(device)
+        store = snapshot_store(root)
+        current = fingerprint(device)
+        if current is not None:
+            found = store.find(device.name, model, current)
+            if found is not None:
+                try:
+                    data = store.load_object(found[1])
+                except KeyError:
+                    log.warning(f"{ device.alias } stored { model } snapshot is missing, fetching it again")
+                else:
+                    log.info(f"{ device.alias } { model } unchanged since "
+                             f"{ datetime.fromtimestamp(found[0]).isoformat(timespec='seconds') }, reusing the stored snapshot")
+                    return data
+        data = fetch(device)
+        if current is not None:
+            store.put(device.name, model, 'FETCHED', data, fingerprint=current)
+        return data
+    return fetch_or_reuse
+
+# ----------------
+# Browse the store
+# ----------------
+def list_snapshots(args):
+    from tabulate import tabulate
+    store = SnapshotStore(args.store)
+    table_data = [[snapshot_id, device, model, stage,
+                   datetime.fromtimestamp(timestamp).isoformat(timespec='seconds'), digest[:12], size]
+                  for snapshot_id, device, model, stage, timestamp, digest, size
+                  in store.list(args.device, args.model, args.stage, args.limit)]
+    print(tabulate(table_data,
+                    headers=['Id', 'Device', 'Model', 'Stage', 'Time', 'Object', 'Bytes'],
+                    tablefmt='orgtbl'))
+    print(f"{ len(store.list()) } snapshots in { store.disk_usage() } bytes of objects")
+
+def show_snapshot(args):
+    store = SnapshotStore(args.store)
+    json.dump(store.load(args.id), sys.stdout, indent=4, sort_keys=True)
+    print()
+
+def main():
+    parser = argparse.ArgumentParser(description='bubo snapshot store')
+    parser.add_argument('--store', default=DEFAULT_SNAPSHOT_STORE)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    listing = subparsers.add_parser('list', help='list stored snapshots, newest first')
+    listing.add_argument('--device')
+    listing.add_argument('--model')
+    listing.add_argument('--stage')
+    listing.add_argument('--limit', type=int)
+    listing.set_defaults(func=list_snapshots)
+    show = subparsers.add_parser('show', help='print a stored snapshot')
+    show.add_argument('id', type=int)
+    show.set_defaults(func=show_snapshot)
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
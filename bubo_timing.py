@@ -0,0 +1,221 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager, ExitStack
+from tabulate import tabulate
+
+# ----------------
+# Get logger for script
+# ----------------
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TIMINGS_JSONL = 'JSON/bubo_timings.jsonl'
+DEFAULT_TIMINGS_PROMETHEUS = 'JSON/bubo_timings.prom'
+
+_context = threading.local()
+
+def set_testcase(name):
+    """Attribute the timings of this thread to a testcase until the next call"""
+    _context.testcase = name
+
+def current_testcase():
+    testcase = getattr(_context, 'testcase', None)
+    if testcase is None:
+        # Worker threads only run the prefetch, the main thread starts in common setup
+        testcase = 'common_setup' if threading.current_thread() is threading.main_thread() else 'prefetch'
+    return testcase
+
+def _open_spans():
+    if not hasattr(_context, 'spans'):
+        _context.spans = []
+    return _context.spans
+
+# ----------------
+# Stage timings of a run
+# ----------------
+class Timings(object):
+    """Seconds spent per device, testcase and stage of a run.
+
+    kind groups the stages: io for device calls, parse, serialize,
+    evaluate, report and diff.  A span that contains other spans, like a
+    learn() around its show commands, is recorded without their time, so
+    every second is counted once however the spans nest.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.samples = []
+        self._lock = threading.Lock()
+
+    def record(self, device_name, kind, stage, seconds, testcase=None):
+        sample = (device_name, testcase or current_testcase(), kind, stage, seconds)
+        with self._lock:
+            self.samples.append(sample)
+
+    @contextmanager
+    def timed(self, device, kind, stage):
+        spans = _open_spans()
+        spans.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = spans.pop()
+            if spans:
+                spans[-1] += elapsed
+            self.record(getattr(device, 'name', device), kind, stage, elapsed - nested)
+
+    def totals(self):
+        """Seconds and calls per (device, testcase, kind, stage)"""
+        totals = {}
+        with self._lock:
+            samples = list(self.samples)
+        for device_name, testcase, kind, stage, seconds in samples:
+            total = totals.setdefault((device_name, testcase, kind, stage), [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+        return totals
+
+    def write_jsonl(self, path):
+        """Append every sample of the run as a JSON line"""
+        with self._lock:
+            samples = list(self.samples)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'a') as f:
+            for device_name, testcase, kind, stage, seconds in samples:
+                f.write(json.dumps({'run': self.started, 'device': device_name, 'testcase': testcase,
+                                    'kind': kind, 'stage': stage, 'seconds': round(seconds, 6)}) + '\n')
+
+    def write_prometheus(self, path):
+        """Write the run totals in the node_exporter textfile format, replacing the last run"""
+        lines = ['# HELP bubo_stage_seconds Seconds bubo spent per device, testcase and stage in its last run',
+                 '# TYPE bubo_stage_seconds gauge']
+        totals = self.totals()
+        for (device_name, testcase, kind, stage), (seconds, calls) in sorted(totals.items()):
+            lines.append(f"bubo_stage_seconds{{{ _labels(device_name, testcase, kind, stage) }}} { seconds:.6f}")
+        lines += ['# HELP bubo_stage_calls Timed calls per device, testcase and stage in the last bubo run',
+                  '# TYPE bubo_stage_calls gauge']
+        for (device_name, testcase, kind, stage), (seconds, calls) in sorted(totals.items()):
+            lines.append(f"bubo_stage_calls{{{ _labels(device_name, testcase, kind, stage) }}} { calls }")
+        lines += ['# HELP bubo_run_start_timestamp_seconds Start of the last bubo run',
+                  '# TYPE bubo_run_start_timestamp_seconds gauge',
+                  f"bubo_run_start_timestamp_seconds { self.started:.3f}"]
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # The collector must never read a half written file
+        temporary = f"{ path }.{ os.getpid() }.tmp"
+        with open(temporary, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temporary, path)
+
+    def log_summary(self, count=10):
+        """Log the devices and stages that took longest"""
+        devices = {}
+        stages = {}
+        for (device_name, testcase, kind, stage), (seconds, calls) in self.totals().items():
+            devices[device_name] = devices.get(device_name, 0.0) + seconds
+            total = stages.setdefault((testcase, kind, stage), [0.0, 0, 0.0])
+            total[0] += seconds
+            total[1] += calls
+            total[2] = max(total[2], seconds)
+        log.info(tabulate([[name, f"{ seconds:.3f}"]
+                           for name, seconds in sorted(devices.items(), key=lambda item: -item[1])[:count]],
+                          headers=['Slowest Devices', 'Seconds'],
+                          tablefmt='orgtbl'))
+        log.info(tabulate([[testcase, kind, stage, f"{ seconds:.3f}", calls, f"{ slowest:.3f}"]
+                           for (testcase, kind, stage), (seconds, calls, slowest)
+                           in sorted(stages.items(), key=lambda item: -item[1][0])[:count]],
+                          headers=['Testcase', 'Kind', 'Slowest Stages', 'Seconds', 'Calls', 'Slowest Device (s)'],
+                          tablefmt='orgtbl'))
+
+def _label(value):
+    return f"{ value }".replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(device_name, testcase, kind, stage):
+    return (f'device="{ _label(device_name) }",testcase="{ _label(testcase) }",'
+            f'kind="{ _label(kind) }",stage="{ _label(stage) }"')
+
+timings = Timings()
+
+# ----------------
+# Time device calls
+# ----------------
+def _timed_call(device, target, method, stage):
+    """Replace a connection call with one timed as io, stage(request) names the stage"""
+    send = getattr(target, method)
+
+    def timed(request, *args, **kwargs):
+        with timings.timed(device, 'io', stage(request)):
+            return send(request, *args, **kwargs)
+
+    setattr(target, method, timed)
+
+def _timed_stream(device, target):
+    """Replace stream() with one timing the request and every chunk read as a single io call"""
+    send = target.stream
+
+    @contextmanager
+    def timed(api_url, *args, **kwargs):
+        spent = []
+
+        def _io(step, *step_args):
+            # Time spent waiting on the device, less from whatever span reads the stream
+            start = time.perf_counter()
+            try:
+                return step(*step_args)
+            finally:
+                elapsed = time.perf_counter() - start
+                spent.append(elapsed)
+                spans = _open_spans()
+                if spans:
+                    spans[-1] += elapsed
+
+        def _timed_chunks(chunks):
+            chunks = iter(chunks)
+            while True:
+                chunk = _io(next, chunks, None)
+                if chunk is None:
+                    return
+                yield chunk
+
+        try:
+            with ExitStack() as stack:
+                chunks = _io(stack.enter_context, send(api_url, *args, **kwargs))
+                yield _timed_chunks(chunks)
+        finally:
+            timings.record(getattr(device, 'name', device), 'io', f"GET { resource_name(api_url) }", sum(spent))
+
+    target.stream = timed
+
+def resource_name(url):
+    """A RESTCONF url without the data prefix and query, like Cisco-IOS-XE-native:native/banner/motd"""
+    return f"{ url }".split('?', 1)[0].replace('/restconf/data/', '', 1)
+
+def instrument(device, rest=False, cli=False):
+    """Time every RESTCONF call of device.rest or every execute/configure of a connected device"""
+    if rest:
+        for method in ('get', 'put', 'patch'):
+            _timed_call(device, device.rest, method,
+                        lambda url, method=method.upper(): f"{ method } { resource_name(url) }")
+        if hasattr(device.rest, 'get_many'):
+            _timed_call(device, device.rest, 'get_many',
+                        lambda urls: f"GET { ' '.join(resource_name(url) for url in urls) }")
+        if hasattr(device.rest, 'stream'):
+            _timed_stream(device, device.rest)
+    if cli:
+        _timed_call(device, device, 'execute', lambda command: f"{ command }")
+        _timed_call(device, device, 'configure', lambda config: 'configure')
+
+def export_timings(testbed):
+    """Write the timings of the run where the testbed settings say and log the slowest devices and stages"""
+    settings = testbed.custom
+    jsonl = settings.get('timings_jsonl', DEFAULT_TIMINGS_JSONL)
+    if jsonl:
+        timings.write_jsonl(jsonl)
+    prometheus = settings.get('timings_prometheus', DEFAULT_TIMINGS_PROMETHEUS)
+    if prometheus:
+        timings.write_prometheus(prometheus)
+    timings.log_summary()
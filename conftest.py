@@ -0,0 +1,30 @@
+import socket
+import threading
+
+import pytest
+
+from bubo_simulator import Simulator, SimulatedDevice, write_testbed
+
+# ----------------
+# A simulated RESTCONF device behind a loaded testbed
+# ----------------
+@pytest.fixture
+def simulated_testbed(tmp_path):
+    """Serve one simulated device and return a function loading its testbed with a rest class"""
+    loader = pytest.importorskip('pyats.topology.loader')
+    device = SimulatedDevice('sim-00001', 4)
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    simulator = Simulator([device], base_port=port)
+    thread = threading.Thread(target=simulator.serve_forever, daemon=True)
+    thread.start()
+
+    def _load(connection_class, directory=None):
+        directory = directory or tmp_path / connection_class
+        write_testbed([device], str(directory), base_port=port, connection_class=connection_class)
+        return loader.load(str(directory / 'testbed_SIM.yaml'))
+
+    yield _load
+    simulator.stop()
+    thread.join()
@@ -0,0 +1,17 @@
+import pytest
+
+pytest.importorskip('aiohttp')
+
+from bubo_async_rest import AsyncRest
+from bubo_parallel import connect_devices
+
+def test_connect_devices_opens_async_rest_as_device_rest(simulated_testbed):
+    testbed = simulated_testbed('bubo_async_rest.AsyncRest')
+    assert connect_devices(testbed, via='rest') == ['sim-00001']
+    device = testbed.devices['sim-00001']
+    assert isinstance(device.rest, AsyncRest)
+    try:
+        response = device.rest.get('/restconf/data/Cisco-IOS-XE-native:native/version')
+        assert response.json() == {'Cisco-IOS-XE-native:version': '17.9'}
+    finally:
+        device.rest.disconnect()
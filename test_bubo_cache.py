@@ -0,0 +1,114 @@
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+from bubo_cache import SnapshotCache
+
+R1 = SimpleNamespace(name='r1')
+R2 = SimpleNamespace(name='r2')
+
+class Fetch(object):
+    """A fetch callable counting its calls"""
+
+    def __init__(self, value='data'):
+        self.value = value
+        self.calls = 0
+
+    def __call__(self, device):
+        self.calls += 1
+        return f"{ self.value } { device.name } { self.calls }"
+
+# ----------------
+# Fetch once, reuse after
+# ----------------
+def test_get_fetches_once_and_reuses():
+    cache, fetch = SnapshotCache(), Fetch()
+    assert cache.get(R1, 'native', fetch) == 'data r1 1'
+    assert cache.get(R1, 'native', fetch) == 'data r1 1'
+    assert cache.get(R2, 'native', fetch) == 'data r2 2'
+    assert fetch.calls == 2
+    assert (cache.fetched, cache.reused) == (2, 1)
+
+def test_put_is_reused_without_fetching():
+    cache, fetch = SnapshotCache(), Fetch()
+    cache.put('r1', 'native', 'prefetched')
+    assert cache.get(R1, 'native', fetch) == 'prefetched'
+    assert fetch.calls == 0
+
+def test_invalidate_forgets_every_key_of_the_device():
+    cache, fetch = SnapshotCache(), Fetch()
+    cache.get(R1, 'native', fetch)
+    cache.get(R1, 'interfaces', fetch)
+    cache.get(R2, 'native', fetch)
+    cache.invalidate(R1)
+    assert cache.get(R1, 'native', fetch) == 'data r1 4'
+    assert cache.get(R1, 'interfaces', fetch) == 'data r1 5'
+    assert cache.get(R2, 'native', fetch) == 'data r2 3'
+
+def test_evict_forgets_only_the_given_keys():
+    cache, fetch = SnapshotCache(), Fetch()
+    cache.get(R1, 'native', fetch)
+    cache.get(R1, 'interfaces', fetch)
+    cache.evict(R1, ['native', 'unknown'])
+    assert cache.get(R1, 'interfaces', fetch) == 'data r1 2'
+    assert cache.get(R1, 'native', fetch) == 'data r1 3'
+
+def test_watchers_hear_every_get():
+    cache, fetch = SnapshotCache(), Fetch()
+    heard = []
+    cache.watch(SimpleNamespace(consumed=lambda device_name, key: heard.append((device_name, key))))
+    cache.get(R1, 'native', fetch)
+    cache.get(R1, 'native', fetch)
+    assert heard == [('r1', 'native'), ('r1', 'native')]
+
+# ----------------
+# Snapshots still being prefetched
+# ----------------
+def _done(result=None, error=None):
+    future = Future()
+    if error is None:
+        future.set_result(result)
+    else:
+        future.set_exception(error)
+    return future
+
+def test_pending_snapshot_resolves_to_its_result():
+    cache, fetch = SnapshotCache(), Fetch()
+    cache.put_pending('r1', 'native', _done('prefetched'))
+    cache.put_pending('r1', 'interfaces', _done({'native': 'both', 'interfaces': 'keys'}), result_key='interfaces')
+    assert cache.get(R1, 'native', fetch) == 'prefetched'
+    assert cache.get(R1, 'interfaces', fetch) == 'keys'
+    assert fetch.calls == 0
+
+def test_pending_snapshot_is_replaced_by_its_result():
+    cache, fetch = SnapshotCache(), Fetch()
+    future = _done('prefetched')
+    cache.put_pending('r1', 'native', future)
+    cache.get(R1, 'native', fetch)
+    future.result = lambda: 'waited on again'
+    assert cache.get(R1, 'native', fetch) == 'prefetched'
+
+def test_failed_prefetch_is_fetched_again():
+    cache, fetch = SnapshotCache(), Fetch()
+    cache.put_pending('r1', 'native', _done(error=ConnectionError('session closed')))
+    assert cache.get(R1, 'native', fetch) == 'data r1 1'
+    assert cache.get(R1, 'native', fetch) == 'data r1 1'
+    assert fetch.calls == 1
+
+# ----------------
+# Held snapshots
+# ----------------
+def test_held_counts_devices_per_key():
+    cache, fetch = SnapshotCache(), Fetch()
+    cache.get(R1, 'interfaces', fetch)
+    cache.put_pending('r2', 'interfaces', _done('prefetched'))
+    cache.get(R1, 'native', fetch)
+    assert cache.held('interfaces') == 2
+    # Storing over a snapshot or resolving a prefetch holds no more devices
+    cache.put('r1', 'interfaces', 'again')
+    cache.get(R2, 'interfaces', fetch)
+    assert cache.held('interfaces') == 2
+    cache.evict(R1, ['interfaces', 'interfaces'])
+    assert (cache.held('interfaces'), cache.held('native')) == (1, 1)
+    cache.invalidate(R2)
+    cache.invalidate(R2)
+    assert (cache.held('interfaces'), cache.held('native')) == (0, 1)
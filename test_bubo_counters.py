@@ -0,0 +1,98 @@
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+import bubo_counters
+from bubo_counters import counter_delta, evaluate_counters, evaluate_counter_deltas, CounterStore, CounterRule
+
+RULES = [
+    CounterRule('in-errors', 'Input Errors Counter', 'input errors', packets=('in-pkts',)),
+    CounterRule('out-errors', 'Output Errors Counter', 'output errors', threshold=5, packets=('out-pkts',)),
+]
+THRESHOLDS = {'in-errors': 0, 'out-errors': 5}
+DEVICE = SimpleNamespace(name='r1', alias='R1')
+
+# ----------------
+# counter_delta
+# ----------------
+def test_counter_delta_increase():
+    assert counter_delta(10, 25) == 15
+    assert counter_delta(7, 7) == 0
+
+def test_counter_delta_wraps_32_bit():
+    assert counter_delta(2 ** 32 - 10, 5) == 15
+
+def test_counter_delta_wraps_64_bit():
+    assert counter_delta(2 ** 64 - 1, 0) == 1
+
+def test_counter_delta_clear_counts_from_zero():
+    # Far from the top of either width, so the counter was cleared
+    assert counter_delta(1000, 40) == 40
+
+# ----------------
+# evaluate_counters
+# ----------------
+INTERFACES = [
+    ('Gi1', {'in-errors': '3', 'out-errors': '5'}),
+    ('Gi2', {'in-errors': '0', 'out-errors': ''}),
+    ('Gi3', {'in-errors': str(2 ** 64 - 1)}),
+]
+
+def _rows(result):
+    return [[row[1], row[2] if row[2] == 'N/A' else int(row[2]), row[3]] for row in result.table_data]
+
+@pytest.fixture(params=['python', 'numpy'])
+def numpy_mode(request, monkeypatch):
+    if request.param == 'python':
+        monkeypatch.setattr(bubo_counters, 'numpy', None)
+    else:
+        pytest.importorskip('numpy')
+    return request.param
+
+def test_evaluate_counters(numpy_mode):
+    results = evaluate_counters(DEVICE, INTERFACES, RULES, THRESHOLDS)
+    assert _rows(results['in-errors']) == [['Gi1', 3, 'Failed'], ['Gi2', 0, 'Passed'], ['Gi3', 2 ** 64 - 1, 'Failed']]
+    assert results['in-errors'].failed_interfaces == {'Gi1': 3, 'Gi3': 2 ** 64 - 1}
+    assert _rows(results['out-errors']) == [['Gi1', 5, 'Passed'], ['Gi2', 'N/A', 'N/A'], ['Gi3', 'N/A', 'N/A']]
+    assert results['out-errors'].failed_interfaces == {}
+
+def test_counter_matrix_top_across_devices():
+    pytest.importorskip('numpy')
+    matrix = bubo_counters.fleet_counter_matrix(RULES)
+    evaluate_counters(DEVICE, INTERFACES, RULES, THRESHOLDS, matrix)
+    evaluate_counters(SimpleNamespace(name='r2', alias='R2'), [('Te1', {'in-errors': '7'})], RULES, THRESHOLDS, matrix)
+    assert matrix.top('in-errors', 2) == [('r1', 'Gi3', 2 ** 64 - 1), ('r2', 'Te1', 7)]
+    assert int(matrix.exceeds(THRESHOLDS).sum()) == 3
+
+# ----------------
+# evaluate_counter_deltas
+# ----------------
+def test_evaluate_counter_deltas_baseline_then_rates(tmp_path):
+    store = CounterStore(str(tmp_path / 'counters.db'))
+    limits = {'in-errors': {'per_second': None, 'per_million': 0}, 'out-errors': {'per_second': 1, 'per_million': None}}
+    first = evaluate_counter_deltas(DEVICE, [('Gi1', {'in-errors': '10', 'in-pkts': '1000', 'out-errors': '0'})],
+                                    RULES, limits, store, now=100)
+    assert first['in-errors'].table_data[0][-1] == 'Baseline'
+    second = evaluate_counter_deltas(DEVICE, [('Gi1', {'in-errors': '12', 'in-pkts': '3000', 'out-errors': '50'})],
+                                     RULES, limits, store, now=110)
+    assert second['in-errors'].table_data[0][3:] == [2, '0.2000', '1000.00', 'Failed']
+    assert second['out-errors'].failed_interfaces == {'Gi1': 50}
+
+def test_counter_store_closes_its_connections(tmp_path, monkeypatch):
+    store = CounterStore(str(tmp_path / 'counters.db'))
+    opened = []
+    connect = store._connect
+
+    def _connect():
+        opened.append(connect())
+        return opened[-1]
+
+    monkeypatch.setattr(store, '_connect', _connect)
+    store.save('r1', 100, {'Gi1': {'in-errors': 3}})
+    assert store.load('r1') == (100, {'Gi1': {'in-errors': 3}})
+    assert len(opened) == 2
+    for db in opened:
+        with pytest.raises(sqlite3.ProgrammingError):
+            db.execute('SELECT 1')
+
@@ -0,0 +1,30 @@
+from bubo_diff import diff, format_path, Change, ABSENT
+
+def test_equal_documents_have_no_changes():
+    document = {'native': {'interface': [{'name': '1', 'mtu': 1500}], 'ip': {'domain': {'name': 'x'}}}}
+    assert diff(document, {'native': {'ip': {'domain': {'name': 'x'}}, 'interface': [{'mtu': 1500, 'name': '1'}]}}) == []
+
+def test_changed_leaf():
+    assert diff({'a': {'b': 1, 'c': 2}}, {'a': {'b': 1, 'c': 3}}) == [Change(('a', 'c'), 2, 3)]
+
+def test_added_and_removed_keys():
+    changes = diff({'a': 1, 'b': 2}, {'b': 2, 'c': 3})
+    assert changes == [Change(('a',), 1, ABSENT), Change(('c',), ABSENT, 3)]
+
+def test_keyed_list_entries_match_by_name():
+    old = [{'name': 'Gi1', 'description': 'a'}, {'name': 'Gi2', 'description': 'b'}]
+    new = [{'name': 'Gi2', 'description': 'changed'}, {'name': 'Gi1', 'description': 'a'}, {'name': 'Gi3'}]
+    assert diff(old, new) == [Change((('name', 'Gi2'), 'description'), 'b', 'changed'),
+                              Change((('name', 'Gi3'),), ABSENT, {'name': 'Gi3'})]
+
+def test_unkeyed_lists_compare_by_position():
+    assert diff([1, 2, 3], [1, 5]) == [Change((1,), 2, 5), Change((2,), 3, ABSENT)]
+
+def test_type_change_below_an_equal_container():
+    # == takes 1, True and 1.0 for the same value
+    assert diff({'a': 1}, {'a': True}) == [Change(('a',), 1, True)]
+    assert diff({'b': [1, 2]}, {'b': [1.0, 2]}) == [Change(('b', 0), 1, 1.0)]
+
+def test_format_path():
+    assert format_path(('interface', ('name', 'Gi1'), 'config', 0)) == 'interface[name=Gi1]/config[0]'
+    assert format_path(()) == '/'
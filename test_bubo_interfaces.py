@@ -0,0 +1,37 @@
+from types import SimpleNamespace
+
+import pytest
+
+from bubo_interfaces import canonical_interface_name, canonical_mapping, intended_description, interface_name_index, match_interfaces
+
+@pytest.mark.parametrize('name, canonical', [
+    ('GigabitEthernet1', 'GigabitEthernet1'),
+    ('Gi1', 'GigabitEthernet1'),
+    ('gig 1/0/1', 'GigabitEthernet1/0/1'),
+    ('Te1/0/1', 'TenGigabitEthernet1/0/1'),
+    ('Twe1/0/1', 'TwentyFiveGigE1/0/1'),
+    ('Tw1/0/1', 'TwoGigabitEthernet1/0/1'),
+    ('Po10', 'Port-channel10'),
+    ('Lo0', 'Loopback0'),
+    ('vlan 100', 'Vlan100'),
+    ('Eth1/1', 'Ethernet1/1'),
+    # Unknown and ambiguous prefixes are left as they are
+    ('Foo1', 'Foo1'),
+    ('T1', 'T1'),
+])
+def test_canonical_interface_name(name, canonical):
+    assert canonical_interface_name(name) == canonical
+
+def test_interface_name_index_keeps_the_first_name_given():
+    assert interface_name_index(['Gi1', 'GigabitEthernet1', 'Lo0']) == {'GigabitEthernet1': 'Gi1', 'Loopback0': 'Lo0'}
+
+def test_match_interfaces_by_canonical_name():
+    intent = canonical_mapping({'Gi1': {'description': 'uplink'}, 'Lo9': {'description': 'spare'}})
+    actual = {'GigabitEthernet1': {'description': 'old'}, 'GigabitEthernet2': {}}
+    assert list(match_interfaces(actual, intent)) == [('GigabitEthernet1', {'description': 'old'}, {'description': 'uplink'})]
+
+def test_intended_description_of_intent_dicts_and_topology_interfaces():
+    assert intended_description({'type': 'ethernet', 'description': 'Uplink'}) == 'Uplink'
+    assert intended_description({'type': 'ethernet'}) is None
+    assert intended_description(SimpleNamespace(name='GigabitEthernet1', description='Uplink')) == 'Uplink'
+    assert intended_description(SimpleNamespace(name='GigabitEthernet1', description=None)) is None
@@ -0,0 +1,168 @@
+import threading
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import pytest
+
+import bubo_parallel
+from bubo_cache import SnapshotCache
+from bubo_parallel import connect_devices, prefetch, start_pipelines, stop_pipelines, Pipeline
+
+class Device(object):
+    """A device whose connect() succeeds, raises or hangs until released"""
+
+    def __init__(self, name, error=None, hang=None):
+        self.name = name
+        self.error = error
+        self.hang = hang
+        self.connected = []
+
+    def connect(self, alias=None, via=None):
+        if self.hang is not None:
+            self.hang.wait()
+        if self.error is not None:
+            raise self.error
+        self.connected.append((alias, via))
+
+def _testbed(*devices):
+    return SimpleNamespace(devices={device.name: device for device in devices})
+
+# ----------------
+# connect_devices
+# ----------------
+def test_connect_devices_returns_the_connected_in_testbed_order():
+    testbed = _testbed(Device('r1'), Device('r2', error=ConnectionError('refused')), Device('r3'))
+    assert connect_devices(testbed, pool_size=2) == ['r1', 'r3']
+    assert testbed.devices['r1'].connected == [(None, None)]
+
+def test_connect_devices_opens_via_under_its_alias():
+    testbed = _testbed(Device('r1'))
+    assert connect_devices(testbed, via='rest') == ['r1']
+    assert testbed.devices['r1'].connected == [('rest', 'rest')]
+
+def test_connect_devices_leaves_a_hung_connect_behind():
+    release = threading.Event()
+    # With one session at a time, r2 only connects once r1 is given up on
+    testbed = _testbed(Device('r1', hang=release), Device('r2'))
+    try:
+        assert connect_devices(testbed, pool_size=1, timeout=0.2) == ['r2']
+    finally:
+        release.set()
+
+# ----------------
+# prefetch
+# ----------------
+@pytest.fixture
+def cache(monkeypatch):
+    cache = SnapshotCache()
+    monkeypatch.setattr(bubo_parallel, 'snapshots', cache)
+    return cache
+
+def native(device):
+    return {'device': device.name, 'model': 'native'}
+
+def interfaces(device):
+    if device.name == 'r2':
+        raise ConnectionError('session closed')
+    return {'device': device.name, 'model': 'interfaces'}
+
+FETCHERS = {'native': native, 'interfaces': interfaces}
+DEVICES = [SimpleNamespace(name='r1'), SimpleNamespace(name='r2'), SimpleNamespace(name='r3')]
+
+def _unfetched(device):
+    raise AssertionError(f"{ device.name } was fetched again")
+
+def test_prefetch_threads_cache_every_device(cache):
+    assert prefetch(DEVICES, {'native': native}, pool_size=2) == ['r1', 'r2', 'r3']
+    for device in DEVICES:
+        assert cache.get(device, 'native', _unfetched) == native(device)
+
+def test_prefetch_leaves_a_failed_device_to_the_testcase(cache):
+    assert prefetch(DEVICES, FETCHERS, pool_size=2) == ['r1', 'r3']
+    assert cache.get(DEVICES[0], 'interfaces', _unfetched) == interfaces(DEVICES[0])
+    # Not even the fetchers that worked are kept for a device that failed
+    assert cache.get(DEVICES[1], 'native', lambda device: 'fetched again') == 'fetched again'
+
+def test_prefetch_processes_cache_every_device(cache):
+    pytest.importorskip('pyats.async_')
+    # A failure fails the whole pcall, so r1 is left to the testcase with r2
+    assert prefetch(DEVICES, FETCHERS, mode='process', pool_size=2) == ['r3']
+    assert cache.get(DEVICES[2], 'interfaces', _unfetched) == interfaces(DEVICES[2])
+    assert cache.get(DEVICES[0], 'native', lambda device: 'fetched again') == 'fetched again'
+
+def test_prefetch_rejects_an_unknown_mode(cache):
+    with pytest.raises(ValueError):
+        prefetch(DEVICES, FETCHERS, mode='fork')
+
+def test_prefetch_concurrent_keys_fetch_a_device_side_by_side(cache):
+    # Each fetcher only returns once the other has started
+    barrier = threading.Barrier(2, timeout=5)
+
+    def _meet(device):
+        barrier.wait()
+        return device.name
+
+    assert prefetch(DEVICES[:1], {'native': _meet, 'interfaces': _meet}, concurrent_keys=True) == ['r1']
+    assert cache.get(DEVICES[0], 'interfaces', _unfetched) == 'r1'
+
+# ----------------
+# Pipeline
+# ----------------
+class Pool(object):
+    """Runs submitted work at once and records the device of every submit"""
+
+    def __init__(self):
+        self.devices = []
+
+    def submit(self, work, device, *args):
+        self.devices.append(device.name)
+        future = Future()
+        future.set_result(work(device, *args))
+        return future
+
+FLEET = [SimpleNamespace(name=f"r{ number }") for number in range(6)]
+
+def test_pipeline_fetches_depth_devices_ahead(cache):
+    pool = Pool()
+    pipeline = Pipeline(FLEET, {'native': native}, pool, depth=2)
+    pipeline.start()
+    assert pool.devices == ['r0', 'r1']
+    pipeline.consumed('r0', 'native')
+    assert pool.devices == ['r0', 'r1', 'r2']
+    # Keys and devices of other testcases do not move it on
+    pipeline.consumed('r3', 'interfaces')
+    pipeline.consumed('r9', 'native')
+    assert pool.devices == ['r0', 'r1', 'r2']
+    pipeline.consumed('r3', 'native')
+    assert pool.devices == ['r0', 'r1', 'r2', 'r3', 'r4', 'r5']
+    assert cache.get(FLEET[4], 'native', _unfetched) == native(FLEET[4])
+
+def test_pipeline_starts_the_next_at_its_last_device(cache):
+    pool = Pool()
+    first = Pipeline(FLEET[:3], {'native': native}, pool, depth=3)
+    first.next = Pipeline(FLEET[:3], {'interfaces': interfaces}, pool, depth=3)
+    first.start()
+    first.consumed('r1', 'native')
+    assert not first.next.started
+    first.consumed('r2', 'native')
+    # r2 is still being tested, so it is not fetched for the next testcase yet
+    assert first.next.started
+    assert pool.devices == ['r0', 'r1', 'r2', 'r0', 'r1']
+
+def test_pipeline_concurrent_keys_fetch_each_key_on_its_own(cache):
+    pool = Pool()
+    Pipeline(FLEET[:1], FETCHERS, pool, depth=1, concurrent_keys=True).start()
+    assert pool.devices == ['r0', 'r0']
+    assert cache.get(FLEET[0], 'interfaces', _unfetched) == interfaces(FLEET[0])
+
+def test_start_pipelines_serves_every_testcase_from_prefetch(cache, monkeypatch):
+    monkeypatch.setattr(bubo_parallel, '_pipelines', [])
+    monkeypatch.setattr(bubo_parallel, '_pipeline_pool', None)
+    fleet = [device for device in FLEET if device.name != 'r2']
+    start_pipelines(fleet, [{'native': native}, {'interfaces': interfaces}], depth=1, pool_size=2)
+    try:
+        for key, fetch in (('native', native), ('interfaces', interfaces)):
+            for device in fleet:
+                assert cache.get(device, key, _unfetched) == fetch(device)
+    finally:
+        stop_pipelines()
@@ -0,0 +1,36 @@
+import json
+
+import pytest
+
+pytest.importorskip('aiohttp')
+
+from bubo_parallel import connect_devices
+from bubo_replay import ReplayRest, record
+
+VERSION = '/restconf/data/Cisco-IOS-XE-native:native/version'
+MOTD = '/restconf/data/Cisco-IOS-XE-native:native/banner/motd'
+
+def _exchanges(rest):
+    before = rest.get(MOTD)
+    patched = rest.patch(MOTD, payload=json.dumps({'Cisco-IOS-XE-native:motd': {'banner': 'Replayed'}}))
+    return [(response.status_code, response.content)
+            for response in (rest.get(VERSION), before, patched, rest.get(MOTD))]
+
+def test_recorded_exchanges_replay_through_device_rest(simulated_testbed, tmp_path):
+    cassettes = tmp_path / 'cassettes'
+    testbed = simulated_testbed('bubo_async_rest.AsyncRest')
+    assert connect_devices(testbed, via='rest') == ['sim-00001']
+    device = testbed.devices['sim-00001']
+    record(device, str(cassettes), rest=True)
+    try:
+        recorded = _exchanges(device.rest)
+    finally:
+        device.rest.disconnect()
+    assert recorded[1] != recorded[3]
+
+    testbed = simulated_testbed('bubo_replay.ReplayRest')
+    device = testbed.devices['sim-00001']
+    device.connections['rest']['cassettes'] = str(cassettes)
+    assert connect_devices(testbed, via='rest') == ['sim-00001']
+    assert isinstance(device.rest, ReplayRest)
+    assert _exchanges(device.rest) == recorded
@@ -0,0 +1,110 @@
+import json
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import pytest
+from requests.exceptions import HTTPError, RequestException
+
+import bubo_restconf
+from bubo_restconf import YangPatch, _decode, _trim, INTERFACE_FIELDS, OPENCONFIG_INTERFACES_ROOT
+
+# ----------------
+# YangPatch
+# ----------------
+def _patch():
+    patch = YangPatch('/restconf/data/Cisco-IOS-XE-native:native', 'Cisco-IOS-XE-native:native')
+    patch.add('motd', ('banner', 'motd', 'banner'), 'Keep out')
+    patch.add('domain name', ('ip', 'domain', 'name'), 'lab.example.com')
+    patch.add('interface Loopback1', ('interface', 'Loopback'), {'name': '1'}, list_entry=True)
+    patch.add('interface Loopback2', ('interface', 'Loopback'), {'name': '2'}, list_entry=True)
+    return patch
+
+def test_yang_patch_merges_changes_into_one_document():
+    [(labels, document)] = list(_patch().documents())
+    assert labels == ['motd', 'domain name', 'interface Loopback1', 'interface Loopback2']
+    assert document == {'Cisco-IOS-XE-native:native': {
+        'banner': {'motd': {'banner': 'Keep out'}},
+        'ip': {'domain': {'name': 'lab.example.com'}},
+        'interface': {'Loopback': [{'name': '1'}, {'name': '2'}]},
+    }}
+
+def test_yang_patch_chunks():
+    chunks = list(_patch().documents(chunk_size=3))
+    assert [labels for labels, document in chunks] == [['motd', 'domain name', 'interface Loopback1'],
+                                                       ['interface Loopback2']]
+    assert chunks[1][1] == {'Cisco-IOS-XE-native:native': {'interface': {'Loopback': [{'name': '2'}]}}}
+
+def test_yang_patch_send_reports_every_change():
+    sent = []
+
+    def patch(url, payload):
+        sent.append(json.loads(payload))
+        if len(sent) == 2:
+            raise HTTPError('400 Client Error', response=SimpleNamespace(status_code=400))
+        return SimpleNamespace(status_code=204, ok=True)
+
+    device = SimpleNamespace(name='r1', rest=SimpleNamespace(patch=patch))
+    outcomes = _patch().send(device, chunk_size=2)
+    assert len(sent) == 2
+    assert outcomes == [('motd', 204, True), ('domain name', 204, True),
+                        ('interface Loopback1', 400, False), ('interface Loopback2', 400, False)]
+
+def test_empty_yang_patch_sends_nothing():
+    def patch(url, payload):
+        raise AssertionError('an empty patch was sent')
+
+    device = SimpleNamespace(name='r1', rest=SimpleNamespace(patch=patch))
+    patch = YangPatch('/restconf/data/Cisco-IOS-XE-native:native', 'Cisco-IOS-XE-native:native')
+    assert list(patch.documents()) == []
+    assert patch.send(device) == []
+
+# ----------------
+# Missing resources
+# ----------------
+def test_decode_missing_resource():
+    assert _decode(SimpleNamespace(status_code=404, content=b'')) == {}
+    assert _decode(HTTPError('x', response=SimpleNamespace(status_code=404))) == {}
+    assert _decode(RequestException("Connection to '10.0.0.1:443' has returned the following code '404', "
+                                    "instead of the expected status code(s): '[200]'")) == {}
+    assert _decode(HTTPError('404 Client Error: Not Found for url: https://r1/restconf/data')) == {}
+
+def test_decode_does_not_mistake_other_errors_for_404():
+    for error in (RequestException('Read timed out fetching GigabitEthernet1/0/404'),
+                  RequestException("Connection to 'r1' has returned the following code '500' for Gi1/0/404")):
+        with pytest.raises(RequestException):
+            _decode(error)
+
+# ----------------
+# Trimmed OpenConfig interfaces
+# ----------------
+ENTRY = {
+    'name': 'GigabitEthernet1',
+    'config': {'name': 'GigabitEthernet1', 'description': 'uplink', 'mtu': 1500, 'type': 'iana-if-type:ethernetCsmacd'},
+    'state': {'admin-status': 'UP', 'oper-status': 'UP', 'mtu': 1500,
+              'counters': {'in-errors': '0', 'out-errors': '2'}},
+    'subinterfaces': {'subinterface': [{'index': 0}]},
+}
+
+def test_trim_keeps_only_the_checked_leaves():
+    assert _trim(ENTRY, INTERFACE_FIELDS) == {
+        'name': 'GigabitEthernet1',
+        'config': {'name': 'GigabitEthernet1', 'description': 'uplink'},
+        'state': {'admin-status': 'UP', 'oper-status': 'UP', 'counters': {'in-errors': '0', 'out-errors': '2'}},
+    }
+
+def test_trim_keeps_a_value_where_a_container_was_expected():
+    assert _trim({'config': 'unexpected'}, {'config': {'name': None}}) == {'config': 'unexpected'}
+
+def test_streamed_interfaces_match_the_trimmed_document():
+    pytest.importorskip('ijson')
+    body = json.dumps({OPENCONFIG_INTERFACES_ROOT: {'interface': [ENTRY, dict(ENTRY, name='GigabitEthernet2')]}}).encode()
+
+    @contextmanager
+    def stream(url):
+        yield iter([body[start:start + 7] for start in range(0, len(body), 7)])
+
+    device = SimpleNamespace(name='r1', rest=SimpleNamespace(stream=stream),
+                             testbed=SimpleNamespace(custom={'openconfig_streaming': True}))
+    streamed = bubo_restconf.fetch_interfaces(device)
+    assert streamed == {OPENCONFIG_INTERFACES_ROOT: {'interface': [
+        _trim(ENTRY, INTERFACE_FIELDS), _trim(dict(ENTRY, name='GigabitEthernet2'), INTERFACE_FIELDS)]}}
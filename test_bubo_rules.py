@@ -0,0 +1,30 @@
+from bubo_rules import NATIVE_RULES, LEARNED_CONFIG_RULES
+
+NATIVE = {'Cisco-IOS-XE-native:native': {'banner': {'motd': {'banner': 'Authorised access only'}},
+                                         'ip': {'domain': {'name': 'lab.example.com'}}}}
+
+def test_native_rules_pass():
+    results = NATIVE_RULES.evaluate('R1', {'motd': 'Authorised access only', 'domain_name': 'lab.example.com'}, NATIVE)
+    assert results['motd'].passed and results['domain_name'].passed
+    assert results['domain_name'].table_row() == ['R1', 'lab.example.com', 'lab.example.com', 'Passed']
+
+def test_native_rule_differs_and_missing():
+    results = NATIVE_RULES.evaluate('R1', {'motd': 'Keep out', 'domain_name': 'other.example.com'},
+                                    {'Cisco-IOS-XE-native:native': {'banner': {'motd': {'banner': 'Welcome'}}}})
+    assert results['motd'].table_row() == ['R1', 'Differs From Intent', 'Failed']
+    assert results['domain_name'].table_row() == ['R1', 'other.example.com', 'Not Configured', 'Failed']
+
+def test_rules_without_intent_are_none():
+    assert NATIVE_RULES.evaluate('R1', {}, NATIVE) == {'motd': None, 'domain_name': None}
+
+def test_has_line_rule():
+    config = {'ip domain name lab.example.com': {}, 'hostname R1': {}}
+    assert LEARNED_CONFIG_RULES.evaluate('R1', {'domain_name': 'lab.example.com'}, config)['domain_name'].passed
+    result = LEARNED_CONFIG_RULES.evaluate('R1', {'domain_name': 'other.example.com'}, config)['domain_name']
+    assert not result.passed
+    assert result.table_row() == ['R1', 'other.example.com', 'Not Configured', 'Failed']
+
+def test_evaluate_fleet_leaves_out_devices_without_intent():
+    fleet = NATIVE_RULES.evaluate_fleet([('R1', {'domain_name': 'lab.example.com'}, NATIVE), ('R2', {}, NATIVE)])
+    assert [result.device_alias for result in fleet['domain_name']] == ['R1']
+    assert fleet['motd'] == []
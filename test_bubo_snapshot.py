@@ -0,0 +1,46 @@
+import os
+from types import SimpleNamespace
+
+from bubo_snapshot import SnapshotStore, write_snapshot
+
+def _objects(store):
+    return [name for directory, subdirectories, files in os.walk(store.objects) for name in files]
+
+def test_identical_documents_are_stored_once(tmp_path):
+    store = SnapshotStore(str(tmp_path / 'store'))
+    digest, stored = store.put('r1', 'Native', 'PRE_TEST', {'a': 1, 'b': [1, 2]}, timestamp=1)
+    # Key order does not change the canonical encoding
+    again, stored_again = store.put('r2', 'Native', 'PRE_TEST', {'b': [1, 2], 'a': 1}, timestamp=2)
+    assert stored and not stored_again
+    assert again == digest
+    assert len(_objects(store)) == 1
+    assert [row[1] for row in store.list()] == ['r2', 'r1']
+
+def test_changed_documents_get_their_own_object(tmp_path):
+    store = SnapshotStore(str(tmp_path / 'store'))
+    first, stored = store.put('r1', 'Native', 'PRE_TEST', {'a': 1}, timestamp=1)
+    second, stored = store.put('r1', 'Native', 'POST_TEST', {'a': 2}, timestamp=2)
+    assert first != second and stored
+    assert len(_objects(store)) == 2
+    assert store.latest('r1', 'Native') == {'a': 2}
+    assert store.latest('r1', 'Native', 'PRE_TEST') == {'a': 1}
+    assert store.latest('r9', 'Native') is None
+
+def test_find_by_fingerprint(tmp_path):
+    store = SnapshotStore(str(tmp_path / 'store'))
+    digest, stored = store.put('r1', 'Native', 'FETCHED', {'a': 1}, timestamp=5, fingerprint='etag-1')
+    assert store.find('r1', 'Native', 'etag-1') == (5, digest)
+    assert store.find('r1', 'Native', 'etag-2') is None
+    assert store.load_object(digest) == {'a': 1}
+
+def _device(**custom):
+    return SimpleNamespace(name='r1', alias='r1', testbed=SimpleNamespace(custom=custom))
+
+def test_write_snapshot_keeps_no_store_unless_set(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('JSON')
+    write_snapshot(_device(), 'Native', 'PRE_TEST', {'a': 1})
+    assert os.listdir('JSON') == ['r1_Native_PRE_TEST.json']
+    write_snapshot(_device(snapshot_store=str(tmp_path / 'store'), snapshot_files=False), 'Native', 'POST_TEST', {'a': 2})
+    assert os.listdir('JSON') == ['r1_Native_PRE_TEST.json']
+    assert SnapshotStore(str(tmp_path / 'store')).latest('r1', 'Native') == {'a': 2}